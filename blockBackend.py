@@ -0,0 +1,264 @@
+import errno
+import os
+import stat
+import subprocess
+import time
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass
+import libvirt
+
+from libvirtOps import connection, DEFAULT_URI
+
+BLUE = '\033[94m'
+RED = '\033[91m'
+YELLOW = '\033[93m'
+RESET = '\033[0m'
+
+BACKENDS = ("file", "block", "lvm", "zvol")
+#zvols smaller than NTFS's 4k clusters make every guest write a read-modify-write
+ZVOL_BLOCK_SIZE = "16k"
+DEVICE_WAIT = 10
+
+@dataclass
+class DiskBackend:
+    """
+    Where the main disk lives when it isn't an image file
+
+    kind: 'block' (existing disk or partition), 'lvm' (new LV) or 'zvol' (new zvol)
+    device: the disk or partition for 'block'
+    pool: volume group ('lvm') or parent dataset ('zvol')
+    name: LV or zvol name, the VM name when not given
+    """
+    kind: str = "block"
+    device: str = None
+    pool: str = None
+    name: str = None
+
+def _block_name(device):
+    """sysfs name of a block device node, e.g. /dev/mapper/vg-lv -> dm-3"""
+    st = os.stat(device)
+    if not stat.S_ISBLK(st.st_mode):
+        raise ValueError(f"{device} is not a block device")
+    return os.path.basename(os.path.realpath(f"/sys/dev/block/{os.major(st.st_rdev)}:{os.minor(st.st_rdev)}"))
+
+def _partitions(name, root="/"):
+    """Partitions of a whole disk (nvme0n1 -> [nvme0n1p1, ...])"""
+    base = os.path.join(root, "sys/class/block", name)
+    try:
+        entries = os.listdir(base)
+    except OSError:
+        return []
+    return sorted(entry for entry in entries if os.path.exists(os.path.join(base, entry, "partition")))
+
+def _mounted_names(root="/"):
+    """sysfs names of mounted and swap devices"""
+    names = set()
+    for path, column in (("proc/self/mounts", 0), ("proc/swaps", 0)):
+        try:
+            with open(os.path.join(root, path)) as f:
+                lines = f.read().splitlines()
+        except OSError:
+            continue
+        for line in lines:
+            fields = line.split()
+            if not fields or not fields[column].startswith("/dev/"):
+                continue
+            try:
+                names.add(_block_name(fields[column]) if root == "/" else os.path.basename(fields[column]))
+            except (OSError, ValueError):
+                continue
+    return names
+
+def _domains_using(device, conn=None, uri=DEFAULT_URI):
+    """Names of libvirt domains that already have device as a disk"""
+    real = os.path.realpath(device)
+    users = []
+    with connection(conn, uri) as conn:
+        for dom in conn.listAllDomains():
+            root = ET.fromstring(dom.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE))
+            for source in root.findall("./devices/disk/source"):
+                if source.get("dev") and os.path.realpath(source.get("dev")) == real:
+                    users.append(dom.name())
+    return users
+
+def device_in_use(device, name=None, root="/", conn=None):
+    """
+    Why device can't be given to a VM, or None if it is free: mounted (it
+    or one of its partitions), swap, held by LVM/dm/md, opened exclusively
+    or already a disk of another domain
+
+    Args:
+        name: sysfs name, looked up from the device node when not given
+    """
+    name = name or _block_name(device)
+    mounted = _mounted_names(root)
+    for part in [name] + _partitions(name, root):
+        if part in mounted:
+            return f"{part} is mounted or used as swap"
+        try:
+            holders = os.listdir(os.path.join(root, "sys/class/block", part, "holders"))
+        except OSError:
+            holders = []
+        if holders:
+            return f"{part} is held by {', '.join(sorted(holders))} (LVM, device mapper or RAID)"
+
+    if root == "/":
+        #The kernel refuses O_EXCL while anything has the device claimed
+        try:
+            fd = os.open(device, os.O_RDONLY | os.O_EXCL)
+            os.close(fd)
+        except OSError as e:
+            if e.errno == errno.EBUSY:
+                return f"{device} is busy (opened exclusively by another process)"
+            raise
+        users = _domains_using(device, conn)
+        if users:
+            return f"{device} is already a disk of {', '.join(users)}"
+    return None
+
+def device_size(name, root="/"):
+    """Size in bytes from sysfs (512 byte sectors)"""
+    with open(os.path.join(root, "sys/class/block", name, "size")) as f:
+        return int(f.read()) * 512
+
+def filesystem_type(device):
+    """Filesystem/partition table signature blkid finds on device, if any"""
+    result = subprocess.run(["blkid", "-p", "-o", "value", "-s", "TYPE", device], capture_output=True, text=True)
+    if result.returncode == 0 and result.stdout.strip():
+        return result.stdout.strip()
+    result = subprocess.run(["blkid", "-p", "-o", "value", "-s", "PTTYPE", device], capture_output=True, text=True)
+    return f"{result.stdout.strip()} partition table" if result.returncode == 0 and result.stdout.strip() else None
+
+def _wait_for_device(path, timeout=DEVICE_WAIT):
+    """udev creates the node shortly after lvcreate/zfs create return"""
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(path):
+        if time.monotonic() >= deadline:
+            raise ValueError(f"{path} didn't appear after {timeout}s")
+        time.sleep(0.2)
+    return path
+
+def create_lvm_volume(volume_group, name, size_gb):
+    """Create a logical volume for the VM. Returns its device path"""
+    subprocess.run(["lvcreate", "-y", "-n", name, "-L", f"{size_gb}G", volume_group], check=True)
+    return _wait_for_device(f"/dev/{volume_group}/{name}")
+
+def create_zvol(parent, name, size_gb, block_size=ZVOL_BLOCK_SIZE):
+    """Create a sparse zvol for the VM. Returns its device path"""
+    dataset = f"{parent}/{name}"
+    subprocess.run(["zfs", "create", "-s", "-V", f"{size_gb}G", "-o", f"volblocksize={block_size}",
+                    "-o", "compression=lz4", dataset], check=True)
+    return _wait_for_device(f"/dev/zvol/{dataset}")
+
+def remove_backend(backend, vm_name):
+    """Destroy the LV or zvol prepare_backend created for the VM. Existing disks are left alone"""
+    name = backend.name or vm_name
+    if backend.kind == "lvm":
+        subprocess.run(["lvremove", "-y", f"{backend.pool}/{name}"], check=True)
+    elif backend.kind == "zvol":
+        subprocess.run(["zfs", "destroy", f"{backend.pool}/{name}"], check=True)
+
+def prepare_backend(backend, vm_name, size_gb, conn=None):
+    """
+    Create the LV or zvol, or check the given disk/partition
+
+    Returns:
+        Device path for the domain's <disk type='block'>
+    """
+    name = backend.name or vm_name
+    if backend.kind == "lvm":
+        return create_lvm_volume(backend.pool, name, size_gb)
+    if backend.kind == "zvol":
+        return create_zvol(backend.pool, name, size_gb)
+
+    device = backend.device
+    reason = device_in_use(device, conn=conn)
+    if reason:
+        raise ValueError(reason)
+    size = device_size(_block_name(device))
+    if size < size_gb * 1024**3:
+        print(f"⚠️  Note ⚠️ : {device} is {size / 1024**3:.1f}GB, smaller than the {size_gb}GB asked for")
+    return device
+
+def block_disk_element(device, target, bus, boot=None):
+    """<disk type='block'> with the driver options that suit a raw device"""
+    disk = ET.Element("disk", {"type": "block", "device": "disk"})
+    ET.SubElement(disk, "driver", {"name": "qemu", "type": "raw", "cache": "none", "io": "native",
+                                   "discard": "unmap", "detect_zeroes": "unmap"})
+    ET.SubElement(disk, "source", {"dev": device})
+    ET.SubElement(disk, "target", {"dev": target, "bus": bus})
+    if boot is not None:
+        ET.SubElement(disk, "boot", {"order": str(boot)})
+    return disk
+
+def block_disk_transform(root, vm_name, device):
+    """
+    Point the main disk of the domain tree at a block device, keeping its
+    target and boot order
+
+    Returns:
+        The image path it used before
+    """
+    devices = root.find("devices")
+    for index, disk in enumerate(list(devices)):
+        if disk.tag != "disk" or disk.get("device") != "disk":
+            continue
+        source = disk.find("source")
+        path = source.get("file") if source is not None else None
+        if not path or os.path.basename(path) not in (f"{vm_name}.qcow2", f"{vm_name}.img"):
+            continue
+        target = disk.find("target")
+        new = block_disk_element(device, target.get("dev"), target.get("bus"))
+        for keep in ("boot", "alias"):
+            elem = disk.find(keep)
+            if elem is not None:
+                new.append(elem)
+        devices.remove(disk)
+        devices.insert(index, new)
+        return path
+    return None
+
+def copy_image_to_device(image, device):
+    """Write the VM's image onto the device (qemu-img convert into an existing target)"""
+    fmt = "qcow2" if image.endswith(".qcow2") else "raw"
+    subprocess.run(["qemu-img", "convert", "-p", "-f", fmt, "-O", "raw", "-t", "none", "-n", image, device],
+                   check=True)
+
+def prompt_disk_backend(vm_name):
+    """
+    Ask where the main disk should live
+
+    Returns:
+        DiskBackend, or None for an image file
+    """
+    kind = input(f"Disk backend {'/'.join(BACKENDS)} (Default {BLUE}file{RESET}): ").strip().lower() or "file"
+    if kind not in BACKENDS:
+        print(f"Unknown backend '{kind}', using an image file")
+        kind = "file"
+    if kind == "file":
+        return None
+
+    if kind == "block":
+        while True:
+            device = input("Disk or partition for the VM (e.g. /dev/nvme1n1): ").strip()
+            try:
+                reason = device_in_use(device)
+            except (OSError, ValueError) as e:
+                reason = str(e)
+            if reason:
+                print(f"🚨 Error 🚨 : {RED}{reason}{RESET}")
+                continue
+            signature = filesystem_type(device)
+            if signature:
+                wipe = input(f"{device} has a {YELLOW}{signature}{RESET} signature. Windows setup will "
+                             "overwrite it. Continue (y/N)? ").strip().lower()
+                if wipe not in ("yes", "y"):
+                    continue
+            return DiskBackend(kind="block", device=device)
+
+    pool_label = "Volume group" if kind == "lvm" else "Parent ZFS dataset (e.g. rpool/vms)"
+    pool = ""
+    while not pool:
+        pool = input(f"{pool_label}: ").strip()
+    name = input(f"Volume name (Default {BLUE}{vm_name}{RESET}): ").strip() or vm_name
+    return DiskBackend(kind=kind, pool=pool, name=name)
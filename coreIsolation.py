@@ -0,0 +1,173 @@
+import json
+import os
+import subprocess
+import sys
+import xml.etree.ElementTree as ET
+
+from hostProbe import parse_cpu_list, format_cpu_list
+
+#Units whose processes are kept off the guest's cores while it runs (the VM itself is in machine.slice)
+HOST_UNITS = ("system.slice", "user.slice", "init.scope")
+CGROUP_DIR = "sys/fs/cgroup"
+#Unbound workqueues (kworkers) and the writeback workqueue follow these masks
+WORKQUEUE_MASKS = ("sys/devices/virtual/workqueue/cpumask", "sys/bus/workqueue/devices/writeback/cpumask")
+DOMAIN_XML_DIR = "etc/libvirt/qemu"
+STATE_DIR = "run/single-gpu-passthrough"
+#Hook scripts run from here, so the isolation doesn't depend on where the repo was checked out
+HOOK_LIB_DIR = "/etc/libvirt/hooks/lib"
+HOOK_MODULES = ("hookEngine.py", "hookTimings.py", "coreIsolation.py", "pciDevices.py", "hostProbe.py")
+
+def _read(path, default=None):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return default
+
+def _write(path, text):
+    with open(path, "w") as f:
+        f.write(text)
+
+def guest_cpus(domain):
+    """Host CPUs the domain's vCPUs are pinned to (<cputune><vcpupin>), empty when it isn't pinned"""
+    cpus = set()
+    for pin in domain.findall("./cputune/vcpupin"):
+        cpus.update(parse_cpu_list(pin.get("cpuset", "")))
+    return sorted(cpus)
+
+def read_domain(vm_name, root="/"):
+    """
+    The domain's persistent XML from libvirt's config directory. Hooks can't
+    call back into libvirtd (it waits for them), so the file is read directly
+    """
+    return ET.parse(os.path.join(root, DOMAIN_XML_DIR, f"{vm_name}.xml")).getroot()
+
+def cpu_mask(cpus):
+    """Kernel hex bitmap for a cpu list, 32 bit groups separated by commas ([0, 1, 33] -> '2,00000003')"""
+    value = sum(1 << cpu for cpu in cpus)
+    groups = []
+    while True:
+        groups.append(value & 0xFFFFFFFF)
+        value >>= 32
+        if not value:
+            break
+    return ",".join([f"{groups[-1]:x}"] + [f"{group:08x}" for group in reversed(groups[:-1])])
+
+def plan_isolation(domain, root="/"):
+    """
+    Split the online CPUs into the guest's (from its pinning) and the ones
+    the host keeps
+
+    Returns:
+        (guest cpus, host cpus), host cpus empty when there is nothing to isolate
+    """
+    online = parse_cpu_list(_read(os.path.join(root, "sys/devices/system/cpu/online"), ""))
+    guest = [cpu for cpu in guest_cpus(domain) if cpu in online]
+    host = [cpu for cpu in online if cpu not in guest]
+    if not guest or not host:
+        return guest, []
+    return guest, host
+
+def isolation_kernel_params(host, cpus):
+    """
+    Kernel options that take cpus (widened to whole cores) away from the
+    scheduler, the timer tick, RCU callbacks and managed IRQs at boot
+
+    Args:
+        host: HostTopology
+        cpus: Guest CPUs, e.g. PinPlan.guest_cpus
+    """
+    isolated = set()
+    for cpu in cpus:
+        core = host.core_of(cpu)
+        isolated.update(core.cpus if core else [cpu])
+    housekeeping = [cpu for cpu in host.logical_cpus if cpu not in isolated]
+    if not housekeeping:
+        raise ValueError("At least one core has to stay with the host")
+    #The boot CPU keeps timekeeping, nohz_full can't include it
+    if 0 in isolated:
+        raise ValueError("CPU 0 can't be isolated, it handles the host's timekeeping")
+    isolated = format_cpu_list(isolated)
+    return (f"isolcpus=managed_irq,domain,{isolated} nohz_full={isolated} rcu_nocbs={isolated} "
+            f"irqaffinity={format_cpu_list(housekeeping)}")
+
+def _set_allowed_cpus(unit, cpus, root="/"):
+    """AllowedCPUs for a unit until reboot. An empty list lifts the restriction"""
+    value = format_cpu_list(cpus)
+    if root == "/":
+        subprocess.run(["systemctl", "set-property", "--runtime", "--", unit, f"AllowedCPUs={value}"], check=True)
+    else:
+        #A fake tree gets what systemd would write to the cgroup
+        _write(os.path.join(root, CGROUP_DIR, unit, "cpuset.cpus"), value)
+
+def _state_path(vm_name, root="/"):
+    return os.path.join(root, STATE_DIR, f"{vm_name}.isolation.json")
+
+def isolate_host(vm_name, root="/"):
+    """
+    Confine host services, user sessions and unbound kernel workqueues to the
+    CPUs the VM isn't pinned to. What was there before is saved for
+    release_host
+
+    Returns:
+        The host CPUs, or an empty list if the VM isn't pinned
+    """
+    guest, host = plan_isolation(read_domain(vm_name, root), root)
+    if not host:
+        print(f"'{vm_name}' has no vCPU pinning that leaves CPUs for the host, not isolating")
+        return []
+
+    state_path = _state_path(vm_name, root)
+    #A second prepare without a release must not save the isolated state as the original
+    if not os.path.exists(state_path):
+        state = {"units": {}, "workqueues": {}}
+        for unit in HOST_UNITS:
+            state["units"][unit] = _read(os.path.join(root, CGROUP_DIR, unit, "cpuset.cpus"), "")
+        for mask in WORKQUEUE_MASKS:
+            value = _read(os.path.join(root, mask))
+            if value is not None:
+                state["workqueues"][mask] = value
+        os.makedirs(os.path.dirname(state_path), exist_ok=True)
+        _write(state_path, json.dumps(state, indent=2))
+
+    for unit in HOST_UNITS:
+        _set_allowed_cpus(unit, host, root)
+    for mask in WORKQUEUE_MASKS:
+        if os.path.exists(os.path.join(root, mask)):
+            _write(os.path.join(root, mask), cpu_mask(host))
+    print(f"Host confined to CPUs {format_cpu_list(host)}, '{vm_name}' has {format_cpu_list(guest)}")
+    return host
+
+def release_host(vm_name, root="/"):
+    """
+    Undo isolate_host
+
+    Returns:
+        False if there was nothing to restore
+    """
+    state_path = _state_path(vm_name, root)
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return False
+
+    for unit, cpus in state["units"].items():
+        _set_allowed_cpus(unit, parse_cpu_list(cpus), root)
+    for mask, value in state["workqueues"].items():
+        try:
+            _write(os.path.join(root, mask), value)
+        except OSError as e:
+            print(f"Couldn't restore {mask}: {e}")
+    os.remove(state_path)
+    print(f"Host has all CPUs back from '{vm_name}'")
+    return True
+
+if __name__ == "__main__":
+    #Called from the hooks: python3 coreIsolation.py isolate|release <vm name>
+    if len(sys.argv) != 3 or sys.argv[1] not in ("isolate", "release"):
+        sys.exit("Usage: coreIsolation.py isolate|release <vm name>")
+    if sys.argv[1] == "isolate":
+        isolate_host(sys.argv[2])
+    else:
+        release_host(sys.argv[2])
@@ -0,0 +1,169 @@
+import sys
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass, field
+
+from hostProbe import probe_host, format_cpu_list
+
+BLUE = '\033[94m'
+YELLOW = '\033[93m'
+RESET = '\033[0m'
+
+@dataclass
+class PinPlan:
+    """Mapping of guest vCPUs onto dedicated host cores"""
+    vcpu_pins: list = field(default_factory=list)   #host cpu for each vCPU index
+    emulator_cpus: list = field(default_factory=list)
+    iothread_cpus: list = field(default_factory=list)
+    sockets: int = 1
+    cores: int = 0
+    threads: int = 1
+    l3_ids: list = field(default_factory=list)
+    realtime: bool = False
+    boot_isolation: bool = False   #isolcpus/nohz_full for the guest cores on the kernel command line
+
+    @property
+    def vcpus(self):
+        return len(self.vcpu_pins)
+
+    @property
+    def guest_cpus(self):
+        return sorted(self.vcpu_pins)
+
+def _pick_cores(candidates, count):
+    """Prefer cores from a single L3 domain, otherwise fill the largest domains first"""
+    by_l3 = {}
+    for core in candidates:
+        by_l3.setdefault(core.l3_id, []).append(core)
+
+    #Smallest domain that still fits keeps the other CCXs whole for the host
+    fitting = [cores for cores in by_l3.values() if len(cores) >= count]
+    if fitting:
+        return min(fitting, key=len)[:count]
+
+    chosen = []
+    for cores in sorted(by_l3.values(), key=len, reverse=True):
+        chosen.extend(cores[:count - len(chosen)])
+        if len(chosen) == count:
+            break
+    return chosen
+
+def plan_cpu_pinning(host, guest_cores, reserve_cores=1, allowed_cpus=None, realtime=False, exclude_cpus=None):
+    """
+    Pick whole physical cores (with their SMT siblings) for the guest
+
+    Args:
+        host: HostTopology from hostProbe.probe_host
+        guest_cores: Number of physical cores to give the guest
+        reserve_cores: Cores kept for the host, emulator and IO threads
+        allowed_cpus: Optional set of host CPUs the guest may use (e.g. one NUMA node)
+        realtime: Emit a FIFO <vcpusched> policy for the vCPUs
+        exclude_cpus: Host CPUs already given to other VMs, cores holding any are skipped
+
+    Returns:
+        A PinPlan, or None if the host does not have enough cores
+    """
+    cores = list(host.cores)
+    if allowed_cpus is not None:
+        allowed_cpus = set(allowed_cpus)
+        cores = [core for core in cores if set(core.cpus) <= allowed_cpus]
+
+    #The lowest cores (cpu0 and its neighbours) do most of the host's IRQ and housekeeping work
+    cores.sort(key=lambda core: core.cpus[0])
+    housekeeping = cores[:reserve_cores]
+    candidates = cores[reserve_cores:]
+    if exclude_cpus:
+        #The housekeeping cores stay the same, other VMs' emulator threads share them
+        candidates = [core for core in candidates if not set(core.cpus) & set(exclude_cpus)]
+
+    if guest_cores < 1 or guest_cores > len(candidates):
+        return None
+
+    chosen = sorted(_pick_cores(candidates, guest_cores), key=lambda core: core.cpus[0])
+    threads = min(len(core.cpus) for core in chosen)
+
+    #Siblings get consecutive vCPU numbers so the guest sees them as one core
+    vcpu_pins = [cpu for core in chosen for cpu in core.cpus[:threads]]
+    host_cpus = sorted(cpu for core in housekeeping for cpu in core.cpus)
+
+    return PinPlan(
+        vcpu_pins=vcpu_pins,
+        emulator_cpus=host_cpus,
+        iothread_cpus=host_cpus,
+        sockets=1,
+        cores=len(chosen),
+        threads=threads,
+        l3_ids=sorted({core.l3_id for core in chosen if core.l3_id is not None}),
+        realtime=realtime,
+    )
+
+def apply_cputune(root, plan):
+    """Write <vcpu>, <cputune> and the <cpu> topology for a PinPlan into a domain tree"""
+    vcpu = root.find("vcpu")
+    if vcpu is None:
+        vcpu = ET.SubElement(root, "vcpu")
+    vcpu.set("placement", "static")
+    vcpu.text = str(plan.vcpus)
+
+    for old in root.findall("cputune"):
+        root.remove(old)
+    cputune = ET.Element("cputune")
+    #Keep <cputune> right after <vcpu> like libvirt does
+    root.insert(list(root).index(vcpu) + 1, cputune)
+
+    for index, cpu in enumerate(plan.vcpu_pins):
+        ET.SubElement(cputune, "vcpupin", {"vcpu": str(index), "cpuset": str(cpu)})
+    if plan.emulator_cpus:
+        ET.SubElement(cputune, "emulatorpin", {"cpuset": format_cpu_list(plan.emulator_cpus)})
+
+    iothreads = root.find("iothreads")
+    if iothreads is not None and plan.iothread_cpus:
+        for iothread in range(1, int(iothreads.text or 0) + 1):
+            ET.SubElement(cputune, "iothreadpin", {
+                "iothread": str(iothread),
+                "cpuset": format_cpu_list(plan.iothread_cpus),
+            })
+
+    if plan.realtime:
+        ET.SubElement(cputune, "vcpusched", {
+            "vcpus": f"0-{plan.vcpus - 1}",
+            "scheduler": "fifo",
+            "priority": "1",
+        })
+
+    cpu = root.find("cpu")
+    if cpu is None:
+        cpu = ET.SubElement(root, "cpu", {"mode": "host-passthrough"})
+    for old in cpu.findall("topology"):
+        cpu.remove(old)
+    ET.SubElement(cpu, "topology", {
+        "sockets": str(plan.sockets),
+        "dies": "1",
+        "cores": str(plan.cores),
+        "threads": str(plan.threads),
+    })
+    return root
+
+def print_pin_plan(plan):
+    """Dry-run output of a PinPlan"""
+    print(f"Guest topology: {BLUE}{plan.sockets}{RESET} socket(s), "
+          f"{BLUE}{plan.cores}{RESET} core(s), {BLUE}{plan.threads}{RESET} thread(s)")
+    if plan.l3_ids:
+        print(f"L3 cache domain(s): {', '.join(str(i) for i in plan.l3_ids)}")
+    for index, cpu in enumerate(plan.vcpu_pins):
+        print(f"  - vCPU {index:<3} ➡️  host CPU {BLUE}{cpu}{RESET}")
+    print(f"  - emulator   ➡️  host CPUs {YELLOW}{format_cpu_list(plan.emulator_cpus)}{RESET}")
+    print(f"  - iothreads  ➡️  host CPUs {YELLOW}{format_cpu_list(plan.iothread_cpus)}{RESET}")
+    if plan.realtime:
+        print("  - vCPU scheduler: FIFO priority 1")
+    if plan.boot_isolation:
+        print("  - guest cores isolated from the host at boot (isolcpus, nohz_full, rcu_nocbs)")
+
+if __name__ == "__main__":
+    #Dry run: python3 cpuPinning.py [guest_cores]
+    host = probe_host()
+    guest_cores = int(sys.argv[1]) if len(sys.argv) > 1 else len(host.cores) - 1
+    plan = plan_cpu_pinning(host, guest_cores)
+    if plan is None:
+        sys.exit(f"Cannot pin {guest_cores} cores on a host with {len(host.cores)} cores")
+    print_pin_plan(plan)
+    print(ET.tostring(apply_cputune(ET.Element("domain"), plan), encoding="unicode"))
@@ -0,0 +1,243 @@
+import os
+import subprocess
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass, field
+import libvirt
+
+from libvirtOps import connection, DEFAULT_URI
+from hostProbe import IMAGES_PATH, read_cpu_flags, read_numa_nodes
+from cpuPinning import apply_cputune
+from hugepages import apply_memory_backing
+from storageTuning import apply_storage_profile, volume_xml, DiskAllocation
+from hooks import pci_hostdev_element
+from guestLatency import apply_latency_profile
+from numaPlacement import apply_numa_placement
+from blockBackend import block_disk_element, prepare_backend, remove_backend
+
+LIBOSINFO_NS = "http://libosinfo.org/xmlns/libvirt/domain/1.0"
+
+#libosinfo ids for the os variants virt-install used to be given
+OS_VARIANTS = {
+    "win11": "http://microsoft.com/win/11",
+    "win10": "http://microsoft.com/win/10",
+}
+
+@dataclass
+class VmConfig:
+    """Everything needed to render and define the VM in one pass"""
+    name: str = "Windows_VM"
+    memory_mb: int = 4096
+    disk_size_gb: int = 50
+    sockets: int = 1
+    cores: int = 1
+    threads: int = 1
+    iso_file: str = None
+    unattend_iso: str = None
+    disk_path: str = None
+    #Windows setup only sees a virtio disk with viostor, which the unattended install loads
+    disk_bus: str = "virtio"
+    os_variant: str = "win11"
+    network: str = "default"
+    graphics: str = "vnc"
+    vnc_password: str = None
+    secure_boot: bool = True
+    tpm: bool = True
+    hostdevs: list = field(default_factory=list)
+    pin_plan: object = None
+    hugepage_size: str = None
+    storage_profile: object = None
+    disk_allocation: object = None
+    disk_backend: object = None
+    block_device: str = None
+    latency_profile: bool = True
+    hide_kvm: bool = False
+    numa_node: int = None
+
+    @property
+    def vcpus(self):
+        return int(self.sockets) * int(self.cores) * int(self.threads)
+
+    def main_disk_path(self):
+        extension = (self.disk_allocation or DiskAllocation()).extension()
+        return self.disk_path or os.path.join(IMAGES_PATH, f"{self.name}{extension}")
+
+def _sub(parent, tag, text=None, **attrs):
+    elem = ET.SubElement(parent, tag, {k.rstrip("_"): str(v) for k, v in attrs.items()})
+    if text is not None:
+        elem.text = str(text)
+    return elem
+
+def _add_disk(devices, path, target, bus, device="disk", boot=None, driver_type=None, readonly=False):
+    disk = _sub(devices, "disk", type="file", device=device)
+    if driver_type is None:
+        driver_type = "qcow2" if path.endswith(".qcow2") else "raw"
+    _sub(disk, "driver", name="qemu", type=driver_type)
+    _sub(disk, "source", file=path)
+    _sub(disk, "target", dev=target, bus=bus)
+    if readonly:
+        _sub(disk, "readonly")
+    if boot is not None:
+        _sub(disk, "boot", order=boot)
+    return disk
+
+def _add_graphics(devices, config):
+    if config.graphics == "vnc":
+        graphics = _sub(devices, "graphics", type="vnc", port="-1", autoport="yes", listen="0.0.0.0")
+        if config.vnc_password:
+            graphics.set("passwd", config.vnc_password[:8])
+        _sub(graphics, "listen", type="address", address="0.0.0.0")
+        video = _sub(devices, "video")
+        _sub(video, "model", type="vga", vram="16384", heads="1", primary="yes")
+    elif config.graphics == "spice":
+        graphics = _sub(devices, "graphics", type="spice", autoport="yes")
+        _sub(graphics, "listen", type="address")
+        _sub(graphics, "image", compression="off")
+        channel = _sub(devices, "channel", type="spicevmc")
+        _sub(channel, "target", type="virtio", name="com.redhat.spice.0")
+        _sub(devices, "audio", id="1", type="spice")
+        video = _sub(devices, "video")
+        _sub(video, "model", type="qxl", ram="65536", vram="65536", vgamem="16384", heads="1", primary="yes")
+
+def build_domain_tree(config):
+    """Render the q35/OVMF/TPM domain for a VmConfig as an ElementTree"""
+    ET.register_namespace("libosinfo", LIBOSINFO_NS)
+    root = ET.Element("domain", {"type": "kvm"})
+    _sub(root, "name", config.name)
+
+    metadata = _sub(root, "metadata")
+    libosinfo = ET.SubElement(metadata, f"{{{LIBOSINFO_NS}}}libosinfo")
+    ET.SubElement(libosinfo, f"{{{LIBOSINFO_NS}}}os", {"id": OS_VARIANTS.get(config.os_variant, OS_VARIANTS["win11"])})
+
+    _sub(root, "memory", config.memory_mb, unit="MiB")
+    _sub(root, "currentMemory", config.memory_mb, unit="MiB")
+    _sub(root, "vcpu", config.vcpus, placement="static")
+
+    os_elem = _sub(root, "os", firmware="efi")
+    _sub(os_elem, "type", "hvm", arch="x86_64", machine="q35")
+    firmware = _sub(os_elem, "firmware")
+    _sub(firmware, "feature", enabled="yes" if config.secure_boot else "no", name="enrolled-keys")
+    _sub(firmware, "feature", enabled="yes" if config.secure_boot else "no", name="secure-boot")
+    if config.secure_boot:
+        _sub(os_elem, "loader", secure="yes")
+
+    features = _sub(root, "features")
+    _sub(features, "acpi")
+    _sub(features, "apic")
+    hyperv = _sub(features, "hyperv", mode="custom")
+    _sub(hyperv, "relaxed", state="on")
+    _sub(hyperv, "vapic", state="on")
+    _sub(hyperv, "spinlocks", state="on", retries="8191")
+    _sub(features, "vmport", state="off")
+    _sub(features, "smm", state="on")
+
+    cpu = _sub(root, "cpu", mode="host-passthrough", check="none", migratable="on")
+    _sub(cpu, "topology", sockets=config.sockets, dies="1", cores=config.cores, threads=config.threads)
+
+    clock = _sub(root, "clock", offset="localtime")
+    _sub(clock, "timer", name="rtc", tickpolicy="catchup")
+    _sub(clock, "timer", name="pit", tickpolicy="delay")
+    _sub(clock, "timer", name="hpet", present="no")
+    _sub(clock, "timer", name="hypervclock", present="yes")
+
+    _sub(root, "on_poweroff", "destroy")
+    _sub(root, "on_reboot", "restart")
+    _sub(root, "on_crash", "destroy")
+    pm = _sub(root, "pm")
+    _sub(pm, "suspend-to-mem", enabled="no")
+    _sub(pm, "suspend-to-disk", enabled="no")
+
+    devices = _sub(root, "devices")
+    boot = 1
+    if config.iso_file:
+        _add_disk(devices, config.iso_file, "sda", "sata", device="cdrom", boot=boot, readonly=True)
+        boot += 1
+    main_target = "vda" if config.disk_bus == "virtio" else "sdb"
+    if config.block_device:
+        devices.append(block_disk_element(config.block_device, main_target, config.disk_bus, boot=boot))
+    else:
+        _add_disk(devices, config.main_disk_path(), main_target, config.disk_bus, boot=boot)
+    if config.unattend_iso:
+        _add_disk(devices, config.unattend_iso, "sdc", "sata", device="cdrom", readonly=True)
+
+    _sub(devices, "controller", type="usb", index="0", model="qemu-xhci", ports="15")
+    interface = _sub(devices, "interface", type="network")
+    _sub(interface, "source", network=config.network)
+    #Windows has no virtio-net driver until virtio-win is installed
+    _sub(interface, "model", type="e1000e")
+    _sub(devices, "input", type="tablet", bus="usb")
+    _add_graphics(devices, config)
+    if config.tpm:
+        tpm = _sub(devices, "tpm", model="tpm-tis")
+        _sub(tpm, "backend", type="emulator", version="2.0")
+    for pci_id in config.hostdevs:
+        devices.append(pci_hostdev_element(pci_id))
+    _sub(devices, "memballoon", model="none" if config.hugepage_size else "virtio")
+
+    if config.pin_plan:
+        apply_cputune(root, config.pin_plan)
+    if config.hugepage_size:
+        apply_memory_backing(root, config.hugepage_size)
+    if config.storage_profile:
+        apply_storage_profile(root, config.storage_profile)
+    if config.latency_profile:
+        apply_latency_profile(root, read_cpu_flags(), hide_kvm=config.hide_kvm)
+    if config.numa_node is not None:
+        node = next((n for n in read_numa_nodes() if n.id == config.numa_node), None)
+        apply_numa_placement(root, config.numa_node, node.cpus if node else None)
+    return root
+
+def build_domain_xml(config):
+    root = build_domain_tree(config)
+    ET.indent(root)
+    return ET.tostring(root, encoding="unicode")
+
+def images_pool(conn, path=IMAGES_PATH):
+    """Find the storage pool backing path, defining a dir pool for it if there is none"""
+    for pool in conn.listAllStoragePools():
+        target = ET.fromstring(pool.XMLDesc(0)).find("target/path")
+        if target is not None and os.path.realpath(target.text) == os.path.realpath(path):
+            if not pool.isActive():
+                pool.create()
+            return pool
+
+    pool_xml = f"<pool type='dir'><name>{os.path.basename(path.rstrip('/')) or 'images'}</name>" \
+               f"<target><path>{path}</path></target></pool>"
+    pool = conn.storagePoolDefineXML(pool_xml, 0)
+    pool.build(0)
+    pool.create()
+    pool.setAutostart(1)
+    return pool
+
+def create_disk(conn, path, capacity_gb, allocation=None):
+    """Create the VM disk in its storage pool with the allocation options. Returns the volume path"""
+    pool = images_pool(conn, os.path.dirname(path))
+    name = os.path.basename(path)
+    pool.refresh(0)
+    if name in pool.listVolumes():
+        raise libvirt.libvirtError(f"Storage volume {path} already exists")
+    xml, metadata = volume_xml(name, capacity_gb, allocation)
+    volume = pool.createXML(xml, libvirt.VIR_STORAGE_VOL_CREATE_PREALLOC_METADATA if metadata else 0)
+    return volume.path()
+
+def define_vm(config, conn=None, uri=DEFAULT_URI):
+    """Create the disk and define the domain for a VmConfig. Returns the libvirt domain"""
+    with connection(conn, uri) as conn:
+        created = False
+        if config.disk_backend:
+            if not config.block_device:
+                config.block_device = prepare_backend(config.disk_backend, config.name, config.disk_size_gb, conn)
+                created = config.disk_backend.kind in ("lvm", "zvol")
+        else:
+            create_disk(conn, config.main_disk_path(), config.disk_size_gb, config.disk_allocation)
+        try:
+            return conn.defineXML(build_domain_xml(config))
+        except Exception:
+            #Otherwise the next run of the same spec stops at "already exists"
+            if created:
+                print(f"Removing {config.block_device}, the VM wasn't defined")
+                try:
+                    remove_backend(config.disk_backend, config.name)
+                    config.block_device = None
+                except (OSError, subprocess.CalledProcessError) as e:
+                    print(f"🚨 Error 🚨 removing {config.block_device}: {e}")
+            raise
@@ -0,0 +1,68 @@
+import difflib
+import xml.etree.ElementTree as ET
+import libvirt
+from libvirtOps import connection, DEFAULT_URI
+
+RED = '\033[91m'
+GREEN = '\033[92m'
+RESET = '\033[0m'
+
+def _pretty(xml):
+    """Re-serialize XML with stable indentation so diffs only show real changes"""
+    root = ET.fromstring(xml) if isinstance(xml, str) else xml
+    root = ET.fromstring(ET.tostring(root))
+    ET.indent(root)
+    return ET.tostring(root, encoding="unicode")
+
+def xml_diff(before, after, name="domain"):
+    """Unified diff between two domain XML documents (strings or trees)"""
+    return "".join(difflib.unified_diff(
+        _pretty(before).splitlines(keepends=True),
+        _pretty(after).splitlines(keepends=True),
+        fromfile=f"{name}.xml (before)",
+        tofile=f"{name}.xml (after)",
+    ))
+
+def print_diff(diff):
+    for line in diff.splitlines():
+        if line.startswith("+") and not line.startswith("+++"):
+            print(f"{GREEN}{line}{RESET}")
+        elif line.startswith("-") and not line.startswith("---"):
+            print(f"{RED}{line}{RESET}")
+        else:
+            print(line)
+
+def run_transforms(root, transforms):
+    """Apply each transform (a callable taking the domain tree) in order"""
+    for transform in transforms:
+        transform(root)
+    return root
+
+def apply_transforms(vm_name, transforms, conn=None, uri=DEFAULT_URI, dry_run=False, show_diff=False):
+    """
+    Run several transforms against one fetched domain XML and commit the
+    result with a single defineXML. Nothing is defined if a transform raises
+
+    Args:
+        vm_name: Name of the libvirt domain
+        transforms: Callables that modify the parsed <domain> tree in place
+        conn: Optional open libvirt connection (e.g. to test:///default)
+        uri: Connection URI used when conn is not given
+        dry_run: Only compute the diff, don't redefine the domain
+        show_diff: Print the unified diff
+
+    Returns:
+        The unified diff of the XML before and after ('' when unchanged)
+    """
+    with connection(conn, uri) as conn:
+        dom = conn.lookupByName(vm_name)
+        before = dom.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE)
+        root = run_transforms(ET.fromstring(before), transforms)
+        after = ET.tostring(root, encoding="unicode")
+
+        diff = xml_diff(before, after, vm_name)
+        if show_diff and diff:
+            print_diff(diff)
+        if diff and not dry_run:
+            conn.defineXML(after)
+        return diff
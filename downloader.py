@@ -0,0 +1,256 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import urllib.request
+
+GREEN = '\033[92m'
+YELLOW = '\033[93m'
+RESET = '\033[0m'
+
+CHUNK_SIZE = 1024 * 1024
+#Segments smaller than this aren't worth their own connection
+MIN_SEGMENT_SIZE = 8 * 1024 * 1024
+RETRIES = 4
+TIMEOUT = 30
+
+class DownloadError(Exception):
+    pass
+
+def _part_path(dest):
+    return dest + ".part"
+
+def _state_path(dest):
+    return dest + ".part.json"
+
+def probe_url(url, timeout=TIMEOUT):
+    """
+    Ask the server for the size and validators of url with a one byte Range request
+
+    Returns:
+        (size or None, supports ranges, etag or last-modified)
+    """
+    request = urllib.request.Request(url, headers={"Range": "bytes=0-0"})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        validator = response.headers.get("ETag") or response.headers.get("Last-Modified")
+        if response.status == 206:
+            #Content-Range: bytes 0-0/734525440
+            total = response.headers.get("Content-Range", "").rpartition("/")[2]
+            return (int(total) if total.isdigit() else None), True, validator
+        length = response.headers.get("Content-Length")
+        return (int(length) if length else None), False, validator
+
+def plan_segments(size, connections):
+    """Split [0, size) into at most connections [start, end, done] segments (end exclusive)"""
+    count = max(1, min(connections, size // MIN_SEGMENT_SIZE))
+    step = -(-size // count)
+    return [[start, min(start + step, size), 0] for start in range(0, size, step)]
+
+class SegmentedDownload:
+    """
+    One download split into byte ranges fetched by parallel threads and
+    written with pwrite into a preallocated .part file. Segment progress is
+    saved next to it so a later run resumes instead of starting over
+    """
+    def __init__(self, url, dest, connections=4, expected_sha256=None, quiet=False):
+        self.url = url
+        self.dest = dest
+        self.connections = connections
+        self.expected_sha256 = expected_sha256.lower() if expected_sha256 else None
+        self.quiet = quiet
+        self.lock = threading.Lock()
+        self.segments = []
+        self.size = None
+        self.validator = None
+        self.errors = []
+        self.fetched = 0
+        self.hashed = 0
+        self.sha256 = hashlib.sha256()
+
+    def _load_state(self):
+        try:
+            with open(_state_path(self.dest)) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if (state.get("url") != self.url or state.get("size") != self.size
+                or state.get("validator") != self.validator or not os.path.exists(_part_path(self.dest))):
+            return False
+        self.segments = state["segments"]
+        return True
+
+    def _save_state(self):
+        with self.lock:
+            state = {"url": self.url, "size": self.size, "validator": self.validator,
+                     "segments": [list(segment) for segment in self.segments]}
+        tmp = _state_path(self.dest) + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, _state_path(self.dest))
+
+    def _preallocate(self, fd):
+        try:
+            os.posix_fallocate(fd, 0, self.size)
+        except (AttributeError, OSError):
+            #Filesystems without fallocate (and non-Linux hosts) get a sparse file
+            os.ftruncate(fd, self.size)
+
+    def _fetch_segment(self, fd, segment):
+        start, end = segment[0], segment[1]
+        error = None
+        for attempt in range(RETRIES):
+            if start + segment[2] >= end:
+                return
+            if attempt:
+                time.sleep(2 ** (attempt - 1))
+            request = urllib.request.Request(self.url, headers={"Range": f"bytes={start + segment[2]}-{end - 1}"})
+            try:
+                with urllib.request.urlopen(request, timeout=TIMEOUT) as response:
+                    if response.status != 206:
+                        raise DownloadError(f"server ignored the Range request (HTTP {response.status})")
+                    while start + segment[2] < end:
+                        chunk = response.read(min(CHUNK_SIZE, end - start - segment[2]))
+                        if not chunk:
+                            break
+                        os.pwrite(fd, chunk, start + segment[2])
+                        with self.lock:
+                            segment[2] += len(chunk)
+                            self.fetched += len(chunk)
+                if start + segment[2] < end:
+                    error = f"connection closed after {start + segment[2]} of bytes {start}-{end - 1}"
+            #Anything escaping here would end the thread without the segment being counted as failed
+            except Exception as e:
+                error = e
+        if start + segment[2] < end:
+            with self.lock:
+                self.errors.append(f"bytes {start}-{end - 1}: {error}")
+
+    def _contiguous(self):
+        """End of the fully downloaded prefix of the file"""
+        with self.lock:
+            for start, end, done in self.segments:
+                if start + done < end:
+                    return start + done
+        return self.size
+
+    def _hash_up_to(self, fd, offset):
+        """Feed the newly completed prefix to SHA-256 while it is still in the page cache"""
+        while self.hashed < offset:
+            chunk = os.pread(fd, min(CHUNK_SIZE * 4, offset - self.hashed), self.hashed)
+            if not chunk:
+                break
+            self.sha256.update(chunk)
+            self.hashed += len(chunk)
+
+    def _report(self, started, resumed_bytes):
+        if self.quiet:
+            return
+        done = resumed_bytes + self.fetched
+        elapsed = max(time.monotonic() - started, 1e-6)
+        rate = self.fetched / elapsed
+        eta = (self.size - done) / rate if rate else 0
+        print(f"\r  {done / self.size:6.1%}  {done / 1024**2:8.1f}/{self.size / 1024**2:.1f} MiB  "
+              f"{rate / 1024**2:6.1f} MiB/s  ETA {eta:4.0f}s", end="", flush=True)
+
+    def run(self):
+        """Download (or resume) to self.dest. Returns the SHA-256 hex digest"""
+        self.size, ranged, self.validator = probe_url(self.url)
+        if not ranged or not self.size:
+            return self._run_single()
+
+        if self._load_state():
+            resumed = sum(done for _, _, done in self.segments)
+            if not self.quiet:
+                print(f"Resuming download at {resumed / 1024**2:.1f} MiB")
+        else:
+            self.segments = plan_segments(self.size, self.connections)
+            resumed = 0
+
+        fd = os.open(_part_path(self.dest), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if not resumed:
+                self._preallocate(fd)
+            self._save_state()
+
+            threads = [threading.Thread(target=self._fetch_segment, args=(fd, segment), daemon=True)
+                       for segment in self.segments if segment[0] + segment[2] < segment[1]]
+            for thread in threads:
+                thread.start()
+
+            started = last_save = time.monotonic()
+            try:
+                while any(thread.is_alive() for thread in threads):
+                    time.sleep(0.5)
+                    self._hash_up_to(fd, self._contiguous())
+                    self._report(started, resumed)
+                    if time.monotonic() - last_save > 1:
+                        self._save_state()
+                        last_save = time.monotonic()
+            finally:
+                #Also on Ctrl+C, so the next run resumes from here
+                self._save_state()
+            self._report(started, resumed)
+            if not self.quiet:
+                print()
+
+            if self.errors:
+                raise DownloadError(f"{len(self.errors)} segment(s) failed, rerun to resume: {self.errors[0]}")
+            missing = [f"{start + done}-{end - 1}" for start, end, done in self.segments if start + done < end]
+            if missing:
+                raise DownloadError(f"bytes {', '.join(missing)} were never downloaded, rerun to resume")
+            self._hash_up_to(fd, self.size)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        if not self.quiet:
+            elapsed = max(time.monotonic() - started, 1e-6)
+            print(f"Downloaded {self.fetched / 1024**2:.1f} MiB in {elapsed:.1f}s "
+                  f"({self.fetched / 1024**2 / elapsed:.1f} MiB/s, {len(threads)} connection(s))")
+        return self._finish()
+
+    def _run_single(self):
+        """Plain streaming download for servers without Range support"""
+        started = last_report = time.monotonic()
+        with urllib.request.urlopen(self.url, timeout=TIMEOUT) as response, \
+                open(_part_path(self.dest), "wb") as f:
+            while True:
+                chunk = response.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                f.write(chunk)
+                self.sha256.update(chunk)
+                self.fetched += len(chunk)
+                if self.size and time.monotonic() - last_report > 0.5:
+                    self._report(started, 0)
+                    last_report = time.monotonic()
+        if self.size and self.fetched < self.size:
+            raise DownloadError(f"connection closed after {self.fetched} of {self.size} bytes")
+        if not self.quiet:
+            elapsed = max(time.monotonic() - started, 1e-6)
+            print(f"\nDownloaded {self.fetched / 1024**2:.1f} MiB in {elapsed:.1f}s "
+                  f"({self.fetched / 1024**2 / elapsed:.1f} MiB/s, server doesn't support ranges)")
+        return self._finish()
+
+    def _finish(self):
+        digest = self.sha256.hexdigest()
+        if self.expected_sha256 and digest != self.expected_sha256:
+            for path in (_part_path(self.dest), _state_path(self.dest)):
+                if os.path.exists(path):
+                    os.remove(path)
+            raise DownloadError(f"SHA-256 mismatch: expected {self.expected_sha256}, got {digest}")
+        os.replace(_part_path(self.dest), self.dest)
+        if os.path.exists(_state_path(self.dest)):
+            os.remove(_state_path(self.dest))
+        return digest
+
+def download(url, dest, connections=4, expected_sha256=None, quiet=False):
+    """
+    Fetch url to dest over several Range connections, resuming an earlier
+    interrupted run, and verify its SHA-256 on the fly
+
+    Returns:
+        SHA-256 hex digest of the file
+    """
+    return SegmentedDownload(url, dest, connections, expected_sha256, quiet).run()
@@ -0,0 +1,200 @@
+import os
+import re
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass
+
+BLUE = '\033[94m'
+RED = '\033[91m'
+YELLOW = '\033[93m'
+RESET = '\033[0m'
+
+INPUT_BY_ID = "dev/input/by-id"
+INPUT_CLASS = "sys/class/input"
+#Keys QEMU accepts for grabToggle, pressed together they move keyboard and mouse between host and guest
+GRAB_TOGGLES = ("ctrl-ctrl", "alt-alt", "shift-shift", "meta-meta", "scrolllock", "ctrl-scrolllock")
+DEFAULT_GRAB_TOGGLE = "ctrl-ctrl"
+
+@dataclass
+class InputDevice:
+    """A keyboard or mouse event node from /dev/input/by-id"""
+    name: str
+    path: str
+    kind: str
+
+    @property
+    def secondary(self):
+        """Extra interfaces (-if01-event-kbd) of gaming mice/keyboards, they carry macro keys or media keys"""
+        return re.search(r"-if\d+-event-", self.name) is not None
+
+def _kind(name):
+    if name.endswith("-event-kbd"):
+        return "keyboard"
+    if name.endswith("-event-mouse"):
+        return "mouse"
+    return None
+
+def input_pci_functions(name, root="/"):
+    """
+    PCI functions (BDFs) on the sysfs path of a by-id event node, e.g. the
+    USB controller a keyboard is plugged into
+    """
+    event = os.path.basename(os.path.realpath(os.path.join(root, INPUT_BY_ID, name)))
+    path = os.path.realpath(os.path.join(root, INPUT_CLASS, event))
+    return [part for part in path.split(os.sep) if re.fullmatch(r"[0-9a-f]{4}:[0-9a-f]{2}:[0-9a-f]{2}\.[0-7]", part)]
+
+def _behind(device, pci_functions, root="/"):
+    """The passed through PCI function device hangs off, None if it is on the host's own"""
+    return next((bdf for bdf in input_pci_functions(device.name, root) if bdf in pci_functions), None)
+
+def list_input_devices(root="/", exclude_pci=()):
+    """
+    Keyboards and mice the host has, by their stable by-id names
+
+    Args:
+        exclude_pci: BDFs of USB controllers given to the VM, their devices
+            vanish from the host once the controller is bound to vfio-pci
+
+    Returns:
+        List of InputDevice, keyboards first
+    """
+    directory = os.path.join(root, INPUT_BY_ID)
+    try:
+        entries = os.listdir(directory)
+    except OSError:
+        return []
+    devices = []
+    for entry in entries:
+        kind = _kind(entry)
+        #A stale link left by an unplugged device can't be opened by QEMU
+        if kind and os.path.exists(os.path.join(directory, entry)):
+            devices.append(InputDevice(entry, os.path.join("/", INPUT_BY_ID, entry), kind))
+    if exclude_pci:
+        devices = [device for device in devices if not _behind(device, exclude_pci, root)]
+    return sorted(devices, key=lambda device: (device.kind != "keyboard", device.secondary, device.name))
+
+def resolve_input_devices(names, root="/", exclude_pci=()):
+    """
+    InputDevices for by-id names or paths (from a spec file). Unknown ones and
+    ones on a passed through USB controller (exclude_pci) raise ValueError
+    """
+    available = {device.name: device for device in list_input_devices(root)}
+    devices = []
+    for name in names:
+        device = available.get(os.path.basename(name))
+        if device is None:
+            raise ValueError(f"No keyboard or mouse named {name} in /{INPUT_BY_ID}")
+        controller = _behind(device, exclude_pci, root)
+        if controller:
+            raise ValueError(f"{name} is plugged into USB controller {controller}, which goes to the VM as a whole")
+        devices.append(device)
+    return devices
+
+def without_passed_through(devices, exclude_pci, root="/"):
+    """devices minus the ones on a passed through USB controller, which are reported"""
+    kept = []
+    for device in devices:
+        controller = _behind(device, exclude_pci, root)
+        if controller:
+            print(f"⚠️  Note ⚠️ : {device.name} is on USB controller {controller} and goes to the VM with it, "
+                  "not through evdev")
+        else:
+            kept.append(device)
+    return kept
+
+def evdev_input_element(device, grab_toggle=None):
+    """
+    <input type='evdev'>. With grab_toggle the keyboard grabs every evdev
+    device of the VM (grab='all') so one toggle switches them all together
+    """
+    input_elem = ET.Element("input", {"type": "evdev"})
+    attrs = {"dev": device.path}
+    if grab_toggle and device.kind == "keyboard":
+        attrs.update({"grab": "all", "grabToggle": grab_toggle, "repeat": "on"})
+    ET.SubElement(input_elem, "source", attrs)
+    return input_elem
+
+def evdev_transform(root, devices, grab_toggle=DEFAULT_GRAB_TOGGLE):
+    """
+    Replace the domain tree's evdev inputs with devices and add the virtio
+    keyboard and mouse the guest receives their events on
+
+    Returns:
+        List of the device paths added
+    """
+    devices_elem = root.find("devices")
+    for old in devices_elem.findall("input[@type='evdev']"):
+        devices_elem.remove(old)
+
+    #Inputs go before the graphics/video devices in libvirt's own ordering
+    index = len(devices_elem)
+    for position, child in enumerate(devices_elem):
+        if child.tag in ("input", "graphics", "video"):
+            index = position
+            break
+    added = []
+    #QEMU lets a single device own the toggle
+    owner = next((device for device in devices if device.kind == "keyboard"), None)
+    for device in devices:
+        devices_elem.insert(index, evdev_input_element(device, grab_toggle if device is owner else None))
+        index += 1
+        added.append(device.path)
+
+    for kind in ("keyboard", "mouse"):
+        if devices_elem.find(f"input[@type='{kind}'][@bus='virtio']") is None:
+            devices_elem.insert(index, ET.Element("input", {"type": kind, "bus": "virtio"}))
+            index += 1
+    return added
+
+def prompt_input_devices(root="/", exclude_pci=()):
+    """
+    Let the user pick the keyboards and mice to hand to the VM. Devices on
+    the USB controllers in exclude_pci aren't offered, the VM gets them anyway
+
+    Returns:
+        (list of InputDevice, grab toggle). An empty list when there are none
+    """
+    devices = list_input_devices(root, exclude_pci)
+    if not devices:
+        print(f"No keyboards or mice found in /{INPUT_BY_ID}")
+        return [], DEFAULT_GRAB_TOGGLE
+
+    defaults = [number for number, device in enumerate(devices, 1) if not device.secondary]
+    for number, device in enumerate(devices, 1):
+        print(f"  {BLUE}{number}{RESET}) {device.kind:<8} {device.name}")
+    while True:
+        answer = input(f"Devices to pass through, e.g. 1,3 (Default {YELLOW}"
+                       f"{','.join(map(str, defaults))}{RESET}, 'none' to skip): ").strip().lower()
+        if answer == "none":
+            return [], DEFAULT_GRAB_TOGGLE
+        numbers = defaults if not answer else [part.strip() for part in answer.split(",")]
+        if all(str(number).isdigit() and 1 <= int(number) <= len(devices) for number in numbers):
+            break
+        print("Invalid input!")
+    chosen = [devices[int(number) - 1] for number in dict.fromkeys(numbers)]
+
+    grab_toggle = input(f"Keys that switch input between host and guest {'/'.join(GRAB_TOGGLES)} "
+                        f"(Default {YELLOW}{DEFAULT_GRAB_TOGGLE}{RESET}): ").strip().lower() or DEFAULT_GRAB_TOGGLE
+    if grab_toggle not in GRAB_TOGGLES:
+        print(f"Unknown toggle '{grab_toggle}', using {DEFAULT_GRAB_TOGGLE}")
+        grab_toggle = DEFAULT_GRAB_TOGGLE
+    return chosen, grab_toggle
+
+def setup_evdev_input(vm_name, devices, grab_toggle=DEFAULT_GRAB_TOGGLE):
+    """Redefine the VM with evdev passthrough for devices"""
+    #Only needed here, listing and resolving devices works without libvirt-python
+    import libvirt
+    from domainXml import apply_transforms, print_diff
+
+    try:
+        diff = apply_transforms(vm_name, [lambda root: evdev_transform(root, devices, grab_toggle)])
+    except libvirt.libvirtError as e:
+        print(f"🚨 Failed to add the input devices to {vm_name} 🚨: {RED}{e}{RESET}")
+        return False
+    if diff:
+        print_diff(diff)
+    keyboard = any(device.kind == "keyboard" for device in devices)
+    print(f"Passed {len(devices)} input device(s) to '{vm_name}' ✅ The VirtIO input driver (vioinput) "
+          "comes with the virtio-win drivers")
+    if keyboard:
+        print(f"Press {YELLOW}{grab_toggle}{RESET} to switch the keyboard and mouse between host and guest")
+    return True
@@ -1,14 +1,20 @@
-import subprocess
 from tkinter import Tk, filedialog
 import sys
-import urllib.request
+import urllib.error
 import string
 import os
 import stat
+from libvirtOps import attach_disk, list_block_devices
+from storageTuning import create_image, DiskAllocation
+from downloader import DownloadError
+from isoCache import IsoCache, pick_cached_iso
+from isoInspector import check_windows_iso, check_virtio_iso
 
 RED = '\033[91m'   
 RESET = '\033[0m'
 
+VIRTIO_ISO_URL = "https://fedorapeople.org/groups/virt/virtio-win/direct-downloads/stable-virtio/virtio-win.iso"
+
 def ensure_libvirt_access(path):
     """
     Ensure that 'libvirt-qemu' user can access the ISO file by setting
@@ -30,67 +36,82 @@ def ensure_libvirt_access(path):
             #Permissions are already ok for this directory, moving up
             pass
 
-def virtioDrivers(vm_name):
-    have_iso = input("Do you have the VirtIO Drivers ISO file? (Y/n): ").strip().lower()
+def make_iso_readable(iso_file):
+    """Let the qemu user reach and read an ISO selected from anywhere on the host"""
+    ensure_libvirt_access(iso_file)
+
+    try:
+        current_permissions = os.stat(iso_file).st_mode
+        os.chmod(iso_file, current_permissions | stat.S_IROTH)
+        print(f"Permissions for {iso_file} updated to be world-readable")
+    except Exception as e:
+        print(f"Failed to change permissions on ISO: {RED}{e}{RESET}")
+
+def virtioDrivers(vm_name, virtio_iso=None, unattended=False):
+    """
+    Attach the helper virtio disk and the VirtIO driver ISO. With virtio_iso
+    given (spec files) nothing is asked and the install confirmation is skipped
+    """
+    cache = IsoCache()
+    virtio_driver_file = virtio_iso or pick_cached_iso("virtio", cache)
+    have_iso = "y" if virtio_driver_file else input("Do you have the VirtIO Drivers ISO file? (Y/n): ").strip().lower()
 
     if have_iso not in ("yes", "y", ""):
         #Download driver for the user
-        download = input("Would you like to download the VirtIO ISO automatically (Y/n)?").strip().lower()
-        if download in ("yes", "y", ""):
-            download_url = "https://fedorapeople.org/groups/virt/virtio-win/direct-downloads/stable-virtio/virtio-win.iso"
-            download_path = f"/var/lib/libvirt/images/virtio-win.iso"
-            print(f"Downloading VirtIO ISO to {download_path}...")
+        want_download = input("Would you like to download the VirtIO ISO automatically (Y/n)?").strip().lower()
+        if want_download in ("yes", "y", ""):
+            print(f"Downloading VirtIO ISO into {cache.directory}...")
 
             try:
-                urllib.request.urlretrieve(download_url, download_path)
+                virtio_driver_file = cache.fetch(VIRTIO_ISO_URL, kind="virtio")
                 print("Download complete")
-                virtio_driver_file = download_path
-            except Exception as e:
+            except (DownloadError, OSError, urllib.error.URLError) as e:
+                #The partial file and its segment state are kept, the next run resumes
                 print(f"Download failed: {RED}{e}{RESET}")
-                sys.exit(1)
+                print("Rerun this step to resume the download, or select an ISO you already have")
         #User downloads driver themselves
         else:
             print("Please download the VirtIO Drivers manually from here:")
             print("https://fedorapeople.org/groups/virt/virtio-win/direct-downloads/stable-virtio/")
 
+    #VirtIO Driver ISO, checked before anything is attached
+    while not virtio_driver_file:
+        print("Please select the VirtIO driver ISO file... 📂")
+        root = Tk()
+        root.withdraw()
+        virtio_driver_file = filedialog.askopenfilename(
+            title="Select VirtIO Driver ISO",
+            filetypes=[("ISO files", "*.iso")]
+        )
+        if not virtio_driver_file:
+            print("🚨 No file selected. Exiting 🚨")
+            sys.exit(1)
+        error = check_virtio_iso(virtio_driver_file)[1]
+        if error:
+            print(f"🚨 {error} 🚨")
+            virtio_driver_file = None
+
+    virtio, error = check_virtio_iso(virtio_driver_file)
+    if error:
+        print(f"🚨 {error}. Exiting 🚨")
+        sys.exit(1)
+    print(f"VirtIO drivers: virtio-win {virtio.version or '(unknown version)'}")
+    make_iso_readable(virtio_driver_file)
+    virtio_driver_file = cache.add_file(virtio_driver_file, kind="virtio",
+                                        version=f"virtio-win {virtio.version}" if virtio.version else None)
+    cache.use(virtio_driver_file, vm_name)
+
     #First VirtIO disk
     print("Adding VirtIO storage device (0.1GB)...")
     first_disk_path = f"/var/lib/libvirt/images/{vm_name}_virtio1.qcow2"
 
-    subprocess.run([
-        "qemu-img", "create", "-f", "qcow2", first_disk_path, "0.1G"
-    ], check=True)
-
-    subprocess.run([
-        "virsh", "attach-disk", vm_name,
-        first_disk_path,
-        "vdb",
-        "--targetbus", "virtio",
-        "--type", "disk",
-        "--persistent"
-    ], check=True)
-    print("VirtIO storage device added")
+    create_image(first_disk_path, "100M", DiskAllocation(preallocation="off"))
 
-    #Second VirtIO Driver ISO
-    print("Please select the VirtIO driver ISO file... 📂")
-    root = Tk()
-    root.withdraw()
-    virtio_driver_file = filedialog.askopenfilename(
-        title="Select VirtIO Driver ISO",
-        filetypes=[("ISO files", "*.iso")]
-    )
-
-    if not virtio_driver_file:
-        print("🚨 No file selected. Exiting 🚨")
-        sys.exit(1)
+    attach_disk(vm_name, first_disk_path, "vdb", bus="virtio", device="disk")
+    print("VirtIO storage device added")
 
     #Find available SATA target
-    result = subprocess.run(["virsh", "domblklist", vm_name],
-                            capture_output=True, text=True, check=True)
-    used_targets = {
-        line.split()[0] for line in result.stdout.splitlines()
-        if line and not line.startswith("Target")
-    }
+    used_targets = {target for target, _ in list_block_devices(vm_name)}
 
     all_possible = [f"sd{letter}" for letter in string.ascii_lowercase[2:]]
     available_target = next((dev for dev in all_possible if dev not in used_targets), None)
@@ -100,18 +121,14 @@ def virtioDrivers(vm_name):
         sys.exit(1)
 
     print(f"Attaching VirtIO driver ISO as CD-ROM to {available_target}...")
-    subprocess.run([
-        "virsh", "attach-disk", vm_name,
-        virtio_driver_file,
-        available_target,
-        "--targetbus", "sata",
-        "--type", "cdrom",
-        "--mode", "readonly",
-        "--persistent"
-    ], check=True)
+    attach_disk(vm_name, virtio_driver_file, available_target, bus="sata", device="cdrom", readonly=True)
 
     print("VirtIO driver CDROM added successfully ✅")
 
+    #The answer file installs virtio-win-gt-x64.msi at first logon
+    if virtio_iso or unattended:
+        return
+
     while True:
         print("================================================================================")
         print("Install the VirtIO drivers in the Windows VM. This is found in the CD drive " \
@@ -130,6 +147,11 @@ def virtioDrivers(vm_name):
 
 
 def get_windows_iso():
+    cached = pick_cached_iso("windows")
+    if cached:
+        print(f"Selected ISO file: {cached}")
+        return cached
+
     have_iso = input("Do you have the Windows ISO downloaded (Y/n)?: ").strip().lower()
     
     if have_iso not in ("yes", "y", ""):
@@ -137,27 +159,28 @@ def get_windows_iso():
         print("https://www.microsoft.com/en-us/software-download/windows11")
         sys.exit("Exiting the script...")
 
-    print("Please select the Windows ISO file... 📂")
-
-    root = Tk()
-    root.withdraw()
-    iso_file = filedialog.askopenfilename(
-        title="Select Windows ISO",
-        filetypes=[("ISO files", "*.iso")]
-    )
-
-    if not iso_file:
-        print("No file selected. Exiting")
-        sys.exit(1)
-        
-    ensure_libvirt_access(iso_file)
+    while True:
+        print("Please select the Windows ISO file... 📂")
+
+        root = Tk()
+        root.withdraw()
+        iso_file = filedialog.askopenfilename(
+            title="Select Windows ISO",
+            filetypes=[("ISO files", "*.iso")]
+        )
+
+        if not iso_file:
+            print("No file selected. Exiting")
+            sys.exit(1)
+
+        #Catch a wrong file now rather than an hour into the install
+        windows, error = check_windows_iso(iso_file)
+        if not error:
+            break
+        print(f"🚨 {error} 🚨")
         
-    try:
-        current_permissions = os.stat(iso_file).st_mode
-        os.chmod(iso_file, current_permissions | stat.S_IROTH)
-        print(f"Permissions for {iso_file} updated to be world-readable")
-    except Exception as e:
-        print(f"Failed to change permissions on ISO: {RED}{e}{RESET}")
+    make_iso_readable(iso_file)
+    iso_file = IsoCache().add_file(iso_file, kind="windows", version=f"Windows build {windows.build}")
 
     print(f"Selected ISO file: {iso_file}")
     return iso_file
\ No newline at end of file
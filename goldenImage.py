@@ -0,0 +1,302 @@
+import json
+import os
+import shutil
+import subprocess
+import time
+import xml.etree.ElementTree as ET
+import libvirt
+
+from hostProbe import IMAGES_PATH
+from libvirtOps import connection, DEFAULT_URI
+from qcow2 import read_header, create_overlay, set_backing_file, backing_chain, Qcow2Error
+from storageTuning import DiskAllocation, cluster_bits
+
+BLUE = '\033[94m'
+GREEN = '\033[92m'
+RED = '\033[91m'
+YELLOW = '\033[93m'
+RESET = '\033[0m'
+
+GOLDEN_DIR = os.path.join(IMAGES_PATH, "golden")
+HOOKS_DIR = "/etc/libvirt/hooks/qemu.d"
+SYSPREP_COMMAND = r"C:\Windows\System32\Sysprep\sysprep.exe /generalize /oobe /shutdown"
+
+def _main_disk(root):
+    """(disk element, path) of the VM's first file-backed disk"""
+    for disk in root.findall("./devices/disk[@device='disk']"):
+        source = disk.find("source")
+        if source is not None and source.get("file"):
+            return disk, source.get("file")
+    return None, None
+
+def _new_overlay(path, image):
+    """Overlays only ever hold their differences, subclusters keep those small"""
+    allocation = DiskAllocation()
+    create_overlay(path, image, cluster_bits=cluster_bits(allocation.cluster_size),
+                   extended_l2=allocation.extended_l2, lazy_refcounts=allocation.lazy_refcounts)
+
+def _inactive_domain(conn, vm_name):
+    dom = conn.lookupByName(vm_name)
+    if dom.isActive():
+        raise ValueError(f"'{vm_name}' is running, shut it down first")
+    return dom, ET.fromstring(dom.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE))
+
+def template_paths(name, directory=GOLDEN_DIR):
+    """(golden image, domain XML, metadata) paths of a template"""
+    base = os.path.join(directory, name)
+    return f"{base}.qcow2", f"{base}.xml", f"{base}.json"
+
+def list_templates(directory=GOLDEN_DIR):
+    """[(name, metadata)] of the sealed templates, oldest first"""
+    if not os.path.isdir(directory):
+        return []
+    templates = []
+    for entry in sorted(os.listdir(directory)):
+        name, ext = os.path.splitext(entry)
+        if ext != ".json":
+            continue
+        image, xml_path, meta_path = template_paths(name, directory)
+        if not (os.path.exists(image) and os.path.exists(xml_path)):
+            continue
+        with open(meta_path) as f:
+            templates.append((name, json.load(f)))
+    return sorted(templates, key=lambda item: item[1].get("created", 0))
+
+def _strip_identity(root):
+    """Drop what has to be unique per VM: UUID, MAC addresses and the UEFI variable store"""
+    for uuid in root.findall("uuid"):
+        root.remove(uuid)
+    for interface in root.findall("./devices/interface"):
+        for mac in interface.findall("mac"):
+            interface.remove(mac)
+    os_elem = root.find("os")
+    if os_elem is not None:
+        for nvram in os_elem.findall("nvram"):
+            os_elem.remove(nvram)
+
+def seal_vm(vm_name, template_name, directory=GOLDEN_DIR, conn=None, uri=DEFAULT_URI):
+    """
+    Turn a shut off, generalized VM into a template: its disk becomes the
+    read-only golden image and the VM itself keeps running from an overlay
+    on top of it
+
+    Returns:
+        Path of the golden image
+    """
+    image, xml_path, meta_path = template_paths(template_name, directory)
+    if os.path.exists(image) or os.path.exists(xml_path):
+        raise ValueError(f"Template '{template_name}' already exists")
+
+    with connection(conn, uri) as conn:
+        _, root = _inactive_domain(conn, vm_name)
+        _, disk_path = _main_disk(root)
+        if disk_path is None:
+            raise ValueError(f"'{vm_name}' has no file-backed disk")
+        header = read_header(disk_path)
+        if header["backing_file"]:
+            raise ValueError(f"{disk_path} is already an overlay of {header['backing_file']}, flatten it first")
+
+        os.makedirs(directory, exist_ok=True)
+        if os.stat(disk_path).st_dev != os.stat(directory).st_dev:
+            raise ValueError(f"{directory} must be on the same filesystem as {disk_path}")
+        os.rename(disk_path, image)
+        try:
+            _new_overlay(disk_path, image)
+        except (OSError, Qcow2Error):
+            os.rename(image, disk_path)
+            raise
+        os.chmod(image, 0o444)
+        os.chmod(disk_path, 0o600)
+
+    _strip_identity(root)
+    ET.indent(root)
+    with open(xml_path, "w") as f:
+        f.write(ET.tostring(root, encoding="unicode"))
+    with open(meta_path, "w") as f:
+        json.dump({"source_vm": vm_name, "created": time.time(), "virtual_size": header["size"],
+                   "image_bytes": os.path.getsize(image)}, f, indent=2)
+    return image
+
+def clone_vm(template_name, vm_name, directory=GOLDEN_DIR, conn=None, uri=DEFAULT_URI):
+    """
+    Define a new VM from a template, its disk a qcow2 overlay of the golden
+    image. The template VM's libvirt hooks are copied, so GPU passthrough
+    works as it did for the template
+
+    Returns:
+        Path of the new overlay
+    """
+    image, xml_path, meta_path = template_paths(template_name, directory)
+    if not (os.path.exists(image) and os.path.exists(xml_path)):
+        raise ValueError(f"No template named '{template_name}'")
+    with open(meta_path) as f:
+        meta = json.load(f)
+
+    root = ET.parse(xml_path).getroot()
+    root.find("name").text = vm_name
+    disk, _ = _main_disk(root)
+    overlay = os.path.join(IMAGES_PATH, f"{vm_name}.qcow2")
+    if os.path.exists(overlay):
+        raise ValueError(f"{overlay} already exists")
+    disk.find("source").set("file", overlay)
+    driver = disk.find("driver")
+    if driver is not None:
+        driver.set("type", "qcow2")
+
+    _new_overlay(overlay, image)
+    os.chmod(overlay, 0o600)
+    try:
+        with connection(conn, uri) as conn:
+            conn.defineXML(ET.tostring(root, encoding="unicode"))
+    except libvirt.libvirtError:
+        os.remove(overlay)
+        raise
+
+    hooks = os.path.join(HOOKS_DIR, meta.get("source_vm", ""))
+    if meta.get("source_vm") and os.path.isdir(hooks) and not os.path.exists(os.path.join(HOOKS_DIR, vm_name)):
+        shutil.copytree(hooks, os.path.join(HOOKS_DIR, vm_name))
+    return overlay
+
+def _disk_of(vm_name, conn=None, uri=DEFAULT_URI):
+    with connection(conn, uri) as conn:
+        _, root = _inactive_domain(conn, vm_name)
+    _, disk_path = _main_disk(root)
+    if disk_path is None:
+        raise ValueError(f"'{vm_name}' has no file-backed disk")
+    return disk_path
+
+def flatten_vm(vm_name, conn=None, uri=DEFAULT_URI):
+    """
+    Copy everything the VM reads from its golden image into its own disk so
+    it no longer depends on the template
+
+    Returns:
+        False if the disk had no backing file
+    """
+    disk_path = _disk_of(vm_name, conn, uri)
+    if not read_header(disk_path)["backing_file"]:
+        return False
+    #Merging data clusters is qemu-img's job, only the header is written natively
+    subprocess.run(["qemu-img", "rebase", "-f", "qcow2", "-b", "", disk_path], check=True)
+    return True
+
+def rebase_vm(vm_name, backing_file, safe=True, conn=None, uri=DEFAULT_URI):
+    """
+    Move a VM's overlay onto another golden image
+
+    Args:
+        safe: copy the clusters that differ between the old and new backing
+              file (qemu-img). False only rewrites the header, for a golden
+              image that was moved or copied unchanged
+    """
+    disk_path = _disk_of(vm_name, conn, uri)
+    backing_file = os.path.abspath(backing_file)
+    read_header(backing_file)
+    if safe:
+        subprocess.run(["qemu-img", "rebase", "-f", "qcow2", "-b", backing_file, "-F", "qcow2", disk_path],
+                       check=True)
+    else:
+        set_backing_file(disk_path, backing_file)
+
+def template_users(template_name, directory=GOLDEN_DIR, images=IMAGES_PATH):
+    """Overlays in the images directory whose backing chain includes the template"""
+    image = template_paths(template_name, directory)[0]
+    users = []
+    for entry in sorted(os.listdir(images)):
+        path = os.path.join(images, entry)
+        if not entry.endswith(".qcow2") or not os.path.isfile(path):
+            continue
+        try:
+            if image in backing_chain(path)[1:]:
+                users.append(path)
+        except Qcow2Error:
+            continue
+    return users
+
+def _pick_template():
+    templates = list_templates()
+    if not templates:
+        print("No templates yet. Seal an installed VM first")
+        return None
+    for number, (name, meta) in enumerate(templates, 1):
+        created = time.strftime("%Y-%m-%d %H:%M", time.localtime(meta.get("created", 0)))
+        print(f"  {BLUE}{number}{RESET}) {name:<24} from {meta.get('source_vm', '?'):<16} "
+              f"{meta.get('image_bytes', 0) / 1024**3:6.1f}GB  {created}")
+    choice = input("Template number: ").strip()
+    if not choice.isdigit() or not 1 <= int(choice) <= len(templates):
+        print("Invalid input!")
+        return None
+    return templates[int(choice) - 1][0]
+
+def prompt_seal():
+    vm_name = input("VM to seal into a template: ").strip()
+    if not vm_name:
+        return
+    print("Windows has to be generalized before it is cloned. In the VM run:")
+    print(f"  {YELLOW}{SYSPREP_COMMAND}{RESET}")
+    done = input("Has the VM been generalized and shut down (Y/n)? ").strip().lower()
+    if done not in ("yes", "y", ""):
+        return
+    template_name = input(f"Template name (Default {YELLOW}{vm_name}-golden{RESET}): ").strip() or f"{vm_name}-golden"
+    try:
+        image = seal_vm(vm_name, template_name)
+    except (ValueError, OSError, Qcow2Error, libvirt.libvirtError) as e:
+        print(f"🚨 Error 🚨 sealing {vm_name}: {RED}{e}{RESET}")
+        return
+    print(f"Sealed '{vm_name}' into {image} ✅ '{vm_name}' now runs from an overlay on it")
+
+def prompt_clone():
+    template_name = _pick_template()
+    if not template_name:
+        return
+    vm_name = input("Name of the new VM: ").strip()
+    if not vm_name:
+        return
+    started = time.monotonic()
+    try:
+        overlay = clone_vm(template_name, vm_name)
+    except (ValueError, OSError, Qcow2Error, libvirt.libvirtError) as e:
+        print(f"🚨 Error 🚨 cloning {template_name}: {RED}{e}{RESET}")
+        return
+    print(f"Created '{vm_name}' in {time.monotonic() - started:.1f}s, its disk {overlay} "
+          f"uses {GREEN}{os.path.getsize(overlay) / 1024**2:.1f}MB{RESET} ✅")
+
+def prompt_flatten():
+    vm_name = input("VM whose disk should be flattened: ").strip()
+    if not vm_name:
+        return
+    try:
+        if not flatten_vm(vm_name):
+            print(f"'{vm_name}' doesn't use a template, nothing to flatten")
+            return
+    except (ValueError, OSError, Qcow2Error, libvirt.libvirtError, subprocess.CalledProcessError) as e:
+        print(f"🚨 Error 🚨 flattening {vm_name}: {RED}{e}{RESET}")
+        return
+    print(f"'{vm_name}' no longer depends on a template ✅")
+
+def prompt_rebase():
+    vm_name = input("VM to move onto another template: ").strip()
+    if not vm_name:
+        return
+    template_name = _pick_template()
+    if not template_name:
+        return
+    moved = input("Is the new template an unchanged copy of the current one (y/N)? ").strip().lower()
+    try:
+        rebase_vm(vm_name, template_paths(template_name)[0], safe=moved not in ("yes", "y"))
+    except (ValueError, OSError, Qcow2Error, libvirt.libvirtError, subprocess.CalledProcessError) as e:
+        print(f"🚨 Error 🚨 rebasing {vm_name}: {RED}{e}{RESET}")
+        return
+    print(f"'{vm_name}' now uses template '{template_name}' ✅")
+
+def show_templates():
+    templates = list_templates()
+    if not templates:
+        print("No templates yet")
+        return
+    for name, meta in templates:
+        users = template_users(name)
+        print(f"{BLUE}{name}{RESET}: {meta.get('image_bytes', 0) / 1024**3:.1f}GB golden image from "
+              f"'{meta.get('source_vm', '?')}', {len(users)} VM(s) use it")
+        for path in users:
+            print(f"    {os.path.basename(path)}  {os.path.getsize(path) / 1024**2:.1f}MB")
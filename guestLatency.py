@@ -0,0 +1,153 @@
+import sys
+import xml.etree.ElementTree as ET
+import libvirt
+
+from hostProbe import read_cpu_flags
+from libvirtOps import connection
+
+GREEN = '\033[92m'
+RED = '\033[91m'
+YELLOW = '\033[93m'
+RESET = '\033[0m'
+
+VIRT_FLAGS = {"vmx", "svm"}
+STABLE_TSC_FLAGS = {"constant_tsc", "nonstop_tsc"}
+
+#(enlightenment, extra attributes, host flags that must all be present, enlightenments it depends on)
+ENLIGHTENMENTS = [
+    ("relaxed", {}, set(), []),
+    ("vapic", {}, set(), []),
+    ("spinlocks", {"retries": "8191"}, set(), []),
+    ("vpindex", {}, set(), []),
+    ("synic", {}, set(), ["vpindex"]),
+    ("stimer", {}, {"constant_tsc"}, ["synic"]),
+    ("frequencies", {}, {"constant_tsc"}, []),
+    ("tlbflush", {}, set(), ["vpindex"]),
+    ("ipi", {}, set(), ["vpindex"]),
+]
+
+def plan_enlightenments(flags):
+    """
+    Pick the Hyper-V enlightenments the host can back
+
+    Returns:
+        Dict of enlightenment name -> extra attributes
+    """
+    if not flags & VIRT_FLAGS:
+        return {}
+
+    enabled = {}
+    for name, attrs, required_flags, depends in ENLIGHTENMENTS:
+        if required_flags <= flags and all(dep in enabled for dep in depends):
+            enabled[name] = attrs
+    return enabled
+
+def apply_latency_profile(root, flags=None, hide_kvm=False):
+    """
+    Write the Hyper-V enlightenments, low-latency timers, invtsc and
+    (optionally) a hidden KVM signature into the domain tree
+
+    Returns:
+        List of the settings that were turned on
+    """
+    if flags is None:
+        flags = read_cpu_flags()
+    active = []
+
+    features = root.find("features")
+    if features is None:
+        features = ET.SubElement(root, "features")
+
+    for old in features.findall("hyperv"):
+        features.remove(old)
+    enlightenments = plan_enlightenments(flags)
+    if enlightenments:
+        hyperv = ET.Element("hyperv", {"mode": "custom"})
+        features.insert(0, hyperv)
+        for name, attrs in enlightenments.items():
+            ET.SubElement(hyperv, name, {"state": "on", **attrs})
+            active.append(f"hv_{name}")
+        if "stimer" in enlightenments:
+            hyperv.find("stimer").append(ET.Element("direct", {"state": "on"}))
+        if hide_kvm:
+            #NVIDIA drivers before 465 refuse to start when they spot a hypervisor
+            ET.SubElement(hyperv, "vendor_id", {"state": "on", "value": "1234567890ab"})
+
+    for old in features.findall("kvm"):
+        features.remove(old)
+    if hide_kvm:
+        kvm = ET.SubElement(features, "kvm")
+        ET.SubElement(kvm, "hidden", {"state": "on"})
+        active.append("kvm_hidden")
+
+    clock = root.find("clock")
+    if clock is None:
+        clock = ET.SubElement(root, "clock", {"offset": "localtime"})
+    for timer in clock.findall("timer"):
+        if timer.get("name") in ("hpet", "hypervclock", "tsc"):
+            clock.remove(timer)
+    ET.SubElement(clock, "timer", {"name": "hpet", "present": "no"})
+    active.append("hpet_off")
+    if "constant_tsc" in flags:
+        ET.SubElement(clock, "timer", {"name": "hypervclock", "present": "yes"})
+        active.append("hypervclock")
+
+    cpu = root.find("cpu")
+    if cpu is None:
+        cpu = ET.SubElement(root, "cpu", {"mode": "host-passthrough"})
+    for feature in cpu.findall("feature[@name='invtsc']"):
+        cpu.remove(feature)
+    if STABLE_TSC_FLAGS <= flags:
+        ET.SubElement(cpu, "feature", {"policy": "require", "name": "invtsc"})
+        active.append("invtsc")
+
+    return active
+
+def validate_enlightenments(xml):
+    """
+    Report which latency settings are active in a domain XML (string or tree)
+
+    Returns:
+        Dict of setting -> True/False
+    """
+    root = ET.fromstring(xml) if isinstance(xml, str) else xml
+    report = {}
+    hyperv = root.find("features/hyperv")
+    for name, _, _, _ in ENLIGHTENMENTS:
+        elem = hyperv.find(name) if hyperv is not None else None
+        report[f"hv_{name}"] = elem is not None and elem.get("state") == "on"
+
+    hidden = root.find("features/kvm/hidden")
+    report["kvm_hidden"] = hidden is not None and hidden.get("state") == "on"
+    hpet = root.find("clock/timer[@name='hpet']")
+    report["hpet_off"] = hpet is not None and hpet.get("present") == "no"
+    hypervclock = root.find("clock/timer[@name='hypervclock']")
+    report["hypervclock"] = hypervclock is not None and hypervclock.get("present") == "yes"
+    invtsc = root.find("cpu/feature[@name='invtsc']")
+    report["invtsc"] = invtsc is not None and invtsc.get("policy") in ("require", "force")
+    return report
+
+def print_enlightenment_report(report):
+    for name, active in report.items():
+        state = f"{GREEN}active{RESET}" if active else f"{YELLOW}off{RESET}"
+        print(f"  - {name:<16} {state}")
+
+def check_vm_latency_profile(vm_name, conn=None):
+    """Print which latency settings are active in a defined VM"""
+    try:
+        with connection(conn) as conn:
+            xml = conn.lookupByName(vm_name).XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE)
+    except libvirt.libvirtError as e:
+        print(f"Libvirt error: {RED}{e}{RESET}")
+        return None
+
+    report = validate_enlightenments(xml)
+    print(f"Latency profile of {vm_name}:")
+    print_enlightenment_report(report)
+    return report
+
+if __name__ == "__main__":
+    #Usage: python3 guestLatency.py <vm_name>
+    if len(sys.argv) != 2:
+        sys.exit("Usage: python3 guestLatency.py <vm_name>")
+    check_vm_latency_profile(sys.argv[1])
@@ -0,0 +1,310 @@
+import os
+import signal
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from coreIsolation import read_domain, isolate_host, release_host
+from pciDevices import read_pci_device, CLASS_DISPLAY, VENDOR_NVIDIA
+from hookTimings import HookJournal
+
+PCI_DEVICES = "sys/bus/pci/devices"
+DISPLAY_MANAGER = "display-manager.service"
+#Device nodes a process can hold the GPU through
+GPU_NODES = ("/dev/nvidia", "/dev/dri/", "/dev/fb")
+#Unloaded top down: each module only reaches refcount 0 once the ones using it are gone.
+#amdgpu, i915 and nouveau stay loaded, unbinding the GPU from them is enough
+NVIDIA_MODULES = ("nvidia_drm", "nvidia_modeset", "nvidia_uvm", "nvidia")
+VTCONSOLES = "sys/class/vtconsole"
+EFI_FRAMEBUFFER = "sys/bus/platform/drivers/efi-framebuffer"
+
+#How often conditions are checked and how long each may take before the hook gives up on it
+POLL_INTERVAL = 0.02
+UNIT_TIMEOUT = 15
+PROCESS_TIMEOUT = 3
+MODULE_TIMEOUT = 10
+DRIVER_TIMEOUT = 5
+
+#Marks a start.sh/revert.sh that hands the work to this engine
+HOOK_ENGINE = "hookEngine.py"
+
+class HookError(Exception):
+    pass
+
+class HookTimeout(HookError):
+    pass
+
+#Set for the hook being run, every step is appended to the VM's timing journal
+journal = None
+
+def _read(path, default=None):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return default
+
+def _write(path, text):
+    with open(path, "w") as f:
+        f.write(text)
+
+def log(message):
+    """Hook output ends up in libvirtd's journal"""
+    print(f"[{time.strftime('%H:%M:%S')}] {message}", flush=True)
+
+def wait_for(condition, timeout, what, interval=POLL_INTERVAL):
+    """
+    Poll condition until it is true
+
+    Raises:
+        HookTimeout naming what didn't happen within timeout seconds
+    """
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() >= deadline:
+            raise HookTimeout(f"{what} didn't happen within {timeout}s")
+        time.sleep(interval)
+
+def step(name, func, *args):
+    """Run one phase of a hook, log how long it took and record it in the journal"""
+    started = time.monotonic()
+    ok = False
+    try:
+        result = func(*args)
+        ok = True
+        return result
+    finally:
+        ended = time.monotonic()
+        log(f"{name}: {ended - started:.3f}s")
+        if journal:
+            journal.record(name, started, ended, ok)
+
+def run_concurrently(*steps):
+    """Run (name, func, *args) steps in parallel. The first failure is raised once all have finished"""
+    with ThreadPoolExecutor(max_workers=len(steps)) as pool:
+        futures = [pool.submit(step, *s) for s in steps]
+    errors = [future.exception() for future in futures if future.exception()]
+    if errors:
+        raise errors[0]
+    return [future.result() for future in futures]
+
+def run_best_effort(failures, *steps):
+    """Like run_concurrently, but failed steps are logged and their names appended to failures"""
+    with ThreadPoolExecutor(max_workers=len(steps)) as pool:
+        futures = [(s[0], pool.submit(step, *s)) for s in steps]
+    for name, future in futures:
+        if future.exception():
+            log(f"{name} failed: {future.exception()}")
+            failures.append(name)
+
+def unit_active(unit):
+    state = subprocess.run(["systemctl", "is-active", unit], capture_output=True, text=True).stdout.strip()
+    return state in ("active", "activating", "deactivating", "reloading")
+
+def stop_display_manager():
+    if not unit_active(DISPLAY_MANAGER):
+        return
+    subprocess.run(["systemctl", "stop", "--no-block", DISPLAY_MANAGER], check=True)
+    #Every check forks systemctl, so this one polls less often
+    wait_for(lambda: not unit_active(DISPLAY_MANAGER), UNIT_TIMEOUT, f"{DISPLAY_MANAGER} stopping", interval=0.1)
+
+def start_display_manager():
+    #The hook doesn't wait for the login screen, only libvirt waits for the hook
+    subprocess.run(["systemctl", "start", "--no-block", DISPLAY_MANAGER], check=True)
+
+def gpu_users(root="/"):
+    """PIDs with a GPU device node open, read from /proc/*/fd instead of lsof"""
+    proc = os.path.join(root, "proc")
+    users = set()
+    for pid in os.listdir(proc):
+        if not pid.isdigit() or int(pid) == os.getpid():
+            continue
+        fd_dir = os.path.join(proc, pid, "fd")
+        try:
+            fds = os.listdir(fd_dir)
+        except OSError:
+            continue
+        for fd in fds:
+            try:
+                target = os.readlink(os.path.join(fd_dir, fd))
+            except OSError:
+                continue
+            if target.startswith(GPU_NODES):
+                users.add(int(pid))
+                break
+    return sorted(users)
+
+def _alive(pids, root="/"):
+    return [pid for pid in pids if os.path.exists(os.path.join(root, "proc", str(pid)))]
+
+def kill_gpu_users():
+    """SIGTERM whatever still holds the GPU, SIGKILL what hasn't exited once PROCESS_TIMEOUT is up"""
+    pids = gpu_users()
+    if not pids:
+        return
+    log(f"Stopping GPU users {pids}")
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    try:
+        wait_for(lambda: not _alive(pids), PROCESS_TIMEOUT, "GPU users exiting")
+    except HookTimeout:
+        for pid in _alive(pids):
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        wait_for(lambda: not _alive(pids), PROCESS_TIMEOUT, "GPU users exiting after SIGKILL")
+
+def module_loaded(module, root="/"):
+    return os.path.isdir(os.path.join(root, "sys/module", module))
+
+def module_refcount(module, root="/"):
+    refcnt = _read(os.path.join(root, "sys/module", module, "refcnt"))
+    return int(refcnt) if refcnt and refcnt.isdigit() else 0
+
+def unload_modules(modules, root="/"):
+    """Unload each loaded module as soon as nothing holds it any more"""
+    for module in modules:
+        if not module_loaded(module, root):
+            continue
+        wait_for(lambda: module_refcount(module, root) == 0, MODULE_TIMEOUT, f"{module} refcount reaching 0")
+        subprocess.run(["modprobe", "-r", module], check=True)
+        wait_for(lambda: not module_loaded(module, root), MODULE_TIMEOUT, f"{module} unloading")
+
+def module_available(module):
+    """True if the module is installed for the running kernel, loaded or not"""
+    return subprocess.run(["modinfo", "-n", module], capture_output=True).returncode == 0
+
+def load_modules(*modules):
+    subprocess.run(["modprobe", "-a", *modules], check=True)
+
+def set_vtconsoles(bound, root="/"):
+    """Bind or unbind the text consoles, fbcon keeps the GPU's framebuffer (and nvidia_drm) busy"""
+    directory = os.path.join(root, VTCONSOLES)
+    try:
+        consoles = sorted(os.listdir(directory))
+    except OSError:
+        return
+    for console in consoles:
+        bind = os.path.join(directory, console, "bind")
+        if _read(bind) not in (None, "1" if bound else "0"):
+            try:
+                _write(bind, "1" if bound else "0")
+            except OSError as e:
+                log(f"{console}: {e}")
+
+def set_efi_framebuffer(bound, root="/"):
+    driver = os.path.join(root, EFI_FRAMEBUFFER)
+    device = os.path.join(driver, "efi-framebuffer.0")
+    if not os.path.isdir(driver) or os.path.exists(device) == bound:
+        return
+    try:
+        _write(os.path.join(driver, "bind" if bound else "unbind"), "efi-framebuffer.0")
+    except OSError as e:
+        #Only firmware that set up a GOP framebuffer has one
+        log(f"efi-framebuffer: {e}")
+        return
+    wait_for(lambda: os.path.exists(device) == bound, DRIVER_TIMEOUT,
+             f"efi-framebuffer {'binding' if bound else 'unbinding'}")
+
+def domain_hostdevs(vm_name, root="/"):
+    """PCI addresses of the VM's <hostdev type='pci'> entries (GPU functions, USB controllers)"""
+    bdfs = []
+    for address in read_domain(vm_name, root).findall("./devices/hostdev[@type='pci']/source/address"):
+        values = [int(address.get(attr, "0"), 16) for attr in ("domain", "bus", "slot", "function")]
+        bdfs.append("{:04x}:{:02x}:{:02x}.{:x}".format(*values))
+    return bdfs
+
+def passthrough_gpu(bdfs, root="/"):
+    """The first display controller among the VM's PCI devices, None if it has none"""
+    for bdf in bdfs:
+        device = read_pci_device(bdf, root)
+        if device.class_id >> 8 == CLASS_DISPLAY:
+            return device
+    return None
+
+def _driver(bdf, root="/"):
+    return read_pci_device(bdf, root).driver
+
+def rebind(bdf, driver_override, root="/"):
+    """
+    Move a PCI function to vfio-pci (driver_override 'vfio-pci') or back to
+    its host driver (''), waiting on its driver link instead of sleeping
+    """
+    device = os.path.join(root, PCI_DEVICES, bdf)
+    _write(os.path.join(device, "driver_override"), driver_override or "\n")
+    current = _driver(bdf, root)
+    if current and current != driver_override:
+        _write(os.path.join(device, "driver", "unbind"), bdf)
+        wait_for(lambda: _driver(bdf, root) is None, DRIVER_TIMEOUT, f"{bdf} unbinding from {current}")
+    if _driver(bdf, root) is None:
+        _write(os.path.join(root, "sys/bus/pci/drivers_probe"), bdf)
+    if driver_override:
+        wait_for(lambda: _driver(bdf, root) == driver_override, DRIVER_TIMEOUT, f"{bdf} binding to {driver_override}")
+
+def prepare(vm_name):
+    """prepare/begin: free the GPU from the host and hand the VM's PCI devices to vfio-pci"""
+    bdfs = domain_hostdevs(vm_name)
+    gpu = passthrough_gpu(bdfs)
+    #vfio-pci and the core isolation don't depend on the display going away
+    with ThreadPoolExecutor(max_workers=2) as background:
+        vfio = background.submit(step, "modprobe vfio-pci", load_modules, "vfio-pci")
+        isolation = background.submit(step, "core isolation", isolate_host, vm_name)
+
+        step("stop display manager", stop_display_manager)
+        step("kill GPU users", kill_gpu_users)
+        run_concurrently(("unbind vtconsoles", set_vtconsoles, False),
+                         ("unbind efi-framebuffer", set_efi_framebuffer, False))
+        if gpu and gpu.vendor == VENDOR_NVIDIA:
+            step("unload nvidia modules", unload_modules, NVIDIA_MODULES)
+        vfio.result()
+        if bdfs:
+            run_concurrently(*[(f"detach {bdf}", rebind, bdf, "vfio-pci") for bdf in bdfs])
+    isolation.result()
+
+def release(vm_name):
+    """
+    release/end: give the PCI devices, the cores and the display back to the
+    host. Every step is attempted even when an earlier one failed, so the
+    host always gets its consoles and display manager back
+    """
+    failures = []
+    try:
+        bdfs = domain_hostdevs(vm_name)
+    except Exception as e:
+        log(f"Reading the PCI devices of '{vm_name}' failed, not reattaching any: {e}")
+        failures.append("read domain")
+        bdfs = []
+    gpu = passthrough_gpu(bdfs)
+    steps = [("core release", release_host, vm_name)]
+    steps += [(f"reattach {bdf}", rebind, bdf, "") for bdf in reversed(bdfs)]
+    run_best_effort(failures, *steps)
+    #modprobe pulls in nvidia and nvidia_modeset for nvidia_drm, the GPU binds as the driver registers.
+    #Other drivers stayed loaded and got the GPU back with the reattach
+    if gpu and gpu.vendor == VENDOR_NVIDIA and module_available("nvidia_drm"):
+        run_best_effort(failures, ("load nvidia modules", load_modules, "nvidia_drm", "nvidia_uvm"))
+    run_best_effort(failures, ("bind vtconsoles", set_vtconsoles, True),
+                    ("bind efi-framebuffer", set_efi_framebuffer, True))
+    run_best_effort(failures, ("start display manager", start_display_manager))
+    if failures:
+        raise HookError(f"release incomplete, failed: {', '.join(failures)}")
+
+if __name__ == "__main__":
+    #Called from the hooks: python3 hookEngine.py prepare|release <vm name>
+    if len(sys.argv) != 3 or sys.argv[1] not in ("prepare", "release"):
+        sys.exit("Usage: hookEngine.py prepare|release <vm name>")
+    journal = HookJournal(sys.argv[2], sys.argv[1])
+    try:
+        (prepare if sys.argv[1] == "prepare" else release)(sys.argv[2])
+    #Anything, a broken domain XML included, has to close the journal's run and fail the hook cleanly
+    except Exception as e:
+        log(f"{sys.argv[1]} failed after {time.monotonic() - journal.started:.3f}s: {e!r}")
+        journal.finish(ok=False, error=repr(e))
+        #A failed prepare hook stops libvirt from starting the VM on a half-detached GPU
+        sys.exit(1)
+    log(f"{sys.argv[1]}: {time.monotonic() - journal.started:.3f}s")
+    journal.finish()
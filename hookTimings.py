@@ -0,0 +1,228 @@
+import json
+import os
+import sys
+import threading
+import time
+
+BLUE = '\033[94m'
+GREEN = '\033[92m'
+RED = '\033[91m'
+YELLOW = '\033[93m'
+RESET = '\033[0m'
+
+#One append-only JSONL file per VM, written by the hooks
+JOURNAL_DIR = "var/log/single-gpu-passthrough"
+HOOKS = {"prepare": "starts", "release": "stops"}
+#The record closing a run, with the kernel and driver it ran on
+TOTAL = "total"
+RECENT_RUNS = 20
+#A phase counts as regressed when its p50 grew by this ratio and by at least this many seconds
+REGRESSION_RATIO = 0.25
+REGRESSION_MIN_DELTA = 0.1
+
+def _read(path, default=None):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return default
+
+def journal_path(vm_name, root="/"):
+    return os.path.join(root, JOURNAL_DIR, f"{vm_name}.jsonl")
+
+def driver_version(root="/"):
+    """Version of the loaded nvidia module, None when it isn't loaded"""
+    return _read(os.path.join(root, "sys/module/nvidia/version"))
+
+class HookJournal:
+    """
+    Timings of one hook run. Every phase is appended as soon as it ends, so a
+    hook that hangs or dies still leaves the phases before it
+    """
+
+    def __init__(self, vm_name, hook, root="/"):
+        self.path = journal_path(vm_name, root)
+        self.hook = hook
+        self.root = root
+        self.run = f"{time.time():.6f}-{os.getpid()}"
+        self.started = time.monotonic()
+        #prepare unloads nvidia and release loads it, so whichever end has it loaded gives the version
+        self.driver = driver_version(root)
+        self._lock = threading.Lock()
+        self._failed = False
+
+    def _append(self, record):
+        line = json.dumps({"run": self.run, "hook": self.hook, **record}) + "\n"
+        with self._lock:
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                with open(self.path, "a") as f:
+                    f.write(line)
+            except OSError as e:
+                #Timings are never worth failing the hook over
+                if not self._failed:
+                    print(f"Not recording timings to {self.path}: {e}", flush=True)
+                self._failed = True
+
+    def record(self, phase, start, end, ok=True):
+        """One phase, start and end from time.monotonic()"""
+        self._append({"phase": phase, "start": round(start, 6), "end": round(end, 6),
+                      "duration": round(end - start, 6), "ok": ok})
+
+    def finish(self, ok=True, error=None):
+        end = time.monotonic()
+        self._append({"phase": TOTAL, "start": round(self.started, 6), "end": round(end, 6),
+                      "duration": round(end - self.started, 6), "ok": ok, "error": error,
+                      "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "kernel": os.uname().release,
+                      "driver": self.driver or driver_version(self.root)})
+
+def read_journal(vm_name, root="/"):
+    """Records of a VM's journal in the order they were written. Lines cut short by a crash are skipped"""
+    records = []
+    try:
+        with open(journal_path(vm_name, root)) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    except OSError:
+        pass
+    return records
+
+def journaled_vms(root="/"):
+    try:
+        entries = os.listdir(os.path.join(root, JOURNAL_DIR))
+    except OSError:
+        return []
+    return sorted(entry[:-len(".jsonl")] for entry in entries if entry.endswith(".jsonl"))
+
+def group_runs(records, hook):
+    """
+    Completed runs of one hook, oldest first
+
+    Returns:
+        List of dicts with 'total' (the closing record) and 'phases' (name -> duration in start order)
+    """
+    phases = {}
+    runs = []
+    for record in records:
+        if record.get("hook") != hook:
+            continue
+        if record.get("phase") == TOTAL:
+            steps = sorted(phases.pop(record["run"], []), key=lambda step: step["start"])
+            runs.append({"total": record, "phases": {step["phase"]: step["duration"] for step in steps}})
+        else:
+            phases.setdefault(record["run"], []).append(record)
+    return runs
+
+def environment(run):
+    total = run["total"]
+    return total.get("kernel"), total.get("driver")
+
+def describe_environment(env):
+    kernel, driver = env
+    return f"kernel {kernel}" + (f", nvidia {driver}" if driver else "")
+
+def percentile(values, p):
+    """Linear interpolation between the closest ranks, like numpy's default"""
+    values = sorted(values)
+    if not values:
+        return None
+    position = (len(values) - 1) * p / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+def phase_stats(runs):
+    """phase -> (runs, p50, p95) over successful runs, phases in the order the latest run did them"""
+    durations = {}
+    for run in runs:
+        if not run["total"].get("ok"):
+            continue
+        for phase, duration in run["phases"].items():
+            durations.setdefault(phase, []).append(duration)
+        durations.setdefault(TOTAL, []).append(run["total"]["duration"])
+    latest = list(runs[-1]["phases"]) if runs else []
+    phases = [phase for phase in latest if phase in durations]
+    phases += [phase for phase in durations if phase not in phases and phase != TOTAL]
+    if TOTAL in durations:
+        phases.append(TOTAL)
+    return {phase: (len(durations[phase]), percentile(durations[phase], 50), percentile(durations[phase], 95))
+            for phase in phases}
+
+def find_regressions(runs, recent=RECENT_RUNS):
+    """
+    Compare the p50 of each phase on the latest kernel/driver with the one
+    it replaced
+
+    Returns:
+        (current environment, previous environment, {phase: (old p50, new p50)}),
+        previous None when every run was on the same kernel and driver
+    """
+    if not runs:
+        return None, None, {}
+    current = environment(runs[-1])
+    previous = next((environment(run) for run in reversed(runs) if environment(run) != current), None)
+    if previous is None:
+        return current, None, {}
+    new = phase_stats([run for run in runs if environment(run) == current][-recent:])
+    old = phase_stats([run for run in runs if environment(run) == previous][-recent:])
+    regressions = {}
+    for phase, (_, new_p50, _) in new.items():
+        if phase not in old or new_p50 is None:
+            continue
+        old_p50 = old[phase][1]
+        if new_p50 > old_p50 * (1 + REGRESSION_RATIO) and new_p50 - old_p50 >= REGRESSION_MIN_DELTA:
+            regressions[phase] = (old_p50, new_p50)
+    return current, previous, regressions
+
+def print_report(vm_name, recent=RECENT_RUNS, root="/"):
+    """p50/p95 of every hook phase over the last recent starts and stops, with regressions since the last kernel/driver change"""
+    records = read_journal(vm_name, root)
+    if not records:
+        print(f"No hook timings for '{vm_name}' yet, they are recorded in {journal_path(vm_name, root)} once it starts")
+        return False
+
+    for hook, label in HOOKS.items():
+        runs = group_runs(records, hook)
+        if not runs:
+            continue
+        window = runs[-recent:]
+        failed = sum(1 for run in window if not run["total"].get("ok"))
+        print(f"\n{BLUE}{vm_name}{RESET} {label}: last {len(window)} of {len(runs)}"
+              + (f", {RED}{failed} failed{RESET}" if failed else ""))
+        current, previous, regressions = find_regressions(runs, recent)
+        print(f"  on {describe_environment(current)}")
+        print(f"  {'phase':<32} {'runs':>5} {'p50':>9} {'p95':>9}")
+        for phase, (count, p50, p95) in phase_stats(window).items():
+            flag = ""
+            if phase in regressions:
+                flag = f" {YELLOW}⚠️  was {regressions[phase][0]:.3f}s{RESET}"
+            print(f"  {phase:<32} {count:>5} {p50:>8.3f}s {p95:>8.3f}s{flag}")
+        for run in window:
+            if not run["total"].get("ok"):
+                print(f"  {RED}✗{RESET} {run['total'].get('time')}: {run['total'].get('error')}")
+        if regressions:
+            print(f"{YELLOW}⚠️  Note ⚠️ : {', '.join(regressions)} got slower since {describe_environment(current)} "
+                  f"replaced {describe_environment(previous)}{RESET}")
+        elif previous:
+            print(f"  {GREEN}No regressions since {describe_environment(previous)}{RESET}")
+    return True
+
+def prompt_report(root="/"):
+    vms = journaled_vms(root)
+    if not vms:
+        print(f"No hook timings recorded yet, they appear in /{JOURNAL_DIR} once a passthrough VM has started")
+        return
+    default = vms[0] if len(vms) == 1 else ""
+    vm_name = input(f"VM name ({', '.join(vms)}): ").strip() or default
+    if vm_name:
+        print_report(vm_name, root=root)
+
+if __name__ == "__main__":
+    #python3 hookTimings.py <vm name> [recent runs]
+    if len(sys.argv) not in (2, 3) or (len(sys.argv) == 3 and not sys.argv[2].isdigit()):
+        sys.exit("Usage: hookTimings.py <vm name> [recent runs]")
+    if not print_report(sys.argv[1], int(sys.argv[2]) if len(sys.argv) == 3 else RECENT_RUNS):
+        sys.exit(1)
@@ -2,6 +2,14 @@ import subprocess
 import shutil
 import xml.etree.ElementTree as ET
 import libvirt
+from functools import partial
+from domainXml import apply_transforms
+from guestLatency import apply_latency_profile, check_vm_latency_profile
+from usbControllers import prompt_usb_controllers
+from pciDevices import select_gpu, gpu_functions, pci_inventory, describe, VENDOR_NVIDIA
+from coreIsolation import HOOK_LIB_DIR, HOOK_MODULES
+from hookEngine import HOOK_ENGINE
+from evdevInput import prompt_input_devices, setup_evdev_input, without_passed_through, DEFAULT_GRAB_TOGGLE
 
 GREEN = '\033[92m'
 RED = '\033[91m'
@@ -28,7 +36,14 @@ def restart_libvirt_service():
     else:
         print("Neither systemctl nor service command found. Please check your init system")
 
-def setup_libvirt_hooks(vm_name: str):
+def install_hook_dispatcher():
+    """
+    The qemu hook script and the Python helpers it runs, shared by all VMs.
+    libvirtd only looks for the script when it starts, so it is restarted
+
+    Returns:
+        True when the hook script is in place
+    """
     try:
         #Creating hooks directory
         subprocess.run(["mkdir", "-p", "/etc/libvirt/hooks"], check=True)
@@ -43,9 +58,29 @@ def setup_libvirt_hooks(vm_name: str):
         #Making the qemu script executable
         subprocess.run(["chmod", "+x", "/etc/libvirt/hooks/qemu"], check=True)
 
+        #Python helpers the hook scripts call
+        subprocess.run(["mkdir", "-p", HOOK_LIB_DIR], check=True)
+        subprocess.run(["cp", *HOOK_MODULES, HOOK_LIB_DIR], check=True)
+
         #Restarting libvirtd
         restart_libvirt_service()
+        return True
+
+    except subprocess.CalledProcessError as e:
+        print(f"🚨 Error 🚨 occurred during setup: {RED}{e}{RESET}")
+        return False
+
+def setup_libvirt_hooks(vm_name: str, dispatcher=True):
+    """
+    Install the VM's start.sh and revert.sh
 
+    Args:
+        dispatcher: Also install the shared hook script and restart libvirtd.
+                    Spec mode does that once before any VM is provisioned
+    """
+    if dispatcher and not install_hook_dispatcher():
+        return
+    try:
         #Creating prepare and release hook directories
         prepare_dir = f"/etc/libvirt/hooks/qemu.d/{vm_name}/prepare/begin"
         release_dir = f"/etc/libvirt/hooks/qemu.d/{vm_name}/release/end"
@@ -63,170 +98,239 @@ def setup_libvirt_hooks(vm_name: str):
     except subprocess.CalledProcessError as e:
         print(f"🚨 Error 🚨 occurred during setup: {RED}{e}{RESET}")
 
-def get_gpu_pci_ids():
-    """Returns the PCI IDs for the NVIDIA GPU (VGA and Audio)"""
-    try:
-        output = subprocess.check_output(["lspci", "-nnk"], text=True).splitlines()
-
-        vga_id = None
-        audio_id = None
-
-        for line in output:
-            if "VGA compatible controller" in line and "NVIDIA" in line:
-                vga_id = line.split()[0]
-            elif "Audio device" in line and "NVIDIA" in line:
-                audio_id = line.split()[0]
-
-        if vga_id and audio_id:
-            print(f"Found GPU PCI IDs: VGA = {GREEN}{vga_id}{RESET}, Audio = {GREEN}{audio_id}{RESET}")
-        else:
-            print("Could not find both GPU and Audio IDs")
-        
-        return vga_id, audio_id
-
-    except subprocess.CalledProcessError as e:
-        print(f"Failed to run lspci: {RED}{e}{RESET}")
-        return None, None
-
-def format_pci_id(raw_id):
-    return f"pci_0000_{raw_id.replace(':', '_').replace('.', '_')}"
-
-def update_start_sh(vm_name: str):
-    """Appends virsh nodedev-detach lines to start.sh before modprobe vfio-pci"""
-    vga_id, audio_id = get_gpu_pci_ids()
-
-    if not vga_id or not audio_id:
-        print("Could not find GPU or audio PCI IDs")
+def get_gpu_pci_ids(gpu_choice=None):
+    """
+    Returns the PCI addresses (0000:01:00.0) of every function of the GPU
+    to pass through, its VGA/3D controller first
+
+    Args:
+        gpu_choice: PCI address or 'boot_vga' from a spec file, asked for when None
+    """
+    gpu = select_gpu(choice=gpu_choice)
+    if gpu is None:
+        print("Could not find a GPU")
+        return []
+
+    functions = gpu_functions(choice=gpu_choice)
+    print(f"Found GPU {GREEN}{describe(gpu)}{RESET}")
+    for function in functions[1:]:
+        print(f"  with {GREEN}{function.bdf}{RESET} [{function.ids}] ({function.driver or 'no driver'})")
+    #Everything in the group goes to vfio-pci together, PCI bridges (class 0x06) don't have to
+    others = [device for device in pci_inventory().iommu_group_of(gpu)
+              if device not in functions and device.class_id >> 8 != 0x06]
+    if others:
+        print(f"⚠️  Note ⚠️ : IOMMU group {gpu.iommu_group} also holds {', '.join(describe(d) for d in others)}. "
+              "They have to be passed through too (or the group split with the ACS override patch)")
+    return [function.bdf for function in functions]
+
+def full_bdf(raw_id):
+    """lspci prints 01:00.0, sysfs wants the domain too (0000:01:00.0)"""
+    return raw_id if raw_id.count(':') == 2 else f"0000:{raw_id}"
+
+def vfio_detach_lines(raw_id):
+    """Shell lines that hand a PCI function to vfio-pci through sysfs (what nodedev-detach does)"""
+    bdf = full_bdf(raw_id)
+    dev = f"/sys/bus/pci/devices/{bdf}"
+    return [
+        f"echo vfio-pci > {dev}/driver_override\n",
+        f"[ -e {dev}/driver ] && echo {bdf} > {dev}/driver/unbind\n",
+        f"echo {bdf} > /sys/bus/pci/drivers_probe\n",
+    ]
+
+def vfio_reattach_lines(raw_id):
+    """Shell lines that give a PCI function back to its host driver (what nodedev-reattach does)"""
+    bdf = full_bdf(raw_id)
+    dev = f"/sys/bus/pci/devices/{bdf}"
+    return [
+        f"echo > {dev}/driver_override\n",
+        f"[ -e {dev}/driver ] && echo {bdf} > {dev}/driver/unbind\n",
+        f"echo {bdf} > /sys/bus/pci/drivers_probe\n",
+    ]
+
+def update_start_sh(vm_name: str, pci_ids=None, label="GPU", gpu_choice=None):
+    """
+    Adds sysfs vfio-pci bind lines to start.sh right after modprobe vfio-pci
+
+    Args:
+        pci_ids: PCI addresses to detach, the GPU's functions when not given
+        gpu_choice: PCI address or 'boot_vga' of that GPU, asked for when None
+    """
+    if pci_ids is None:
+        pci_ids = get_gpu_pci_ids(gpu_choice)
+
+    if not pci_ids:
+        print(f"Could not find {label} PCI IDs")
         return
 
-    pci_vga = format_pci_id(vga_id)
-    pci_audio = format_pci_id(audio_id)
-
     start_sh_path = f"/etc/libvirt/hooks/qemu.d/{vm_name}/prepare/begin/start.sh"
 
     try:
         with open(start_sh_path, "r") as file:
             lines = file.readlines()
 
+        if any(HOOK_ENGINE in line for line in lines):
+            print(f"{start_sh_path} detaches the VM's PCI hostdevs itself, nothing to add")
+            return
+
         insert_index = next((i for i, line in enumerate(lines) if "modprobe vfio-pci" in line), None)
         if insert_index is None:
             print(f"modprobe vfio-pci not found in {start_sh_path}")
             return
 
-        #Inserts detachment lines just before the modprobe
-        lines.insert(insert_index, f"virsh nodedev-detach {pci_audio}\n\n")
-        lines.insert(insert_index, f"virsh nodedev-detach {pci_vga}\n")
-        lines.insert(insert_index, f"#Unbind the GPU from display driver\n")
+        #vfio-pci has to be loaded before devices can be probed onto it
+        detach_lines = ["\n", f"#Unbind the {label} from its host driver\n"]
+        for pci_id in pci_ids:
+            detach_lines += vfio_detach_lines(pci_id)
+        lines[insert_index + 1:insert_index + 1] = detach_lines
 
         #Writes updated lines back
         with open(start_sh_path, "w") as file:
             file.writelines(lines)
 
-        print(f"Updated {start_sh_path} with GPU detach commands")
+        print(f"Updated {start_sh_path} with {label} detach commands")
 
     except FileNotFoundError:
         print(f"{start_sh_path} not found")
     except PermissionError:
         print(f"Permission denied while editing {start_sh_path}")
 
-def update_revert_sh(vm_name: str):
-    """Prepends virsh nodedev-reattach lines to revert.sh after set -x"""
-    vga_id, audio_id = get_gpu_pci_ids()
+def update_revert_sh(vm_name: str, pci_ids=None, label="GPU", gpu_choice=None):
+    """Prepends sysfs reattach lines to revert.sh after set -x"""
+    if pci_ids is None:
+        pci_ids = get_gpu_pci_ids(gpu_choice)
 
-    if not vga_id or not audio_id:
-        print("Could not find GPU or audio PCI IDs")
+    if not pci_ids:
+        print(f"Could not find {label} PCI IDs")
         return
 
-    pci_vga = format_pci_id(vga_id)
-    pci_audio = format_pci_id(audio_id)
-
     revert_sh_path = f"/etc/libvirt/hooks/qemu.d/{vm_name}/release/end/revert.sh"
 
     try:
         with open(revert_sh_path, "r") as file:
             lines = file.readlines()
 
+        if any(HOOK_ENGINE in line for line in lines):
+            print(f"{revert_sh_path} reattaches the VM's PCI hostdevs itself, nothing to add")
+            return
+
         #Finds the index right after "set -x"
         insert_index = next(
             (i + 1 for i, line in enumerate(lines) if line.strip() == "set -x"),
             0
         )
 
-        #Insert reattach commands (audio first)
-        lines.insert(insert_index, f"virsh nodedev-reattach {pci_vga}\n")
-        lines.insert(insert_index, f"virsh nodedev-reattach {pci_audio}\n")
-        lines.insert(insert_index, f"\n#Re-Bind GPU to Nvidia Driver\n")
+        #Insert reattach commands (audio and the other functions first, the GPU last)
+        reattach_lines = ["\n#Re-Bind GPU to Nvidia Driver\n" if label == "GPU" else f"\n#Give the {label} back to the host\n"]
+        for pci_id in reversed(pci_ids):
+            reattach_lines += vfio_reattach_lines(pci_id)
+        lines[insert_index:insert_index] = reattach_lines
 
         with open(revert_sh_path, "w") as file:
             file.writelines(lines)
 
-        print(f"Updated {revert_sh_path} with GPU reattach commands")
+        print(f"Updated {revert_sh_path} with {label} reattach commands")
 
     except FileNotFoundError:
         print(f"{revert_sh_path} not found")
     except PermissionError:
         print(f"Permission denied while editing {revert_sh_path}")
 
-def add_gpu_passthrough_devices(vm_name):
-    """Attach GPU and audio PCI devices to a libvirt VM"""
-    vga_id, audio_id = get_gpu_pci_ids()
-
-    if not vga_id or not audio_id:
-        print("GPU or Audio PCI IDs not found. Exiting...")
-        return
-
-    conn = libvirt.open("qemu:///system")
-    if conn is None:
-        print("Failed to open libvirt connection")
+def pci_hostdev_element(pci_id):
+    """Build a managed PCI <hostdev> element for an lspci-style id (e.g. 01:00.0)"""
+    if pci_id.count(':') == 2:
+        domain, bus, slot_func = pci_id.split(':')
+    elif pci_id.count(':') == 1:
+        domain = "0000"
+        bus, slot_func = pci_id.split(':')
+    else:
+        raise ValueError(f"Unexpected PCI ID format: {pci_id}")
+
+    slot, func = slot_func.split('.')
+    hostdev = ET.Element("hostdev", {
+        "mode": "subsystem",
+        "type": "pci",
+        "managed": "yes"
+    })
+    source = ET.SubElement(hostdev, "source")
+    ET.SubElement(source, "address", {
+        "domain": f"0x{domain}",
+        "bus": f"0x{bus}",
+        "slot": f"0x{slot}",
+        "function": f"0x{func}"
+    })
+    return hostdev
+
+def _hostdev_key(address):
+    return tuple(int(address.get(attr, "0"), 16) for attr in ("domain", "bus", "slot", "function"))
+
+def gpu_hostdev_transform(root, pci_ids):
+    """Add a managed PCI hostdev for each id to the domain tree, skipping ones already attached"""
+    devices_elem = root.find("devices")
+    attached = {
+        _hostdev_key(address)
+        for address in root.findall("./devices/hostdev[@type='pci']/source/address")
+    }
+
+    added = []
+    for pci_id in pci_ids:
+        hostdev = pci_hostdev_element(pci_id)
+        key = _hostdev_key(hostdev.find("source/address"))
+        if key in attached:
+            continue
+        devices_elem.append(hostdev)
+        attached.add(key)
+        added.append(pci_id)
+    return added
+
+def add_usb_controllers(vm_name, controllers):
+    """Attach whole USB controllers as managed PCI hostdevs, detached and reattached by the hooks"""
+    pci_ids = [controller.pci.bdf for controller in controllers]
+    apply_transforms(vm_name, [partial(gpu_hostdev_transform, pci_ids=pci_ids)])
+    update_start_sh(vm_name, pci_ids, label="USB controller")
+    update_revert_sh(vm_name, pci_ids, label="USB controller")
+    print(f"Added USB controller(s) {', '.join(pci_ids)} to VM '{vm_name}' ✅")
+
+def add_gpu_passthrough_devices(vm_name, input_devices=None, grab_toggle=DEFAULT_GRAB_TOGGLE, usb_controllers=None,
+                                gpu_choice=None):
+    """
+    Attach GPU and audio PCI devices to a libvirt VM, then whole USB
+    controllers and the host keyboard and mice through evdev
+
+    Args:
+        input_devices: InputDevices to pass through, asked for when None
+        usb_controllers: UsbControllers to pass through, asked for when None
+        gpu_choice: PCI address or 'boot_vga' of the GPU, asked for when None
+    """
+    pci_ids = get_gpu_pci_ids(gpu_choice)
+
+    if not pci_ids:
+        print("GPU PCI IDs not found. Exiting...")
         return
 
     try:
-        dom = conn.lookupByName(vm_name)
-        xml = dom.XMLDesc()
-        tree = ET.fromstring(xml)
-
-        devices_elem = tree.find("devices")
-
-        def pci_hostdev_element(pci_id):
-            if pci_id.count(':') == 2:
-                domain, bus, slot_func = pci_id.split(':')
-            elif pci_id.count(':') == 1:
-                domain = "0000"
-                bus, slot_func = pci_id.split(':')
-            else:
-                raise ValueError(f"Unexpected PCI ID format: {pci_id}")
-
-            slot, func = slot_func.split('.')
-            return ET.Element("hostdev", {
-                "mode": "subsystem",
-                "type": "pci",
-                "managed": "yes"
-            }), {
-                "domain": f"0x{domain}",
-                "bus": f"0x{bus}",
-                "slot": f"0x{slot}",
-                "function": f"0x{func}"
-            }
-    
-        for pci_id in [vga_id, audio_id]:
-            hostdev, address_attrs = pci_hostdev_element(pci_id)
-            source = ET.SubElement(hostdev, "source")
-            ET.SubElement(source, "address", address_attrs)
-            devices_elem.append(hostdev)
-
-        new_xml = ET.tostring(tree).decode()
-        conn.defineXML(new_xml)
+        #Older NVIDIA drivers need the hypervisor hidden once the card is passed through, AMD and Intel don't
+        gpu = select_gpu(choice=gpu_choice)
+        apply_transforms(vm_name, [
+            partial(gpu_hostdev_transform, pci_ids=pci_ids),
+            partial(apply_latency_profile, hide_kvm=gpu is not None and gpu.vendor == VENDOR_NVIDIA),
+        ])
         print(f"Added GPU passthrough devices to VM '{vm_name}' ✅")
-        print("⚠️  Note ⚠️ : Lastly you need to passthrough your USB devices")
-        print("To do this open up Virt-manager, " \
-        "\n      ➡️  Open the windows VM"
-        "\n      ➡️  Open the tab show virtual hardware details"
-        "\n      ➡️  Click add hardware"
-        "\n      ➡️  Open USB Host Device"
-        "\n      ➡️  Click the device you want to be passed through"
-        "\n      ➡️  Click finish")
+        check_vm_latency_profile(vm_name)
+        if usb_controllers is None:
+            usb_controllers = prompt_usb_controllers()
+        if usb_controllers:
+            add_usb_controllers(vm_name, usb_controllers)
+        passed_through = [controller.pci.bdf for controller in usb_controllers]
+        if input_devices is None:
+            print("Keyboard and mouse go to the VM through evdev, no USB passthrough needed")
+            input_devices, grab_toggle = prompt_input_devices(exclude_pci=passed_through)
+        else:
+            #QEMU can't open event nodes that disappear when their controller moves to vfio-pci
+            input_devices = without_passed_through(input_devices, passed_through)
+        if input_devices:
+            setup_evdev_input(vm_name, input_devices, grab_toggle)
+        elif not usb_controllers:
+            print("⚠️  Note ⚠️ : No keyboard or mouse was passed through. Add them as USB host devices in virt-manager")
 
     except libvirt.libvirtError as e:
         print(f"Libvirt error: {RED}{e}{RESET}")
-    finally:
-        conn.close()
\ No newline at end of file
@@ -0,0 +1,240 @@
+import os
+import re
+from dataclasses import dataclass, field
+
+IMAGES_PATH = "/var/lib/libvirt/images"
+
+def _path(root, *parts):
+    """Join a sysfs/procfs path onto a (possibly fake) root"""
+    return os.path.join(root, *[p.lstrip("/") for p in parts])
+
+def _read(path, default=None):
+    try:
+        with open(path, "r") as f:
+            return f.read().strip()
+    except OSError:
+        return default
+
+def parse_cpu_list(text):
+    """Expand a kernel cpu list such as '0-3,8,10-11' into a sorted list of ints"""
+    cpus = set()
+    if not text:
+        return []
+    for chunk in text.strip().split(","):
+        chunk = chunk.strip()
+        if not chunk:
+            continue
+        if "-" in chunk:
+            start, end = chunk.split("-", 1)
+            cpus.update(range(int(start), int(end) + 1))
+        else:
+            cpus.add(int(chunk))
+    return sorted(cpus)
+
+def format_cpu_list(cpus):
+    """Compress a list of ints into the kernel cpu list format ('0-3,8')"""
+    cpus = sorted(set(cpus))
+    ranges = []
+    for cpu in cpus:
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(str(a) if a == b else f"{a}-{b}" for a, b in ranges)
+
+@dataclass
+class CpuCore:
+    """A physical core and the logical CPUs (SMT siblings) that belong to it"""
+    package_id: int
+    core_id: int
+    cpus: list
+    l3_id: int = None
+    numa_node: int = None
+
+@dataclass
+class CacheDomain:
+    """A set of logical CPUs sharing one L3 cache (a CCX/CCD on AMD)"""
+    id: int
+    cpus: list
+    size_kb: int = None
+
+@dataclass
+class NumaNode:
+    id: int
+    cpus: list
+    total_mb: int = None
+    free_mb: int = None
+
+@dataclass
+class HostTopology:
+    cores: list = field(default_factory=list)
+    l3_domains: list = field(default_factory=list)
+    numa_nodes: list = field(default_factory=list)
+    total_memory_mb: int = None
+    available_memory_mb: int = None
+    images_path: str = IMAGES_PATH
+    free_disk_bytes: int = None
+
+    @property
+    def sockets(self):
+        return len({core.package_id for core in self.cores}) or None
+
+    @property
+    def cores_per_socket(self):
+        if not self.cores:
+            return None
+        per_package = {}
+        for core in self.cores:
+            per_package[core.package_id] = per_package.get(core.package_id, 0) + 1
+        return max(per_package.values())
+
+    @property
+    def threads_per_core(self):
+        return max((len(core.cpus) for core in self.cores), default=None)
+
+    @property
+    def logical_cpus(self):
+        return sorted(cpu for core in self.cores for cpu in core.cpus)
+
+    @property
+    def free_disk_gb(self):
+        if self.free_disk_bytes is None:
+            return None
+        return round(self.free_disk_bytes / 1024**3, 1)
+
+    def core_of(self, cpu):
+        """Return the CpuCore a logical CPU belongs to"""
+        for core in self.cores:
+            if cpu in core.cpus:
+                return core
+        return None
+
+def read_l3_domains(root="/"):
+    """Group logical CPUs by the L3 cache they share"""
+    cpu_dir = _path(root, "sys/devices/system/cpu")
+    online = parse_cpu_list(_read(os.path.join(cpu_dir, "online"), ""))
+    domains = {}
+    for cpu in online:
+        cache_dir = os.path.join(cpu_dir, f"cpu{cpu}", "cache")
+        if not os.path.isdir(cache_dir):
+            continue
+        for index in sorted(os.listdir(cache_dir)):
+            if not index.startswith("index"):
+                continue
+            index_dir = os.path.join(cache_dir, index)
+            if _read(os.path.join(index_dir, "level")) != "3":
+                continue
+            shared = tuple(parse_cpu_list(_read(os.path.join(index_dir, "shared_cpu_list"), "")))
+            if shared and shared not in domains:
+                size = _read(os.path.join(index_dir, "size"), "")
+                match = re.match(r"(\d+)([KMG]?)", size)
+                size_kb = None
+                if match:
+                    size_kb = int(match.group(1)) * {"": 1, "K": 1, "M": 1024, "G": 1024**2}[match.group(2)]
+                cache_id = _read(os.path.join(index_dir, "id"))
+                domains[shared] = (int(cache_id) if cache_id is not None else len(domains), size_kb)
+    return [CacheDomain(id=cache_id, cpus=list(cpus), size_kb=size_kb)
+            for cpus, (cache_id, size_kb) in sorted(domains.items(), key=lambda d: d[1][0])]
+
+def read_numa_nodes(root="/"):
+    """Read NUMA node CPU lists and per-node memory from sysfs"""
+    node_dir = _path(root, "sys/devices/system/node")
+    nodes = []
+    if not os.path.isdir(node_dir):
+        return nodes
+    for entry in os.listdir(node_dir):
+        match = re.fullmatch(r"node(\d+)", entry)
+        if not match:
+            continue
+        node_id = int(match.group(1))
+        cpus = parse_cpu_list(_read(os.path.join(node_dir, entry, "cpulist"), ""))
+        total_mb = free_mb = None
+        meminfo = _read(os.path.join(node_dir, entry, "meminfo"), "")
+        for line in meminfo.splitlines():
+            #Lines look like: "Node 0 MemTotal:       32768000 kB"
+            parts = line.split()
+            if len(parts) >= 4 and parts[2] == "MemTotal:":
+                total_mb = int(parts[3]) // 1024
+            elif len(parts) >= 4 and parts[2] == "MemFree:":
+                free_mb = int(parts[3]) // 1024
+        nodes.append(NumaNode(id=node_id, cpus=cpus, total_mb=total_mb, free_mb=free_mb))
+    return sorted(nodes, key=lambda n: n.id)
+
+def read_cpu_topology(root="/", l3_domains=None, numa_nodes=None):
+    """Build the list of physical cores from /sys/devices/system/cpu/*/topology"""
+    cpu_dir = _path(root, "sys/devices/system/cpu")
+    online = parse_cpu_list(_read(os.path.join(cpu_dir, "online"), ""))
+    if l3_domains is None:
+        l3_domains = read_l3_domains(root)
+    if numa_nodes is None:
+        numa_nodes = read_numa_nodes(root)
+
+    cores = {}
+    for cpu in online:
+        topo_dir = os.path.join(cpu_dir, f"cpu{cpu}", "topology")
+        package_id = int(_read(os.path.join(topo_dir, "physical_package_id"), "0"))
+        core_id = int(_read(os.path.join(topo_dir, "core_id"), str(cpu)))
+        key = (package_id, core_id)
+        if key in cores:
+            continue
+        #core_cpus_list replaced thread_siblings_list in newer kernels
+        siblings = _read(os.path.join(topo_dir, "core_cpus_list"))
+        if siblings is None:
+            siblings = _read(os.path.join(topo_dir, "thread_siblings_list"), str(cpu))
+        siblings = [c for c in parse_cpu_list(siblings) if c in online]
+        l3_id = next((d.id for d in l3_domains if cpu in d.cpus), None)
+        numa_node = next((n.id for n in numa_nodes if cpu in n.cpus), None)
+        cores[key] = CpuCore(package_id=package_id, core_id=core_id, cpus=siblings,
+                             l3_id=l3_id, numa_node=numa_node)
+
+    return sorted(cores.values(), key=lambda c: c.cpus[0])
+
+def read_meminfo(root="/"):
+    """Return (total_mb, available_mb) from /proc/meminfo"""
+    total = available = None
+    meminfo = _read(_path(root, "proc/meminfo"), "")
+    for line in meminfo.splitlines():
+        parts = line.split()
+        if len(parts) < 2:
+            continue
+        if parts[0] == "MemTotal:":
+            total = int(parts[1]) // 1024
+        elif parts[0] == "MemAvailable:":
+            available = int(parts[1]) // 1024
+    return total, available
+
+def get_free_bytes(path, root="/"):
+    """Exact free bytes available to unprivileged writers on the filesystem holding path"""
+    target = _path(root, path)
+    #The images pool may not exist yet, so fall back to the nearest existing parent
+    while not os.path.exists(target):
+        parent = os.path.dirname(target)
+        if parent == target:
+            break
+        target = parent
+    st = os.statvfs(target)
+    return st.f_bavail * st.f_frsize
+
+def probe_host(root="/", images_path=IMAGES_PATH):
+    """Probe CPU topology, memory and images pool free space without forking"""
+    l3_domains = read_l3_domains(root)
+    numa_nodes = read_numa_nodes(root)
+    cores = read_cpu_topology(root, l3_domains, numa_nodes)
+    total_mb, available_mb = read_meminfo(root)
+    return HostTopology(
+        cores=cores,
+        l3_domains=l3_domains,
+        numa_nodes=numa_nodes,
+        total_memory_mb=total_mb,
+        available_memory_mb=available_mb,
+        images_path=images_path,
+        free_disk_bytes=get_free_bytes(images_path, root),
+    )
+
+def read_cpu_flags(root="/"):
+    """Return the set of CPU feature flags of the first processor in /proc/cpuinfo"""
+    cpuinfo = _read(_path(root, "proc/cpuinfo"), "")
+    for line in cpuinfo.splitlines():
+        if line.startswith("flags"):
+            return set(line.split(":", 1)[1].split())
+    return set()
@@ -0,0 +1,133 @@
+import json
+import os
+import xml.etree.ElementTree as ET
+
+#Supported hugepage sizes in KiB
+HUGEPAGE_SIZES = {
+    "2M": 2048,
+    "1G": 1048576,
+}
+
+HUGEPAGES_DIR = "sys/kernel/mm/hugepages"
+#Pages each VM backs its memory with, the boot reservation is their sum
+RESERVATIONS_FILE = "var/lib/single-gpu-passthrough/hugepages.json"
+DOMAIN_XML_DIR = "etc/libvirt/qemu"
+
+def pages_needed(memory_mb, size="2M"):
+    """Number of hugepages of the given size needed to back memory_mb"""
+    size_kb = HUGEPAGE_SIZES[size]
+    return -(-memory_mb * 1024 // size_kb)
+
+def _reservations_path(root="/"):
+    return os.path.join(root, RESERVATIONS_FILE)
+
+def read_reservations(root="/"):
+    """vm name -> {"size": ..., "pages": ...} of every VM that asked for hugepages"""
+    try:
+        with open(_reservations_path(root)) as f:
+            reservations = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return reservations if isinstance(reservations, dict) else {}
+
+def record_reservation(vm_name, memory_mb, size="2M", root="/"):
+    """
+    Save the VM's share of the boot reservation, replacing its earlier one.
+    VMs that are no longer defined in libvirt are dropped, the VM being
+    created isn't defined yet and is always kept
+
+    Returns:
+        The reservations after the change
+    """
+    reservations = {vm: entry for vm, entry in read_reservations(root).items()
+                    if os.path.exists(os.path.join(root, DOMAIN_XML_DIR, f"{vm}.xml"))}
+    reservations[vm_name] = {"size": size, "pages": pages_needed(memory_mb, size)}
+    path = _reservations_path(root)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(reservations, f, indent=2)
+    os.replace(path + ".tmp", path)
+    return reservations
+
+def total_kernel_params(reservations):
+    """
+    Kernel options reserving the pages of all VMs at boot, one
+    hugepagesz/hugepages pair per size. The default size is the one
+    holding the most memory
+    """
+    totals = {}
+    for entry in reservations.values():
+        if entry.get("size") in HUGEPAGE_SIZES:
+            totals[entry["size"]] = totals.get(entry["size"], 0) + int(entry.get("pages", 0))
+    if not totals:
+        return ""
+    default = max(totals, key=lambda size: (totals[size] * HUGEPAGE_SIZES[size], HUGEPAGE_SIZES[size]))
+    return " ".join([f"default_hugepagesz={default}"]
+                    + [f"hugepagesz={size} hugepages={pages}" for size, pages in totals.items()])
+
+def _pool_dir(size, root="/"):
+    return os.path.join(root, HUGEPAGES_DIR, f"hugepages-{HUGEPAGE_SIZES[size]}kB")
+
+def supported_sizes(root="/"):
+    """Hugepage sizes the running kernel exposes a pool for"""
+    return [size for size in HUGEPAGE_SIZES if os.path.isdir(_pool_dir(size, root))]
+
+def read_pool(size, root="/"):
+    """Return (total, free) pages of a hugepage pool, or (None, None) if it doesn't exist"""
+    pool = _pool_dir(size, root)
+    try:
+        with open(os.path.join(pool, "nr_hugepages")) as f:
+            total = int(f.read())
+        with open(os.path.join(pool, "free_hugepages")) as f:
+            free = int(f.read())
+    except (OSError, ValueError):
+        return None, None
+    return total, free
+
+def check_hugepages(memory_mb, size="2M", root="/"):
+    """
+    Validate that enough free hugepages exist to start the guest
+
+    Returns:
+        (ok, message)
+    """
+    needed = pages_needed(memory_mb, size)
+    total, free = read_pool(size, root)
+    if total is None:
+        return False, f"The kernel has no {size} hugepage pool (is the CPU/kernel able to use {size} pages?)"
+    if free < needed:
+        return False, f"{needed} free {size} hugepages needed but only {free} of {total} are free"
+    return True, f"{free} of {total} {size} hugepages are free, {needed} needed"
+
+def reserve_hugepages(memory_mb, size="2M", root="/"):
+    """Try to grow the pool at runtime. Fragmented memory may leave it short"""
+    total, free = read_pool(size, root)
+    if total is None:
+        return False
+    shortfall = pages_needed(memory_mb, size) - free
+    if shortfall <= 0:
+        return True
+    try:
+        with open(os.path.join(_pool_dir(size, root), "nr_hugepages"), "w") as f:
+            f.write(str(total + shortfall))
+    except OSError:
+        return False
+    return check_hugepages(memory_mb, size, root)[0]
+
+def apply_memory_backing(root, size="2M"):
+    """Back the domain's memory with locked, unshared hugepages"""
+    for old in root.findall("memoryBacking"):
+        root.remove(old)
+    backing = ET.Element("memoryBacking")
+    hugepages = ET.SubElement(backing, "hugepages")
+    ET.SubElement(hugepages, "page", {"size": str(HUGEPAGE_SIZES[size]), "unit": "KiB"})
+    ET.SubElement(backing, "nosharepages")
+    ET.SubElement(backing, "locked")
+
+    #libvirt keeps <memoryBacking> after the memory elements
+    anchor = root.find("currentMemory")
+    if anchor is None:
+        anchor = root.find("memory")
+    index = list(root).index(anchor) + 1 if anchor is not None else len(root)
+    root.insert(index, backing)
+    return root
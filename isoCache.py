@@ -0,0 +1,265 @@
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+
+from downloader import download
+from hostProbe import IMAGES_PATH
+
+BLUE = '\033[94m'
+YELLOW = '\033[93m'
+RESET = '\033[0m'
+
+CACHE_DIR = os.path.join(IMAGES_PATH, "iso-cache")
+INDEX_FILE = "index.json"
+MAX_CACHE_BYTES = 40 * 1024**3
+#A VM holds its ISOs only while libvirt still has its definition
+DOMAIN_XML_DIR = "/etc/libvirt/qemu"
+#Hash in 16MiB windows of the mapping so the GIL is released between updates
+HASH_WINDOW = 16 * 1024 * 1024
+
+_lock = threading.Lock()
+
+def hash_file(path):
+    """SHA-256 of a file, fed incrementally from a read-only memory map"""
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return sha256.hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if hasattr(mmap, "MADV_SEQUENTIAL"):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            view = memoryview(mapped)
+            try:
+                for offset in range(0, size, HASH_WINDOW):
+                    sha256.update(view[offset:offset + HASH_WINDOW])
+            finally:
+                view.release()
+    return sha256.hexdigest()
+
+def volume_id(path):
+    """Volume label from the ISO9660 primary volume descriptor (sector 16), e.g. virtio-win-0.1.262"""
+    try:
+        with open(path, "rb") as f:
+            f.seek(16 * 2048)
+            descriptor = f.read(72)
+    except OSError:
+        return None
+    if len(descriptor) < 72 or descriptor[1:6] != b"CD001":
+        return None
+    return descriptor[40:72].decode("ascii", "replace").strip() or None
+
+class IsoCache:
+    """
+    ISOs stored once under their SHA-256 (<cache>/<sha256>.iso) with an
+    index of where they came from. Paths already hashed are remembered by
+    size and mtime, so unchanged files are never read twice
+    """
+    def __init__(self, directory=CACHE_DIR, max_bytes=MAX_CACHE_BYTES, domain_xml_dir=DOMAIN_XML_DIR):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.domain_xml_dir = domain_xml_dir
+
+    def object_path(self, digest):
+        return os.path.join(self.directory, f"{digest}.iso")
+
+    @contextmanager
+    def _index(self):
+        """Load the index under a thread and file lock and write it back afterwards"""
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, INDEX_FILE)
+        with _lock, open(path + ".lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                with open(path) as f:
+                    index = json.load(f)
+            except (OSError, ValueError):
+                index = {}
+            index.setdefault("objects", {})
+            index.setdefault("paths", {})
+            yield index
+            tmp = path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(index, f, indent=2)
+            os.replace(tmp, path)
+
+    def digest(self, path):
+        """SHA-256 of path, reusing the recorded one when size and mtime are unchanged"""
+        path = os.path.realpath(path)
+        st = os.stat(path)
+        with self._index() as index:
+            known = index["paths"].get(path)
+            if known and known["size"] == st.st_size and known["mtime"] == st.st_mtime_ns:
+                return known["sha256"]
+
+        digest = hash_file(path)
+        with self._index() as index:
+            index["paths"][path] = {"size": st.st_size, "mtime": st.st_mtime_ns, "sha256": digest}
+        return digest
+
+    def _record(self, index, digest, source, kind, version):
+        obj = self.object_path(digest)
+        st = os.stat(obj)
+        entry = index["objects"].setdefault(digest, {"sources": [], "vms": []})
+        if source and source not in entry["sources"]:
+            entry["sources"].append(source)
+        entry.update({"size": st.st_size, "mtime": st.st_mtime_ns, "last_used": time.time()})
+        entry["kind"] = kind or entry.get("kind")
+        entry["version"] = version or entry.get("version") or volume_id(obj)
+        index["paths"][obj] = {"size": st.st_size, "mtime": st.st_mtime_ns, "sha256": digest}
+        return obj
+
+    def add_file(self, path, kind=None, version=None):
+        """
+        Store a local ISO in the cache (hard link when on the same filesystem,
+        copy otherwise). Returns the cached path
+        """
+        digest = self.digest(path)
+        obj = self.object_path(digest)
+        if not os.path.exists(obj):
+            tmp = obj + ".tmp"
+            try:
+                #A hard link shares the user's inode, so its permissions are left as they are
+                os.link(path, tmp)
+            except OSError:
+                print(f"Copying {path} into the ISO cache...")
+                shutil.copyfile(path, tmp)
+                os.chmod(tmp, 0o644)
+            os.replace(tmp, obj)
+        source = os.path.realpath(path)
+        with self._index() as index:
+            obj = self._record(index, digest, source if source != obj else None, kind, version)
+        self.evict(keep={digest})
+        return obj
+
+    def find_url(self, url):
+        """Cached path for a URL fetched before, if its object is still intact"""
+        with self._index() as index:
+            for digest, entry in index["objects"].items():
+                if url not in entry["sources"]:
+                    continue
+                obj = self.object_path(digest)
+                try:
+                    st = os.stat(obj)
+                except OSError:
+                    continue
+                if st.st_size == entry["size"] and st.st_mtime_ns == entry["mtime"]:
+                    entry["last_used"] = time.time()
+                    return obj
+        return None
+
+    def fetch(self, url, kind=None, version=None, expected_sha256=None):
+        """Return the cached ISO for url, downloading it only when it isn't cached yet"""
+        cached = self.find_url(url)
+        if cached:
+            print(f"Using cached {os.path.basename(url)} ({cached})")
+            return cached
+
+        os.makedirs(self.directory, exist_ok=True)
+        #A stable partial name lets an interrupted download resume on the next run
+        partial = os.path.join(self.directory, hashlib.sha256(url.encode()).hexdigest()[:16] + ".download")
+        digest = download(url, partial, expected_sha256=expected_sha256)
+        obj = self.object_path(digest)
+        if os.path.exists(obj):
+            #Same bytes were already cached from a local file
+            os.remove(partial)
+        else:
+            os.chmod(partial, 0o644)
+            os.replace(partial, obj)
+        with self._index() as index:
+            obj = self._record(index, digest, url, kind, version)
+        self.evict(keep={digest})
+        return obj
+
+    def use(self, path, vm_name):
+        """Record that a VM references a cached ISO, which also makes it most recently used"""
+        digest = os.path.splitext(os.path.basename(path))[0]
+        with self._index() as index:
+            entry = index["objects"].get(digest)
+            if entry is None:
+                return
+            entry["last_used"] = time.time()
+            if vm_name not in entry["vms"]:
+                entry["vms"].append(vm_name)
+
+    def release(self, path, vm_name):
+        """Record that a VM no longer has a cached ISO attached. Paths outside the cache are ignored"""
+        if os.path.dirname(os.path.realpath(path)) != os.path.realpath(self.directory):
+            return
+        digest = os.path.splitext(os.path.basename(path))[0]
+        with self._index() as index:
+            entry = index["objects"].get(digest)
+            if entry and vm_name in entry["vms"]:
+                entry["vms"].remove(vm_name)
+
+    def _attached(self, entry):
+        """VMs of an entry that still exist, a VM undefined without detaching its CD-ROM doesn't hold the ISO"""
+        return [vm for vm in entry["vms"] if os.path.exists(os.path.join(self.domain_xml_dir, f"{vm}.xml"))]
+
+    def entries(self, kind=None):
+        """(path, entry) of cached ISOs, most recently used first"""
+        with self._index() as index:
+            items = [(self.object_path(digest), entry) for digest, entry in index["objects"].items()
+                     if (kind is None or entry.get("kind") == kind) and os.path.exists(self.object_path(digest))]
+        return sorted(items, key=lambda item: item[1]["last_used"], reverse=True)
+
+    def evict(self, keep=()):
+        """
+        Delete least recently used ISOs until the cache fits in max_bytes. ISOs
+        a VM uses as its CD-ROM are never deleted
+        """
+        removed = []
+        with self._index() as index:
+            objects = index["objects"]
+            total = sum(entry["size"] for entry in objects.values())
+            for digest, entry in sorted(objects.items(), key=lambda item: item[1]["last_used"]):
+                if total <= self.max_bytes:
+                    break
+                entry["vms"] = self._attached(entry)
+                if digest in keep or entry["vms"]:
+                    continue
+                obj = self.object_path(digest)
+                if os.path.exists(obj):
+                    os.remove(obj)
+                total -= entry["size"]
+                removed.append(digest)
+            for digest in removed:
+                del objects[digest]
+                index["paths"] = {path: info for path, info in index["paths"].items()
+                                  if info["sha256"] != digest or not path.startswith(self.directory)}
+        for digest in removed:
+            print(f"Evicted {digest[:12]} from the ISO cache")
+        if total > self.max_bytes:
+            print(f"⚠️  Note ⚠️ : The ISO cache holds {total / 1024**3:.1f}GB, over its {self.max_bytes / 1024**3:.1f}GB "
+                  f"limit, because the rest is attached to VMs")
+        return removed
+
+def pick_cached_iso(kind, cache=None):
+    """
+    Offer the cached ISOs of a kind ('windows' or 'virtio')
+
+    Returns:
+        The chosen cached path, or None to select another file
+    """
+    cache = cache or IsoCache()
+    entries = cache.entries(kind)
+    if not entries:
+        return None
+
+    print(f"Cached {kind} ISOs:")
+    for number, (path, entry) in enumerate(entries, 1):
+        label = entry.get("version") or os.path.basename(entry["sources"][0] if entry["sources"] else path)
+        print(f"  {BLUE}{number}{RESET}) {label:<32} {entry['size'] / 1024**3:5.1f}GB  used by {len(entry['vms'])} VM(s)")
+    while True:
+        choice = input("Pick a cached ISO (Enter to select another file): ").strip()
+        if not choice:
+            return None
+        if choice.isdigit() and 1 <= int(choice) <= len(entries):
+            return entries[int(choice) - 1][0]
+        print(f"Invalid input! Enter a number from 1 to {len(entries)}")
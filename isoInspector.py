@@ -0,0 +1,368 @@
+import mmap
+import re
+import struct
+import sys
+from dataclasses import dataclass
+
+GREEN = '\033[92m'
+RED = '\033[91m'
+RESET = '\033[0m'
+
+SECTOR = 2048
+#Files larger than this are never needed for identification
+MAX_READ = 256 * 1024
+
+#UDF (ECMA-167) descriptor tag identifiers
+TAG_AVDP = 2
+TAG_PARTITION = 5
+TAG_LOGICAL_VOLUME = 6
+TAG_TERMINATING = 8
+TAG_FILE_SET = 256
+TAG_FILE_ID = 257
+TAG_FILE_ENTRY = 261
+TAG_EXTENDED_FILE_ENTRY = 266
+
+JOLIET_ESCAPES = (b"%/@", b"%/C", b"%/E")
+
+class IsoError(Exception):
+    pass
+
+class IsoImage:
+    """
+    Read-only view of an ISO9660/Joliet/UDF image through mmap. Only the
+    descriptors and directories on the way to a file are touched, so
+    identifying a multi-GB ISO reads a few kilobytes
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise IsoError(f"{path} is empty")
+        self.volume_id = None
+        self._iso_root = None
+        self._joliet = False
+        self._udf = None
+        self._read_volume_descriptors()
+        self._read_udf()
+        if self._iso_root is None and self._udf is None:
+            self.close()
+            raise IsoError(f"{path} is not an ISO9660 or UDF image")
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _sector(self, number, count=1):
+        start = number * SECTOR
+        if start + count * SECTOR > len(self._map):
+            raise IsoError(f"{self.path} is truncated (sector {number})")
+        return self._map[start:start + count * SECTOR]
+
+    #ISO9660 / Joliet
+
+    def _read_volume_descriptors(self):
+        for number in range(16, 64):
+            if (number + 1) * SECTOR > len(self._map):
+                return
+            descriptor = self._sector(number)
+            kind, ident = descriptor[0], descriptor[1:6]
+            if ident != b"CD001":
+                return
+            if kind == 255:
+                return
+            if kind == 1 and self._iso_root is None:
+                self.volume_id = descriptor[40:72].decode("ascii", "replace").strip() or None
+                self._iso_root = self._dir_record(descriptor[156:190])
+            elif kind == 2 and descriptor[88:91] in JOLIET_ESCAPES:
+                #Joliet keeps the full (UCS-2) file names, prefer it over the 8.3 ones
+                self._iso_root = self._dir_record(descriptor[156:190])
+                self._joliet = True
+
+    @staticmethod
+    def _dir_record(record):
+        return struct.unpack_from("<I", record, 2)[0], struct.unpack_from("<I", record, 10)[0]
+
+    def _iso_entries(self, extent):
+        location, size = extent
+        data = self._map[location * SECTOR:location * SECTOR + size]
+        offset, entries = 0, {}
+        while offset < len(data):
+            length = data[offset]
+            if length == 0:
+                #Records never cross a sector boundary, zero padding until the next one
+                offset = (offset // SECTOR + 1) * SECTOR
+                continue
+            record = data[offset:offset + length]
+            name_len = record[32]
+            raw = record[33:33 + name_len]
+            if raw not in (b"\x00", b"\x01"):
+                name = raw.decode("utf-16-be", "replace") if self._joliet else raw.decode("ascii", "replace")
+                name = name.split(";")[0].rstrip(".")
+                entries[name.lower()] = (name, bool(record[25] & 2), self._dir_record(record))
+            offset += length
+        return entries
+
+    #UDF
+
+    def _tag(self, data, expected=None):
+        tag_id = struct.unpack_from("<H", data, 0)[0]
+        if expected is not None and tag_id != expected:
+            raise IsoError(f"Unexpected UDF descriptor {tag_id}, wanted {expected}")
+        return tag_id
+
+    def _read_udf(self):
+        if 257 * SECTOR > len(self._map):
+            return
+        anchor = self._sector(256)
+        if struct.unpack_from("<H", anchor, 0)[0] != TAG_AVDP:
+            return
+        length, location = struct.unpack_from("<II", anchor, 16)
+
+        partition_start = block_size = fsd = None
+        for number in range(location, location + length // SECTOR):
+            descriptor = self._sector(number)
+            tag_id = self._tag(descriptor)
+            if tag_id == TAG_PARTITION:
+                partition_start = struct.unpack_from("<I", descriptor, 188)[0]
+            elif tag_id == TAG_LOGICAL_VOLUME:
+                block_size = struct.unpack_from("<I", descriptor, 212)[0]
+                fsd = self._long_ad(descriptor, 248)
+                map_count = struct.unpack_from("<I", descriptor, 268)[0]
+                maps = descriptor[440:]
+                for _ in range(map_count):
+                    if maps[0] != 1:
+                        #Type 2 maps (UDF 2.5 metadata/virtual partitions) aren't used by Windows media
+                        raise IsoError("UDF images with metadata partitions are not supported")
+                    maps = maps[maps[1]:]
+            elif tag_id == TAG_TERMINATING:
+                break
+        if partition_start is None or block_size != SECTOR or fsd is None:
+            return
+
+        self._udf = partition_start
+        file_set = self._block(fsd[1])
+        self._tag(file_set, TAG_FILE_SET)
+        self._udf_root = self._long_ad(file_set, 400)
+
+    @staticmethod
+    def _long_ad(data, offset):
+        length, block = struct.unpack_from("<II", data, offset)
+        return length & 0x3FFFFFFF, block
+
+    def _block(self, block):
+        return self._sector(self._udf + block)
+
+    def _udf_file(self, icb, limit=MAX_READ):
+        """Contents of the file whose (File or Extended) File Entry is at icb, at most limit bytes"""
+        entry = self._block(icb[1])
+        tag_id = self._tag(entry)
+        if tag_id == TAG_FILE_ENTRY:
+            ea_offset = 168
+        elif tag_id == TAG_EXTENDED_FILE_ENTRY:
+            ea_offset = 208
+        else:
+            raise IsoError(f"Unexpected UDF descriptor {tag_id} for a file entry")
+        flags = struct.unpack_from("<H", entry, 34)[0]
+        size = struct.unpack_from("<Q", entry, 56)[0]
+        ea_length, ad_length = struct.unpack_from("<II", entry, ea_offset)
+        ads = entry[ea_offset + 8 + ea_length:ea_offset + 8 + ea_length + ad_length]
+        size = min(size, limit)
+
+        allocation = flags & 7
+        if allocation == 3:
+            #Data embedded in the entry itself
+            return bytes(ads[:size])
+        step = 8 if allocation == 0 else 16
+        data = bytearray()
+        for offset in range(0, len(ads) - step + 1, step):
+            length, block = struct.unpack_from("<II", ads, offset)
+            length &= 0x3FFFFFFF
+            if length == 0:
+                break
+            start = (self._udf + block) * SECTOR
+            data += self._map[start:start + min(length, size - len(data))]
+            if len(data) >= size:
+                break
+        return bytes(data)
+
+    def _udf_entries(self, icb):
+        data = self._udf_file(icb, limit=16 * 1024 * 1024)
+        offset, entries = 0, {}
+        while offset + 38 <= len(data):
+            if struct.unpack_from("<H", data, offset)[0] != TAG_FILE_ID:
+                break
+            characteristics, name_len = data[offset + 18], data[offset + 19]
+            child = self._long_ad(data, offset + 20)
+            iu_length = struct.unpack_from("<H", data, offset + 36)[0]
+            raw = data[offset + 38 + iu_length:offset + 38 + iu_length + name_len]
+            if not characteristics & 8 and raw:
+                #OSTA compressed unicode: first byte says 8 or 16 bits per character
+                name = raw[1:].decode("latin-1") if raw[0] == 8 else raw[1:].decode("utf-16-be", "replace")
+                entries[name.lower()] = (name, bool(characteristics & 2), child)
+            offset += (38 + iu_length + name_len + 3) & ~3
+        return entries
+
+    #Path lookups
+
+    def _entries(self, node):
+        return self._udf_entries(node) if self._udf is not None else self._iso_entries(node)
+
+    def _lookup(self, path):
+        node = self._udf_root if self._udf is not None else self._iso_root
+        is_dir = True
+        for part in [p for p in path.strip("/").split("/") if p]:
+            if not is_dir:
+                return None, False
+            entry = self._entries(node).get(part.lower())
+            if entry is None:
+                return None, False
+            _, is_dir, node = entry
+        return node, is_dir
+
+    def list_dir(self, path="/"):
+        node, is_dir = self._lookup(path)
+        if node is None or not is_dir:
+            return []
+        return sorted(name for name, _, _ in self._entries(node).values())
+
+    def exists(self, path):
+        return self._lookup(path)[0] is not None
+
+    def read_file(self, path, limit=MAX_READ):
+        node, is_dir = self._lookup(path)
+        if node is None or is_dir:
+            return None
+        if self._udf is not None:
+            return self._udf_file(node, limit)
+        location, size = node
+        return bytes(self._map[location * SECTOR:location * SECTOR + min(size, limit)])
+
+@dataclass
+class WindowsIsoInfo:
+    build: int
+    arch: str
+    branch: str = None
+    volume_id: str = None
+
+    @property
+    def os_variant(self):
+        return "win11" if self.build >= 22000 else "win10"
+
+    @property
+    def tpm(self):
+        #Windows 11 setup refuses to install without TPM 2.0
+        return self.build >= 22000
+
+    @property
+    def secure_boot(self):
+        return True
+
+@dataclass
+class VirtioIsoInfo:
+    version: str = None
+    volume_id: str = None
+    has_guest_tools: bool = False
+
+def parse_idwbinfo(text):
+    """key -> value of the [BUILDINFO] section of sources/idwbinfo.txt"""
+    info = {}
+    for line in text.splitlines():
+        key, sep, value = line.partition("=")
+        if sep:
+            info[key.strip().lower()] = value.strip()
+    return info
+
+def inspect_windows_iso(path):
+    """
+    Identify a Windows install ISO
+
+    Returns:
+        WindowsIsoInfo, or None when path isn't Windows install media
+    """
+    with IsoImage(path) as iso:
+        raw = iso.read_file("sources/idwbinfo.txt")
+        if raw is None:
+            return None
+        info = parse_idwbinfo(raw.decode("utf-8-sig", "replace"))
+        build = info.get("buildbuildnum", "")
+        if not build.isdigit():
+            return None
+        return WindowsIsoInfo(build=int(build), arch=info.get("buildarch", "").lower(),
+                              branch=info.get("buildbranch"), volume_id=iso.volume_id)
+
+def inspect_virtio_iso(path):
+    """
+    Identify a virtio-win driver ISO and its release
+
+    Returns:
+        VirtioIsoInfo, or None when path isn't virtio-win media
+    """
+    with IsoImage(path) as iso:
+        root = {name.lower() for name in iso.list_dir("/")}
+        if not {"viostor", "netkvm"} <= root:
+            return None
+        version = None
+        #Labels look like virtio-win-0.1.262 (or VIRTIO_WIN_0_1_262 when mangled to d-characters)
+        match = re.search(r"(\d+)[._](\d+)[._](\d+)", iso.volume_id or "")
+        if match:
+            version = ".".join(match.groups())
+        else:
+            #Older releases don't carry the version in the label, the license file does
+            license_text = iso.read_file("virtio-win_license.txt", limit=4096)
+            match = re.search(rb"virtio-win-(\d+\.\d+\.\d+)", license_text or b"")
+            version = match.group(1).decode() if match else None
+        return VirtioIsoInfo(version=version, volume_id=iso.volume_id,
+                             has_guest_tools="virtio-win-gt-x64.msi" in root)
+
+def check_windows_iso(path):
+    """
+    Validate the ISO picked for the install before anything is defined
+
+    Returns:
+        (WindowsIsoInfo or None, error message or None)
+    """
+    try:
+        info = inspect_windows_iso(path)
+    except (OSError, IsoError) as e:
+        return None, f"{path} can't be read as an ISO: {e}"
+    if info is None:
+        return None, f"{path} is not Windows install media (no sources/idwbinfo.txt)"
+    if info.arch != "amd64":
+        return None, f"{path} is a {info.arch or 'unknown'} build, an x64 (amd64) ISO is needed"
+    if info.build < 10240:
+        return None, f"{path} is build {info.build}, only Windows 10 and 11 are supported"
+    return info, None
+
+def check_virtio_iso(path):
+    """(VirtioIsoInfo or None, error message or None) for the driver ISO"""
+    try:
+        info = inspect_virtio_iso(path)
+    except (OSError, IsoError) as e:
+        return None, f"{path} can't be read as an ISO: {e}"
+    if info is None:
+        return None, f"{path} doesn't look like the virtio-win driver ISO (no viostor/NetKVM folders)"
+    return info, None
+
+if __name__ == "__main__":
+    #Usage: python3 isoInspector.py <iso>...
+    if len(sys.argv) < 2:
+        sys.exit("Usage: python3 isoInspector.py <iso>...")
+    for iso_path in sys.argv[1:]:
+        windows, _ = check_windows_iso(iso_path)
+        virtio, _ = check_virtio_iso(iso_path)
+        if windows:
+            print(f"{iso_path}: {GREEN}Windows build {windows.build}{RESET} {windows.arch} "
+                  f"({windows.os_variant}, label {windows.volume_id})")
+        elif virtio:
+            print(f"{iso_path}: {GREEN}virtio-win {virtio.version or 'unknown version'}{RESET} (label {virtio.volume_id})")
+        else:
+            print(f"{iso_path}: {RED}not Windows or virtio-win media{RESET}")
@@ -0,0 +1,157 @@
+import os
+import re
+import struct
+import time
+
+SECTOR = 2048
+#System area (16) + primary, Joliet and terminator descriptors + four one-sector path tables
+FIRST_DIR_SECTOR = 16 + 3 + 4
+
+def _both16(value):
+    return struct.pack("<H", value) + struct.pack(">H", value)
+
+def _both32(value):
+    return struct.pack("<I", value) + struct.pack(">I", value)
+
+def _pad(text, length, joliet=False):
+    if joliet:
+        return text.ljust(length // 2).encode("utf-16-be")[:length].ljust(length, b"\x00")
+    return text.encode("ascii", "replace")[:length].ljust(length, b" ")
+
+def _record_date(stamp):
+    t = time.gmtime(stamp)
+    return bytes([t.tm_year - 1900, t.tm_mon, t.tm_mday, t.tm_hour, t.tm_min, t.tm_sec, 0])
+
+def _volume_date(stamp):
+    return time.strftime("%Y%m%d%H%M%S00", time.gmtime(stamp)).encode("ascii") + b"\x00"
+
+def _dir_record(identifier, extent, size, stamp, directory=False):
+    length = 33 + len(identifier)
+    length += length % 2
+    return (bytes([length, 0]) + _both32(extent) + _both32(size) + _record_date(stamp)
+            + bytes([2 if directory else 0, 0, 0]) + _both16(1) + bytes([len(identifier)])
+            + identifier).ljust(length, b"\x00")
+
+def iso9660_name(name, taken):
+    """
+    Level 1 (8.3, upper case d-characters) name for the primary directory,
+    the Joliet directory keeps the real one. autounattend.xml -> AUTOUNAT.XML;1
+    """
+    stem, _, ext = name.upper().rpartition(".") if "." in name else (name.upper(), "", "")
+    stem = re.sub(r"[^A-Z0-9_]", "_", stem)[:8] or "_"
+    ext = re.sub(r"[^A-Z0-9_]", "_", ext)[:3]
+    candidate, number = f"{stem}.{ext}", 1
+    while candidate in taken:
+        suffix = f"~{number}"
+        candidate, number = f"{stem[:8 - len(suffix)]}{suffix}.{ext}", number + 1
+    taken.add(candidate)
+    return candidate + ";1"
+
+def _directory(entries, self_extent, sectors, stamp):
+    """Directory extent for the root: '.', '..' and entries, no record crossing a sector"""
+    data = bytearray()
+    records = [_dir_record(b"\x00", self_extent, sectors * SECTOR, stamp, True),
+               _dir_record(b"\x01", self_extent, sectors * SECTOR, stamp, True)]
+    records += [_dir_record(identifier, extent, size, stamp) for identifier, extent, size in entries]
+    for record in records:
+        if len(data) % SECTOR + len(record) > SECTOR:
+            data += b"\x00" * (SECTOR - len(data) % SECTOR)
+        data += record
+    return bytes(data).ljust(sectors * SECTOR, b"\x00")
+
+def _directory_sectors(entries):
+    used, sectors = 34 * 2, 1
+    for identifier, _, _ in entries:
+        length = 33 + len(identifier) + (33 + len(identifier)) % 2
+        if used + length > SECTOR:
+            sectors, used = sectors + 1, 0
+        used += length
+    return sectors
+
+def _path_table(extent, big_endian=False):
+    return bytes([1, 0]) + struct.pack(">I" if big_endian else "<I", extent) + struct.pack(
+        ">H" if big_endian else "<H", 1) + b"\x00\x00"
+
+def _volume_descriptor(kind, volume_id, total, root_record, path_tables, stamp, joliet=False):
+    descriptor = bytearray(SECTOR)
+    descriptor[0] = kind
+    descriptor[1:7] = b"CD001\x01"
+    descriptor[8:40] = _pad("LINUX", 32, joliet)
+    descriptor[40:72] = _pad(volume_id, 32, joliet)
+    descriptor[80:88] = _both32(total)
+    if joliet:
+        #UCS-2 level 3
+        descriptor[88:91] = b"%/E"
+    descriptor[120:124] = _both16(1)
+    descriptor[124:128] = _both16(1)
+    descriptor[128:132] = _both16(SECTOR)
+    descriptor[132:140] = _both32(10)
+    descriptor[140:144] = struct.pack("<I", path_tables)
+    descriptor[148:152] = struct.pack(">I", path_tables + 1)
+    descriptor[156:190] = root_record
+    for offset, length in ((190, 128), (318, 128), (446, 128), (574, 128), (702, 37), (739, 37), (776, 37)):
+        descriptor[offset:offset + length] = _pad("", length, joliet)
+    descriptor[813:830] = _volume_date(stamp)
+    descriptor[830:847] = _volume_date(stamp)
+    descriptor[847:864] = b"0" * 16 + b"\x00"
+    descriptor[864:881] = b"0" * 16 + b"\x00"
+    descriptor[881] = 1
+    return bytes(descriptor)
+
+def write_iso(path, files, volume_id="CDROM"):
+    """
+    Write a small ISO9660 image with Joliet names holding files in its root
+    directory, enough for answer files and scripts that Windows looks for
+    on removable media
+
+    Args:
+        path: where to write the image
+        files: {name: bytes}
+        volume_id: volume label (d-characters, up to 32)
+
+    Returns:
+        Size of the image in bytes
+    """
+    stamp = time.time()
+    volume_id = re.sub(r"[^A-Z0-9_]", "_", volume_id.upper())[:32]
+    taken = set()
+    names = [(name, iso9660_name(name, taken), data) for name, data in files.items()]
+
+    primary = sorted((short.encode("ascii"), name) for name, short, _ in names)
+    joliet = sorted(((name[:64] + ";1").encode("utf-16-be"), name) for name, _, _ in names)
+    primary_sectors = _directory_sectors([(identifier, 0, 0) for identifier, _ in primary])
+    joliet_sectors = _directory_sectors([(identifier, 0, 0) for identifier, _ in joliet])
+
+    primary_root = FIRST_DIR_SECTOR
+    joliet_root = primary_root + primary_sectors
+    extent = joliet_root + joliet_sectors
+    extents = {}
+    for name, _, data in names:
+        extents[name] = (extent, len(data))
+        extent += max(1, -(-len(data) // SECTOR))
+    total = extent
+
+    with open(path, "wb") as f:
+        f.write(b"\x00" * 16 * SECTOR)
+        f.write(_volume_descriptor(1, volume_id, total,
+                                   _dir_record(b"\x00", primary_root, primary_sectors * SECTOR, stamp, True),
+                                   19, stamp))
+        f.write(_volume_descriptor(2, volume_id[:16], total,
+                                   _dir_record(b"\x00", joliet_root, joliet_sectors * SECTOR, stamp, True),
+                                   21, stamp, joliet=True))
+        terminator = bytearray(SECTOR)
+        terminator[0:7] = b"\xffCD001\x01"
+        f.write(terminator)
+        for root_extent in (primary_root, joliet_root):
+            f.write(_path_table(root_extent).ljust(SECTOR, b"\x00"))
+            f.write(_path_table(root_extent, big_endian=True).ljust(SECTOR, b"\x00"))
+        f.write(_directory([(identifier, *extents[name]) for identifier, name in primary],
+                           primary_root, primary_sectors, stamp))
+        f.write(_directory([(identifier, *extents[name]) for identifier, name in joliet],
+                           joliet_root, joliet_sectors, stamp))
+        for name, _, data in names:
+            f.write(data)
+            f.write(b"\x00" * (-len(data) % SECTOR or (0 if data else SECTOR)))
+        size = f.tell()
+    os.chmod(path, 0o644)
+    return size
@@ -1,10 +1,14 @@
 import subprocess
+import shutil
 import os
 import sys
 import tty
 import termios
 import json
 
+from hostProbe import probe_host, parse_cpu_list, format_cpu_list
+from coreIsolation import isolation_kernel_params
+
 RED = '\033[91m'   
 RESET = '\033[0m'
 BLUE = '\033[94m'
@@ -179,40 +183,162 @@ def initramfsKernelBootChanges():
     subprocess.run(["update-initramfs", "-u"])
     print("Initramfs regeneration complete")
 
-def grubChanges():
+def getIommuOption():
+    """Returns the IOMMU kernel options for the host CPU vendor"""
     isAMD, isIntel = checkCPU()
-
     if isAMD:
         print("AMD CPU detected. Setting kernel options...")
-        command = [
-            "sed", "-i", 
-            '/^GRUB_CMDLINE_LINUX="/ s/"$/ amd_iommu=on iommu=pt"/', 
-            "/etc/sysconfig/grub"
-        ]
-        subprocess.run(command, check=True)
+        return "amd_iommu=on iommu=pt"
     elif isIntel:
         print("Intel CPU detected. Setting kernel options...")
-        command = [
-            "sed", "-i", 
-            '/^GRUB_CMDLINE_LINUX="/ s/"$/ intel_iommu=on iommu=pt"/', 
-            "/etc/sysconfig/grub"
-        ]
-        subprocess.run(command, check=True)
-    else:
+        return "intel_iommu=on iommu=pt"
+    return None
+
+#CPU lists several VMs share: the isolated CPUs of all of them are joined, IRQs stay on the CPUs none of them use
+CPU_UNION_OPTIONS = ("isolcpus", "nohz_full", "rcu_nocbs")
+CPU_INTERSECT_OPTIONS = ("irqaffinity",)
+
+def _splitCpuOption(value):
+    """'managed_irq,domain,2-5' -> (['managed_irq', 'domain'], {2, 3, 4, 5})"""
+    items = value.split(",")
+    flags = [item for item in items if item and not item[0].isdigit()]
+    return flags, set(parse_cpu_list(",".join(item for item in items if item not in flags)))
+
+def mergeCpuOption(option, old_values):
+    """
+    Join a CPU list option with the values already on the command line,
+    so one VM's isolation doesn't undo another's. Values that aren't CPU
+    lists are left to the new option
+    """
+    key, _, value = option.partition("=")
+    if key not in CPU_UNION_OPTIONS + CPU_INTERSECT_OPTIONS:
+        return option
+    try:
+        flags, cpus = _splitCpuOption(value)
+        for old in old_values:
+            old_flags, old_cpus = _splitCpuOption(old)
+            if key in CPU_UNION_OPTIONS:
+                flags += [flag for flag in old_flags if flag not in flags]
+                cpus |= old_cpus
+            else:
+                cpus &= old_cpus
+    except ValueError:
+        return option
+    if not cpus:
+        #Nothing left for the host's IRQs, the new VM's value at least keeps them off its own CPUs
+        return option
+    return f"{key}=" + ",".join(flags + [format_cpu_list(cpus)])
+
+def mergeKernelOptions(cmdline, options):
+    """
+    Add options to a kernel command line. Every token of a key that is in
+    options (e.g. hugepages=) is replaced by the new ones instead of
+    duplicating it, so repeated keys like hugepagesz=2M hugepagesz=1G work.
+    CPU lists (isolcpus=, nohz_full=, ...) are joined with the existing ones
+    """
+    new = options.split()
+    keys = {option.split("=", 1)[0] for option in new}
+    old_values = {}
+    tokens = []
+    for token in cmdline.split():
+        key, _, value = token.partition("=")
+        if key in keys:
+            old_values.setdefault(key, []).append(value)
+        else:
+            tokens.append(token)
+    return " ".join(tokens + [mergeCpuOption(option, old_values.get(option.split("=", 1)[0], [])) for option in new])
+
+#Debian, Ubuntu, Mint and openSUSE keep the GRUB settings in /etc/default/grub, old Fedora in /etc/sysconfig/grub
+GRUB_DEFAULTS = ("/etc/default/grub", "/etc/sysconfig/grub")
+
+def grubConfigCommand():
+    """The command that regenerates grub.cfg from the defaults file on this distro"""
+    if shutil.which("update-grub"):
+        return ["update-grub"]
+    if shutil.which("grub2-mkconfig"):
+        output = "/boot/grub2/grub.cfg" if os.path.isdir("/boot/grub2") else "/etc/grub2.cfg"
+        return ["grub2-mkconfig", "-o", output]
+    return ["grub-mkconfig", "-o", "/boot/grub/grub.cfg"]
+
+def grubChanges(options=None):
+    if options is None:
+        options = getIommuOption()
+
+    if not options:
         print("Unknown CPU vendor. Skipping kernel options")
-    subprocess.run(["grub2-mkconfig", "-o", "/etc/grub2.cfg"])
+        return
+    grub_path = next((path for path in GRUB_DEFAULTS if os.path.exists(path)), None)
+    if grub_path is None:
+        raise FileNotFoundError(f"No GRUB defaults file, looked for {' and '.join(GRUB_DEFAULTS)}")
 
-def popChanges():
-    isAMD, isIntel = checkCPU()
-    if isAMD:
-        print("AMD CPU detected. Setting kernel options...")
-        subprocess.run(["kernelstub", "--add-options", "amd_iommu=on iommu=pt"])
-    elif isIntel:
-        print("Intel CPU detected. Setting kernel options...")
-        subprocess.run(["kernelstub", "--add-options", "intel_iommu=on iommu=pt"])
+    with open(grub_path, "r") as f:
+        lines = f.readlines()
+
+    found = False
+    for i, line in enumerate(lines):
+        if line.startswith('GRUB_CMDLINE_LINUX="'):
+            cmdline = line.strip()[len('GRUB_CMDLINE_LINUX="'):-1]
+            lines[i] = f'GRUB_CMDLINE_LINUX="{mergeKernelOptions(cmdline, options)}"\n'
+            found = True
+    if not found:
+        lines.append(f'GRUB_CMDLINE_LINUX="{options}"\n')
+
+    with open(grub_path, "w") as f:
+        f.writelines(lines)
+    subprocess.run(grubConfigCommand(), check=True)
+
+def kernelstubOptions(config_path="/etc/kernelstub/configuration"):
+    """Kernel options kernelstub currently writes, from its config or else the running command line"""
+    try:
+        with open(config_path) as f:
+            return json.load(f)["user"]["kernel_options"]
+    except (OSError, ValueError, KeyError, TypeError):
+        with open("/proc/cmdline") as f:
+            return f.read().split()
+
+def replaceOptions(current, options):
+    """
+    For boot tools that add and remove options rather than rewrite the
+    command line: merge options into the current ones
+
+    Returns:
+        (options to remove, options to add)
+    """
+    keys = {option.split("=", 1)[0] for option in options.split()}
+    merged = mergeKernelOptions(" ".join(current), options).split()
+    add = [option for option in merged if option.split("=", 1)[0] in keys]
+    #All of them, a key given twice (hugepagesz=) can't be updated one value at a time
+    stale = [option for option in current if option.split("=", 1)[0] in keys]
+    return stale, add
+
+def popChanges(options=None):
+    if options is None:
+        options = getIommuOption()
+
+    if options:
+        #--add-options only appends, a second isolcpus= or hugepages= would sit next to the old one
+        stale, add = replaceOptions(kernelstubOptions(), options)
+        if stale:
+            subprocess.run(["kernelstub", "--remove-options", " ".join(stale)])
+        subprocess.run(["kernelstub", "--add-options", " ".join(add)])
     else:
         print("Unknown CPU vendor. Skipping kernel options")
 
+def grubbyOptions():
+    """Kernel options of the default boot entry"""
+    output = subprocess.check_output(["grubby", "--info=DEFAULT"], text=True)
+    for line in output.splitlines():
+        if line.startswith("args="):
+            return line[len("args="):].strip().strip('"').split()
+    return []
+
+def grubbyChanges(options):
+    """Add kernel options to every installed kernel with grubby (Fedora)"""
+    stale, add = replaceOptions(grubbyOptions(), options)
+    if stale:
+        subprocess.run(["grubby", "--update-kernel=ALL", f"--remove-args={' '.join(stale)}"], check=True)
+    subprocess.run(["grubby", "--update-kernel=ALL", f"--args={' '.join(add)}"], check=True)
+
 def dracutKernelBootChanges():
     command = [
         "bash", "-c", 
@@ -225,13 +351,10 @@ def dracutKernelBootChanges():
     ]
     subprocess.run(command, check=True)
 
-def sysChanges():
-    isAMD, isIntel = checkCPU()
-    iommu_option = None
-    if isAMD:
-        iommu_option = "amd_iommu=on iommu=pt"
-    elif isIntel:
-        iommu_option = "intel_iommu=on iommu=pt"
+def sysChanges(options=None):
+    iommu_option = options
+    if iommu_option is None:
+        iommu_option = getIommuOption()
 
     if not iommu_option:
         print("Unknown CPU vendor. Skipping kernel option modification")
@@ -271,17 +394,18 @@ def sysChanges():
     modified = False
     for line in lines:
         if line.startswith("options"):
-            if iommu_option not in line:
-                line = line.strip() + f" {iommu_option}\n"
+            merged = "options " + mergeKernelOptions(line[len("options"):], iommu_option) + "\n"
+            if merged.split() != line.split():
+                line = merged
                 modified = True
         new_lines.append(line)
 
     if modified:
         with open(matched_entry, "w") as f:
             f.writelines(new_lines)
-        print("IOMMU kernel options added successfully")
+        print("Kernel options added successfully")
     else:
-        print("IOMMU options already present. No changes made")
+        print("Kernel options already present. No changes made")
 
 def show_bootloader_menu(options, title):
     """
@@ -367,34 +491,56 @@ def show_reboot_menu():
             print("\n\nExiting...")
             sys.exit(0)
 
-def kernelBootChanges_no_prompt(distro):
+def kernelBootChanges_no_prompt(distro, kernel_params=None, isolated_cpus=None):
+    """
+    Apply the IOMMU boot changes for the distro. When kernel_params is given
+    only those options are written through the same bootloader path and the
+    initramfs is left alone
+
+    Args:
+        isolated_cpus: Host CPUs to take away from the host at boot (latency
+                       profile: isolcpus, nohz_full, rcu_nocbs, irqaffinity)
+    """
+    initramfs = kernel_params is None
+    if isolated_cpus:
+        isolation = isolation_kernel_params(probe_host(), isolated_cpus)
+        print(f"Latency profile kernel options: {BLUE}{isolation}{RESET}")
+        kernel_params = " ".join(filter(None, [getIommuOption() if initramfs else kernel_params, isolation]))
     if distro == "pop":
         print("Pop!_OS detected!")
-        popChanges()
-        initramfsKernelBootChanges()
+        popChanges(kernel_params)
+        if initramfs:
+            initramfsKernelBootChanges()
     elif distro == "fedora":
         print("Fedora detected!")
         # grubChanges() # This seems to target /etc/sysconfig/grub which is for legacy systems
-        dracutKernelBootChanges() # This is correct for modern Fedora
+        if initramfs:
+            dracutKernelBootChanges() # This is correct for modern Fedora
+        if kernel_params:
+            grubbyChanges(kernel_params)
     elif distro == "debian":
         print("Debian detected!")
-        grubChanges()
-        initramfsKernelBootChanges()
+        grubChanges(kernel_params)
+        if initramfs:
+            initramfsKernelBootChanges()
     elif distro == "linuxmint":
         print("Linux Mint detected!")
-        grubChanges()
-        initramfsKernelBootChanges()
+        grubChanges(kernel_params)
+        if initramfs:
+            initramfsKernelBootChanges()
     elif distro == "opensuse":
         print("openSUSE detected!")
-        grubChanges()
-        dracutKernelBootChanges()
+        grubChanges(kernel_params)
+        if initramfs:
+            dracutKernelBootChanges()
     elif distro == "ubuntu":
         print("Ubuntu detected!")
-        grubChanges()
-        initramfsKernelBootChanges()
+        grubChanges(kernel_params)
+        if initramfs:
+            initramfsKernelBootChanges()
     elif distro == "arch":
         print("Arch Linux detected!")
-        sysChanges()
+        sysChanges(kernel_params)
         #initramfsKernelBootChanges()
     else:
         manualSet = False
@@ -420,10 +566,14 @@ def kernelBootChanges_no_prompt(distro):
             manualSet = True
         elif selected_bootloader == "grub":
             print("\nConfiguring GRUB bootloader...")
-            grubChanges()
+            grubChanges(kernel_params)
         elif selected_bootloader == "systemd-boot":
             print("\nConfiguring systemd-boot...")
-            sysChanges()
+            sysChanges(kernel_params)
+
+        if not initramfs:
+            print("\nKernel options will take effect after a reboot")
+            return
         
         # Now prompt for initramfs system
         initramfs_options = [
@@ -0,0 +1,114 @@
+import time
+import xml.etree.ElementTree as ET
+from contextlib import contextmanager
+import libvirt
+
+DEFAULT_URI = "qemu:///system"
+
+@contextmanager
+def connection(conn=None, uri=DEFAULT_URI):
+    """Use the given connection, or open one to uri for the duration of the block"""
+    if conn is not None:
+        yield conn
+        return
+
+    conn = libvirt.open(uri)
+    if conn is None:
+        raise libvirt.libvirtError(f"Failed to open connection to {uri}")
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+def _affect_flags(dom, persistent=True, live=None):
+    """Build VIR_DOMAIN_AFFECT_* flags. live=None means 'live if the domain is running'"""
+    if live is None:
+        live = bool(dom.isActive())
+    flags = 0
+    if persistent:
+        flags |= libvirt.VIR_DOMAIN_AFFECT_CONFIG
+    if live:
+        flags |= libvirt.VIR_DOMAIN_AFFECT_LIVE
+    return flags
+
+def start_domain(vm_name, conn=None, uri=DEFAULT_URI):
+    """In-process equivalent of 'virsh start'. Returns False if it was already running"""
+    with connection(conn, uri) as conn:
+        dom = conn.lookupByName(vm_name)
+        if dom.isActive():
+            return False
+        dom.create()
+        return True
+
+def wait_for_shutoff(vm_name, timeout, interval=5, conn=None, uri=DEFAULT_URI):
+    """Poll until the domain has powered itself off. Returns False on timeout"""
+    deadline = time.monotonic() + timeout
+    with connection(conn, uri) as conn:
+        dom = conn.lookupByName(vm_name)
+        while dom.isActive():
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(interval)
+    return True
+
+def send_key(vm_name, keycodes, hold_ms=50, conn=None, uri=DEFAULT_URI):
+    """In-process equivalent of 'virsh send-key' with Linux keycodes (e.g. 28 = Enter)"""
+    with connection(conn, uri) as conn:
+        dom = conn.lookupByName(vm_name)
+        dom.sendKey(libvirt.VIR_KEYCODE_SET_LINUX, hold_ms, list(keycodes), len(keycodes), 0)
+
+def attach_device(vm_name, device_xml, persistent=True, live=None, conn=None, uri=DEFAULT_URI):
+    """Attach a device described by XML to the domain config and/or live domain"""
+    with connection(conn, uri) as conn:
+        dom = conn.lookupByName(vm_name)
+        dom.attachDeviceFlags(device_xml, _affect_flags(dom, persistent, live))
+
+def disk_xml(source, target_dev, bus="virtio", device="disk", driver_type=None, readonly=False):
+    """Build a file-backed <disk> element the way 'virsh attach-disk' would"""
+    disk = ET.Element("disk", {"type": "file", "device": device})
+    driver = ET.SubElement(disk, "driver", {"name": "qemu"})
+    if driver_type is None:
+        driver_type = "qcow2" if source.endswith(".qcow2") else "raw"
+    driver.set("type", driver_type)
+    ET.SubElement(disk, "source", {"file": source})
+    ET.SubElement(disk, "target", {"dev": target_dev, "bus": bus})
+    if readonly:
+        ET.SubElement(disk, "readonly")
+    return ET.tostring(disk, encoding="unicode")
+
+def attach_disk(vm_name, source, target_dev, bus="virtio", device="disk", readonly=False,
+                persistent=True, live=None, conn=None, uri=DEFAULT_URI):
+    """In-process equivalent of 'virsh attach-disk'"""
+    xml = disk_xml(source, target_dev, bus=bus, device=device, readonly=readonly)
+    attach_device(vm_name, xml, persistent=persistent, live=live, conn=conn, uri=uri)
+
+def list_block_devices(vm_name, conn=None, uri=DEFAULT_URI):
+    """
+    In-process equivalent of 'virsh domblklist'
+
+    Returns:
+        List of (target dev, source) tuples. Source is None for empty drives
+    """
+    with connection(conn, uri) as conn:
+        dom = conn.lookupByName(vm_name)
+        root = ET.fromstring(dom.XMLDesc(0))
+    devices = []
+    for disk in root.findall("./devices/disk"):
+        target = disk.find("target")
+        if target is None:
+            continue
+        source = disk.find("source")
+        path = None
+        if source is not None:
+            path = source.get("file") or source.get("dev") or source.get("name") or source.get("volume")
+        devices.append((target.get("dev"), path))
+    return devices
+
+def start_network(name="default", autostart=True, conn=None, uri=DEFAULT_URI):
+    """In-process equivalent of 'virsh net-start' and 'virsh net-autostart'"""
+    with connection(conn, uri) as conn:
+        network = conn.networkLookupByName(name)
+        if not network.isActive():
+            network.create()
+        if autostart and not network.autostart():
+            network.setAutostart(1)
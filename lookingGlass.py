@@ -0,0 +1,225 @@
+import os
+import re
+import subprocess
+import xml.etree.ElementTree as ET
+import libvirt
+
+from domainXml import apply_transforms, print_diff
+
+GREEN = '\033[92m'
+RED = '\033[91m'
+YELLOW = '\033[93m'
+RESET = '\033[0m'
+
+QEMU_NS = "http://libvirt.org/schemas/domain/qemu/1.0"
+
+#shm: a file in /dev/shm shared with the client. kvmfr: the kvmfr kernel module's
+#DMA-capable device, which also lets the client import frames straight into the host GPU
+SHMEM_MODES = ("shm", "kvmfr")
+SHMEM_NAME = "looking-glass"
+SHM_PATH = "dev/shm/looking-glass"
+KVMFR_DEVICE = "/dev/kvmfr0"
+
+TMPFILES_CONF = "etc/tmpfiles.d/10-looking-glass.conf"
+KVMFR_MODPROBE_CONF = "etc/modprobe.d/kvmfr.conf"
+KVMFR_MODULES_CONF = "etc/modules-load.d/kvmfr.conf"
+KVMFR_UDEV_RULE = "etc/udev/rules.d/99-kvmfr.rules"
+QEMU_CONF = "etc/libvirt/qemu.conf"
+
+#libvirt's default cgroup_device_acl, kvmfr0 has to be appended to it
+DEFAULT_DEVICE_ACL = ["/dev/null", "/dev/full", "/dev/zero", "/dev/random", "/dev/urandom",
+                      "/dev/ptmx", "/dev/kvm", "/dev/userfaultfd"]
+
+def parse_resolution(text):
+    """'2560x1440' -> (2560, 1440)"""
+    match = re.fullmatch(r"\s*(\d+)\s*[xX]\s*(\d+)\s*", text or "")
+    if not match:
+        raise ValueError(f"Resolution must look like 1920x1080, got '{text}'")
+    return int(match.group(1)), int(match.group(2))
+
+def ivshmem_size_mb(width, height, hdr=False):
+    """
+    Shared memory needed for a resolution: two frames (4 bytes per pixel,
+    8 with HDR) plus 10MB for the cursor and headers, rounded up to the
+    power of two IVSHMEM requires. 1920x1080 -> 32, 3840x2160 -> 128
+    """
+    frame_bytes = width * height * (8 if hdr else 4)
+    needed_mb = frame_bytes * 2 / 1024**2 + 10
+    size = 1
+    while size < needed_mb:
+        size *= 2
+    return size
+
+def shmem_element(size_mb):
+    shmem = ET.Element("shmem", {"name": SHMEM_NAME})
+    ET.SubElement(shmem, "model", {"type": "ivshmem-plain"})
+    size = ET.SubElement(shmem, "size", {"unit": "M"})
+    size.text = str(size_mb)
+    return shmem
+
+def kvmfr_commandline(root, size_mb):
+    """qemu:commandline args backing an ivshmem-plain device with the kvmfr device"""
+    ET.register_namespace("qemu", QEMU_NS)
+    for old in root.findall(f"{{{QEMU_NS}}}commandline"):
+        root.remove(old)
+    commandline = ET.SubElement(root, f"{{{QEMU_NS}}}commandline")
+    for arg in ("-device", f"{{\"driver\":\"ivshmem-plain\",\"id\":\"shmem0\",\"memdev\":\"{SHMEM_NAME}\"}}",
+                "-object", f"{{\"qom-type\":\"memory-backend-file\",\"id\":\"{SHMEM_NAME}\","
+                           f"\"mem-path\":\"{KVMFR_DEVICE}\",\"size\":{size_mb * 1024**2},\"share\":true}}"):
+        ET.SubElement(commandline, f"{{{QEMU_NS}}}arg", {"value": arg})
+    return commandline
+
+def looking_glass_transform(root, size_mb, mode="shm"):
+    """
+    Add the IVSHMEM device for Looking Glass to the domain tree. Once a PCI
+    GPU is attached the VNC/SPICE displays and the emulated video card are
+    dropped, so the passed-through GPU is the guest's only display
+
+    Returns:
+        List of what was removed
+    """
+    devices = root.find("devices")
+    for old in devices.findall(f"shmem[@name='{SHMEM_NAME}']"):
+        devices.remove(old)
+    if mode == "kvmfr":
+        kvmfr_commandline(root, size_mb)
+    else:
+        devices.append(shmem_element(size_mb))
+
+    removed = []
+    if root.find("./devices/hostdev[@type='pci']") is None:
+        print("⚠️  Note ⚠️ : No GPU is attached yet, the emulated display is kept until it is")
+        return removed
+
+    for graphics in devices.findall("graphics"):
+        devices.remove(graphics)
+        removed.append(f"{graphics.get('type')} graphics")
+    for video in devices.findall("video"):
+        model = video.find("model")
+        if model is not None and model.get("type") != "none":
+            removed.append(f"{model.get('type')} video")
+        devices.remove(video)
+    video = ET.SubElement(devices, "video")
+    ET.SubElement(video, "model", {"type": "none"})
+
+    #Ballooning fights the fixed shared memory mapping
+    for balloon in devices.findall("memballoon"):
+        balloon.set("model", "none")
+    return removed
+
+def tmpfiles_rule(user, group="kvm"):
+    """systemd-tmpfiles line creating the shm file for the VM and the client user"""
+    return f"f /{SHM_PATH} 0660 {user} {group} -\n"
+
+def kvmfr_udev_rule(user, group="kvm"):
+    return f'SUBSYSTEM=="kvmfr", OWNER="{user}", GROUP="{group}", MODE="0660"\n'
+
+def _write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(text)
+
+def allow_kvmfr_device(root="/"):
+    """
+    Add the kvmfr device to cgroup_device_acl in qemu.conf
+
+    Returns:
+        True if qemu.conf was changed (libvirtd needs a restart)
+    """
+    path = os.path.join(root, QEMU_CONF)
+    try:
+        with open(path) as f:
+            text = f.read()
+    except FileNotFoundError:
+        text = ""
+
+    match = re.search(r"^cgroup_device_acl\s*=\s*\[(.*?)\]", text, re.M | re.S)
+    if match:
+        if KVMFR_DEVICE in match.group(1):
+            return False
+        entries = match.group(1).rstrip().rstrip(",")
+        text = text[:match.start(1)] + f"{entries},\n    \"{KVMFR_DEVICE}\"\n" + text[match.end(1):]
+    else:
+        devices = ",\n    ".join(f'"{device}"' for device in DEFAULT_DEVICE_ACL + [KVMFR_DEVICE])
+        text += f"\n#Added for Looking Glass (kvmfr)\ncgroup_device_acl = [\n    {devices}\n]\n"
+    _write(path, text)
+    return True
+
+def configure_host(mode, size_mb, user, root="/"):
+    """
+    Give the client user access to the shared memory across reboots
+
+    Returns:
+        List of files written
+    """
+    written = []
+    if mode == "kvmfr":
+        _write(os.path.join(root, KVMFR_MODPROBE_CONF), f"options kvmfr static_size_mb={size_mb}\n")
+        _write(os.path.join(root, KVMFR_MODULES_CONF), "kvmfr\n")
+        _write(os.path.join(root, KVMFR_UDEV_RULE), kvmfr_udev_rule(user))
+        written += [KVMFR_MODPROBE_CONF, KVMFR_MODULES_CONF, KVMFR_UDEV_RULE]
+        if allow_kvmfr_device(root):
+            written.append(QEMU_CONF)
+    else:
+        _write(os.path.join(root, TMPFILES_CONF), tmpfiles_rule(user))
+        written.append(TMPFILES_CONF)
+    return [os.path.join(root, path) for path in written]
+
+def prompt_looking_glass():
+    """
+    Ask whether to use Looking Glass instead of VNC
+
+    Returns:
+        (width, height, mode) or None
+    """
+    use_lg = input("Use Looking Glass (shared memory) instead of VNC for the display (y/N)? ").strip().lower()
+    if use_lg not in ("yes", "y"):
+        return None
+
+    while True:
+        try:
+            width, height = parse_resolution(input(f"Guest resolution (Default {YELLOW}1920x1080{RESET}): ") or "1920x1080")
+            break
+        except ValueError as e:
+            print(e)
+    mode = input(f"Shared memory backend {'/'.join(SHMEM_MODES)} (Default {YELLOW}shm{RESET}): ").strip().lower() or "shm"
+    if mode not in SHMEM_MODES:
+        print(f"Unknown backend '{mode}', using shm")
+        mode = "shm"
+    return width, height, mode
+
+def setup_looking_glass(vm_name, width, height, mode="shm", hdr=False, user=None, restart=True):
+    """
+    Size the IVSHMEM region for the resolution, set up the host side and redefine the VM
+
+    Args:
+        restart: Restart libvirtd for the kvmfr device ACL. Spec mode does it once after all VMs
+    """
+    user = user or os.environ.get("SUDO_USER") or "root"
+    size_mb = ivshmem_size_mb(width, height, hdr)
+    print(f"Looking Glass at {width}x{height} needs {YELLOW}{size_mb}MB{RESET} of shared memory ({mode})")
+
+    try:
+        diff = apply_transforms(vm_name, [lambda root: looking_glass_transform(root, size_mb, mode)])
+    except libvirt.libvirtError as e:
+        print(f"🚨 Failed to add the IVSHMEM device to {vm_name} 🚨: {RED}{e}{RESET}")
+        return False
+    if diff:
+        print_diff(diff)
+
+    for path in configure_host(mode, size_mb, user):
+        print(f"Wrote {path}")
+    if mode == "kvmfr":
+        result = subprocess.run(["modprobe", "kvmfr", f"static_size_mb={size_mb}"], capture_output=True, text=True)
+        if result.returncode != 0:
+            print(f"⚠️  Note ⚠️ : kvmfr couldn't be loaded ({result.stderr.strip()}). Install the "
+                  "looking-glass kvmfr module (DKMS) and reboot")
+        #cgroup_device_acl is only read when libvirtd starts
+        if restart:
+            subprocess.run(["systemctl", "restart", "libvirtd"])
+    else:
+        subprocess.run(["systemd-tmpfiles", "--create", os.path.join("/", TMPFILES_CONF)])
+
+    print(f"Looking Glass is set up for {vm_name} ✅ Install the host application in Windows and "
+          f"run looking-glass-client as {user}")
+    return True
@@ -1,5 +1,6 @@
 import threading
 import sys
+import argparse
 import json
 import os
 import io
@@ -8,29 +9,41 @@ import tty
 import termios
 
 from kernelUpdates import installations, kernelBootChanges_no_prompt
-from vmCreation import get_sys_info, create_vm, modify_storage_bus, update_display_to_vnc, cleanupDrives
+from vmCreation import (get_sys_info, create_vm, modify_storage_bus, update_display_to_vnc, cleanupDrives,
+                        finalize_vm_devices, detect_gpu_numa_node, HOST_LOCK)
+from hostProbe import probe_host
+from libvirtOps import start_domain, wait_for_shutoff
+from vmSpec import load_specs, spec_to_config, storage_profile, unattend_config, reserve_defined_cpus
+from unattend import install_unattended, UNATTEND_TIMEOUT_MIN
+from vmBatch import run_batch
+from goldenImage import prompt_seal, prompt_clone, prompt_flatten, prompt_rebase, show_templates
+from lookingGlass import prompt_looking_glass, setup_looking_glass, parse_resolution
+from evdevInput import resolve_input_devices, DEFAULT_GRAB_TOGGLE
+from usbControllers import resolve_usb_controllers
+from hookTimings import prompt_report
 from getISO import ensure_libvirt_access, virtioDrivers
-from hooks import setup_libvirt_hooks, update_start_sh, update_revert_sh, add_gpu_passthrough_devices
+from hooks import (setup_libvirt_hooks, install_hook_dispatcher, restart_libvirt_service, update_start_sh,
+                   update_revert_sh, add_gpu_passthrough_devices)
 from moving import main_moving
 
 PROGRESS_FILE = "progress.json"
 
-def saveProgress(choice, step, data=None):
+def saveProgress(choice, step, data=None, path=PROGRESS_FILE):
     progress = {"choice": choice, "step": step}
     if data:
         progress["data"] = data
-    with open(PROGRESS_FILE, "w") as f:
+    with open(path, "w") as f:
         json.dump(progress, f)
 
-def loadProgress():
-    if os.path.exists(PROGRESS_FILE):
-        with open(PROGRESS_FILE, "r") as f:
+def loadProgress(path=PROGRESS_FILE):
+    if os.path.exists(path):
+        with open(path, "r") as f:
             return json.load(f)
     return None
 
-def clearProgress():
-    if os.path.exists(PROGRESS_FILE):
-        os.remove(PROGRESS_FILE)
+def clearProgress(path=PROGRESS_FILE):
+    if os.path.exists(path):
+        os.remove(path)
 
 def get_distro():
     """Get the current distribution from /etc/os-release"""
@@ -107,8 +120,10 @@ def show_menu(options, title="Menu"):
             sys.exit(0)
 
 class Api:
-    def __init__(self):
+    def __init__(self, progress_file=PROGRESS_FILE):
         self.distro = get_distro()
+        #Batch runs give every VM its own progress file
+        self.progress_file = progress_file
 
     def _run_in_thread(self, target, args=()):
         thread = threading.Thread(target=target, args=args)
@@ -150,7 +165,7 @@ class Api:
         self._run_in_thread(self._execute_choice_1)
 
     def _execute_choice_1(self):
-        saveProgress(1, 1)
+        saveProgress(1, 1, path=self.progress_file)
         self.log_message("Starting Step 1: Preparing Host System...")
         
         # Test message to verify logging is working
@@ -160,7 +175,7 @@ class Api:
         try:
             self._log_and_run(installations, self.distro)
             self.log_message("DEBUG: Installations completed")
-            saveProgress(1, 2)
+            saveProgress(1, 2, path=self.progress_file)
         except Exception as e:
             self.log_message(f"ERROR in installations: {e}")
             return
@@ -169,7 +184,7 @@ class Api:
         try:
             self._log_and_run(kernelBootChanges_no_prompt, self.distro)
             self.log_message("DEBUG: Kernel boot changes completed")
-            saveProgress(1, 3)
+            saveProgress(1, 3, path=self.progress_file)
         except Exception as e:
             self.log_message(f"ERROR in kernelBootChanges_no_prompt: {e}")
             return
@@ -177,107 +192,192 @@ class Api:
         self.log_message("\nHost preparation complete. A reboot is required")
         self.log_message("You can reboot from your system menu, or run 'sudo reboot' in a terminal")
         self.log_message("After rebooting, please run this application again and choose option 2")
-        saveProgress(1, "complete")
+        saveProgress(1, "complete", path=self.progress_file)
 
     def start_choice_2(self):
         self._execute_choice_2()
 
-    def _execute_choice_2(self):
-        saveProgress(2, 1)
+    def _execute_choice_2(self, spec=None):
+        """
+        Create the VM and set up GPU passthrough. With a VmSpec nothing is
+        asked: the spec answers every prompt and a rerun picks up from the
+        VM's saved progress
+
+        Returns:
+            True once the VM is fully set up
+        """
+        progress = loadProgress(self.progress_file) if spec else None
+        if progress and progress.get("choice") == 2 and progress.get("step", 0) >= 5:
+            vm_name = progress.get("data", {}).get("vm_name", spec.name)
+            self.log_message(f"Resuming {vm_name} from step {progress['step']}...")
+            return self._finish_spec_vm(spec, vm_name, progress["step"])
+
+        saveProgress(2, 1, path=self.progress_file)
         self.log_message("Starting Step 2: Creating VM and Setting Up GPU Passthrough...")
         
         self.log_message("\n--- Getting System Information ---")
         try:
             sys_info = get_sys_info()
-            saveProgress(2, 2, {"sys_info": sys_info})
+            saveProgress(2, 2, {"sys_info": sys_info}, path=self.progress_file)
             self.log_message(f"System info gathered: {sys_info}")
         except Exception as e:
             self.log_message(f"ERROR getting system info: {e}")
-            return
+            return False
         
         self.log_message("\n--- Ensuring Libvirt Access ---")
         try:
             ensure_libvirt_access("/var/lib/libvirt/images/")
-            saveProgress(2, 3)
+            saveProgress(2, 3, path=self.progress_file)
         except Exception as e:
             self.log_message(f"ERROR ensuring libvirt access: {e}")
-            return
+            return False
 
         self.log_message("\n--- Creating VM ---")
         try:
-            vm_name = create_vm(self.distro)
-            saveProgress(2, 5, {"vm_name": vm_name})
+            if spec:
+                host = probe_host()
+                numa_node = detect_gpu_numa_node(host, spec.gpu) if spec.numa else None
+                vm_name = create_vm(self.distro, spec_to_config(spec, host, numa_node), spec.virtio_iso,
+                                    unattend_config(spec))
+            else:
+                vm_name = create_vm(self.distro)
+            if not vm_name:
+                return False
+            saveProgress(2, 5, {"vm_name": vm_name}, path=self.progress_file)
             self.log_message(f"VM created: {vm_name}")
         except Exception as e:
             self.log_message(f"ERROR creating VM: {e}")
-            return
-        
-        self.log_message("\n--- Modifying Storage Bus ---")
-        try:
-            modify_storage_bus(vm_name)
-            saveProgress(2, 6)
-        except Exception as e:
-            self.log_message(f"ERROR modifying storage bus: {e}")
-            return
+            return False
+
+        if spec:
+            return self._finish_spec_vm(spec, vm_name, 5)
         
-        self.log_message("\n--- Updating Display to VNC ---")
+        self.log_message("\n--- Modifying Storage Bus, Updating Display to VNC & Cleaning Up Drives ---")
         try:
-            update_display_to_vnc(vm_name, self.distro)
-            saveProgress(2, 7)
+            if not finalize_vm_devices(vm_name, self.distro):
+                return False
+            saveProgress(2, 8, {"vm_name": vm_name}, path=self.progress_file)
         except Exception as e:
-            self.log_message(f"ERROR updating display: {e}")
-            return
-        
-        self.log_message("\n--- Cleaning Up Drives ---")
-        try:
-            cleanupDrives(vm_name)
-            saveProgress(2, 8)
-        except Exception as e:
-            self.log_message(f"ERROR cleaning up drives: {e}")
-            return
+            self.log_message(f"ERROR updating VM devices: {e}")
+            return False
         
+        return self._setup_passthrough(vm_name)
+
+    def _finish_spec_vm(self, spec, vm_name, step):
+        """Windows install, device finalization and passthrough for a spec VM from a saved step"""
+        if step < 8:
+            self.log_message("\n--- Installing Windows ---")
+            if not spec.install_timeout_min and not spec.unattend:
+                self.log_message(f"Install Windows and the VirtIO drivers in '{vm_name}', shut it down and run the spec again")
+                return False
+            try:
+                if spec.unattend:
+                    #The answer file powers the VM off once the drivers are in
+                    if not install_unattended(vm_name, spec.install_timeout_min or UNATTEND_TIMEOUT_MIN):
+                        return False
+                else:
+                    start_domain(vm_name)
+                    self.log_message(f"Waiting up to {spec.install_timeout_min} minutes for '{vm_name}' to power off...")
+                    if not wait_for_shutoff(vm_name, spec.install_timeout_min * 60):
+                        self.log_message(f"ERROR: '{vm_name}' was still running after {spec.install_timeout_min} minutes")
+                        return False
+            except Exception as e:
+                self.log_message(f"ERROR waiting for the Windows install: {e}")
+                return False
+
+            self.log_message("\n--- Modifying Storage Bus, Updating Display to VNC & Cleaning Up Drives ---")
+            try:
+                if not finalize_vm_devices(vm_name, self.distro, storage_profile(spec) or False, spec.vnc_password):
+                    return False
+                saveProgress(2, 8, {"vm_name": vm_name}, path=self.progress_file)
+            except Exception as e:
+                self.log_message(f"ERROR updating VM devices: {e}")
+                return False
+
+        if not spec.gpu_passthrough:
+            self.log_message(f"\n=== '{vm_name}' is ready (GPU passthrough skipped) ===")
+            clearProgress(self.progress_file)
+            return True
+        display = False
+        if spec.display == "looking-glass":
+            display = (*parse_resolution(spec.resolution), spec.shmem_mode)
+        usb_controllers = resolve_usb_controllers(spec.usb_controllers or [])
+        input_devices = resolve_input_devices(spec.input_devices or [],
+                                              exclude_pci=[controller.pci.bdf for controller in usb_controllers])
+        return self._setup_passthrough(vm_name, display, input_devices, spec.grab_toggle, usb_controllers, spec.gpu,
+                                       restart_libvirt=False)
+
+    def _setup_passthrough(self, vm_name, display=None, input_devices=None, grab_toggle=DEFAULT_GRAB_TOGGLE,
+                           usb_controllers=None, gpu_choice=None, restart_libvirt=True):
+        """
+        Hooks, hook scripts, GPU hostdevs and the display (steps 8 to 13 of choice 2)
+
+        Args:
+            display: (width, height, mode) for Looking Glass, False to keep VNC, None to ask
+            input_devices: evdev keyboards/mice for the VM, None to ask
+            usb_controllers: whole USB controllers for the VM, None to ask
+            gpu_choice: PCI address or 'boot_vga' of the GPU, None to ask
+            restart_libvirt: Install the hook script and restart libvirtd here. Spec mode
+                             does both around the worker pool, a restart would break the
+                             libvirt connections of the other workers
+        """
         self.log_message("\n--- Setting Up Libvirt Hooks ---")
         try:
-            setup_libvirt_hooks()
-            saveProgress(2, 9)
+            setup_libvirt_hooks(vm_name, dispatcher=restart_libvirt)
+            saveProgress(2, 9, {"vm_name": vm_name}, path=self.progress_file)
         except Exception as e:
             self.log_message(f"ERROR setting up hooks: {e}")
-            return
+            return False
         
         self.log_message("\n--- Updating start.sh Script ---")
         try:
-            update_start_sh(vm_name)
-            saveProgress(2, 10)
+            update_start_sh(vm_name, gpu_choice=gpu_choice)
+            saveProgress(2, 10, {"vm_name": vm_name}, path=self.progress_file)
         except Exception as e:
             self.log_message(f"ERROR updating start.sh: {e}")
-            return
+            return False
         
         self.log_message("\n--- Updating revert.sh Script ---")
         try:
-            update_revert_sh(vm_name)
-            saveProgress(2, 11)
+            update_revert_sh(vm_name, gpu_choice=gpu_choice)
+            saveProgress(2, 11, {"vm_name": vm_name}, path=self.progress_file)
         except Exception as e:
             self.log_message(f"ERROR updating revert.sh: {e}")
-            return
+            return False
         
         self.log_message("\n--- Adding GPU Passthrough Devices ---")
         try:
-            add_gpu_passthrough_devices(vm_name)
-            saveProgress(2, 12)
+            add_gpu_passthrough_devices(vm_name, input_devices, grab_toggle, usb_controllers, gpu_choice)
+            saveProgress(2, 12, {"vm_name": vm_name}, path=self.progress_file)
         except Exception as e:
             self.log_message(f"ERROR adding GPU passthrough: {e}")
-            return
+            return False
+
+        if display is None:
+            display = prompt_looking_glass()
+        if display:
+            self.log_message("\n--- Setting Up Looking Glass ---")
+            try:
+                #Host config files and (for kvmfr) a libvirtd restart are shared by all VMs
+                with HOST_LOCK:
+                    if not setup_looking_glass(vm_name, *display, restart=restart_libvirt):
+                        return False
+                saveProgress(2, 13, {"vm_name": vm_name}, path=self.progress_file)
+            except Exception as e:
+                self.log_message(f"ERROR setting up Looking Glass: {e}")
+                return False
         
         self.log_message("\n=== VM Setup Complete! ===")
         self.log_message(f"Your VM '{vm_name}' is ready with GPU passthrough configured")
-        clearProgress()
+        clearProgress(self.progress_file)
+        return True
 
     def start_choice_3(self):
         self._run_in_thread(self._execute_choice_3)
 
     def _execute_choice_3(self):
         self.log_message("Checking for saved progress...")
-        progress = loadProgress()
+        progress = loadProgress(self.progress_file)
         
         if not progress:
             self.log_message("No saved progress found. Please start from the beginning")
@@ -303,10 +403,11 @@ class Api:
                 self._execute_choice_2()
             elif step == 5:
                 self.log_message(f"Resuming with VM: {vm_name}")
-                self.log_message("\n--- Modifying Storage Bus ---")
-                modify_storage_bus(vm_name)
-                saveProgress(2, 6)
-                self._continue_choice_2_from_step_6(vm_name)
+                self.log_message("\n--- Modifying Storage Bus, Updating Display to VNC & Cleaning Up Drives ---")
+                if not finalize_vm_devices(vm_name, self.distro):
+                    return
+                saveProgress(2, 8, {"vm_name": vm_name}, path=self.progress_file)
+                self._continue_choice_2_from_step_8(vm_name)
             else:
                 self.log_message(f"Resuming from step {step}...")
                 self._continue_choice_2_from_step(vm_name, step)
@@ -315,36 +416,23 @@ class Api:
         """Continue choice 2 from step 6 onwards"""
         self.log_message("\n--- Updating Display to VNC ---")
         update_display_to_vnc(vm_name, self.distro)
-        saveProgress(2, 7)
+        saveProgress(2, 7, {"vm_name": vm_name}, path=self.progress_file)
         
         self.log_message("\n--- Cleaning Up Drives ---")
         cleanupDrives(vm_name)
-        saveProgress(2, 8)
-        
-        self.log_message("\n--- Setting Up Libvirt Hooks ---")
-        setup_libvirt_hooks()
-        saveProgress(2, 9)
-        
-        self.log_message("\n--- Updating start.sh Script ---")
-        update_start_sh(vm_name)
-        saveProgress(2, 10)
-        
-        self.log_message("\n--- Updating revert.sh Script ---")
-        update_revert_sh(vm_name)
-        saveProgress(2, 11)
-        
-        self.log_message("\n--- Adding GPU Passthrough Devices ---")
-        add_gpu_passthrough_devices(vm_name)
-        saveProgress(2, 12)
-        
-        self.log_message("\n=== VM Setup Complete! ===")
-        self.log_message(f"Your VM '{vm_name}' is ready with GPU passthrough configured")
-        clearProgress()
+        saveProgress(2, 8, {"vm_name": vm_name}, path=self.progress_file)
+        self._continue_choice_2_from_step_8(vm_name)
+
+    def _continue_choice_2_from_step_8(self, vm_name):
+        """Continue choice 2 from step 8 onwards"""
+        return self._setup_passthrough(vm_name)
 
     def _continue_choice_2_from_step(self, vm_name, step):
         """Continue from any step in choice 2"""
         # This is a simplified version - expand as needed
-        if step >= 6:
+        if step >= 8:
+            self._continue_choice_2_from_step_8(vm_name)
+        elif step >= 6:
             self._continue_choice_2_from_step_6(vm_name)
 
     def start_choice_4(self):
@@ -379,7 +467,10 @@ class Api:
                 vm_name = create_vm(self.distro)
                 input("\nPress Enter to continue...")
             elif selection == "4":
-                #TODO
+                vm_name = input("VM name: ").strip()
+                if vm_name:
+                    device = input("Move the disk onto a block device too (e.g. /dev/nvme1n1, Enter to keep the image): ").strip()
+                    modify_storage_bus(vm_name, block_device=device or None)
                 input("\nPress Enter to continue...")
             elif selection == "5":
                 #TODO
@@ -406,6 +497,35 @@ class Api:
         """Execute choice 5 - Moving VMs (runs synchronously for interactive menu)"""
         main_moving()
 
+    def start_choice_6(self):
+        """Execute choice 6 - Golden image templates and overlay clones (runs synchronously for interactive menu)"""
+        while True:
+            template_options = [
+                ("Seal an installed VM into a template", "1"),
+                ("Clone a new VM from a template", "2"),
+                ("Flatten a VM's disk (detach it from its template)", "3"),
+                ("Rebase a VM onto another template", "4"),
+                ("List templates", "5"),
+                ("Back to Main Menu", "back")
+            ]
+
+            selection = show_menu(template_options, title="VM Templates")
+            print("\033[2J\033[H", end="", flush=True)
+
+            if selection == "1":
+                prompt_seal()
+            elif selection == "2":
+                prompt_clone()
+            elif selection == "3":
+                prompt_flatten()
+            elif selection == "4":
+                prompt_rebase()
+            elif selection == "5":
+                show_templates()
+            elif selection == "back":
+                break
+            input("\nPress Enter to continue...")
+
 def run_terminal_mode():
     """Run the application in terminal mode"""
     api = Api()
@@ -422,7 +542,9 @@ def run_terminal_mode():
             ("Resume Previous Setup", "3"),
             ("Custom Functions --- (Advanced)", "4"),
             ("Moving VMs", "5"),
-            ("Exit", "6")
+            ("VM Templates (Golden Images)", "6"),
+            ("Hook Timings Report", "7"),
+            ("Exit", "8")
         ]
         
         choice = show_menu(menu_options)
@@ -449,8 +571,49 @@ def run_terminal_mode():
             api.start_choice_5()
             time.sleep(1)
         elif choice == "6":
+            api.start_choice_6()
+            time.sleep(1)
+        elif choice == "7":
+            prompt_report()
+            input("\nPress Enter to continue...")
+        elif choice == "8":
             print("Exiting...")
             break
 
+def run_spec_mode(spec_path, workers=None):
+    """Provision the VM(s) of a JSON/TOML spec file without any prompts"""
+    if os.geteuid() != 0:
+        print("Root privileges are required. Please run with sudo")
+        sys.exit(1)
+
+    try:
+        options = load_specs(spec_path)
+    except (OSError, ValueError) as e:
+        print(f"🚨 Error 🚨 reading {spec_path}: {e}")
+        sys.exit(1)
+    if workers:
+        options.workers = workers
+    if len(options.vms) > 1:
+        reserve_defined_cpus(options.vms)
+
+    #Restarting libvirtd drops every open connection, so the workers never do it themselves
+    if any(spec.gpu_passthrough for spec in options.vms) and not install_hook_dispatcher():
+        sys.exit(1)
+
+    results = run_batch(options, lambda spec, progress_file: Api(progress_file)._execute_choice_2(spec))
+    #qemu.conf got the kvmfr device ACL, libvirtd reads it when it starts
+    if any(spec.gpu_passthrough and spec.display == "looking-glass" and spec.shmem_mode == "kvmfr"
+           for spec in options.vms):
+        restart_libvirt_service()
+    sys.exit(0 if all(ok for _, ok, _, _ in results) else 1)
+
 if __name__ == "__main__":
-    run_terminal_mode()
+    #Usage: sudo python3 main.py [--spec vms.toml [--workers N]]
+    if len(sys.argv) > 1:
+        parser = argparse.ArgumentParser(description="Single GPU passthrough VM setup")
+        parser.add_argument("--spec", required=True, help="JSON/TOML file describing the VM(s) to provision")
+        parser.add_argument("--workers", type=int, help="VMs provisioned at the same time (overrides the spec)")
+        args = parser.parse_args()
+        run_spec_mode(args.spec, args.workers)
+    else:
+        run_terminal_mode()
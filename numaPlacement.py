@@ -0,0 +1,60 @@
+import xml.etree.ElementTree as ET
+
+from hostProbe import format_cpu_list
+
+YELLOW = '\033[93m'
+RESET = '\033[0m'
+
+def find_node(host, node_id):
+    return next((node for node in host.numa_nodes if node.id == node_id), None)
+
+def check_node_memory(node, memory_mb):
+    """Return a warning string when the guest memory doesn't fit in the node's free memory"""
+    if node.free_mb is not None and memory_mb > node.free_mb:
+        return (f"⚠️  Note ⚠️ : {YELLOW}{memory_mb}MB{RESET} exceeds the {YELLOW}{node.free_mb}MB{RESET} "
+                f"free on NUMA node {node.id}. The VM may fail to start or spill onto another node")
+    return None
+
+def apply_numa_placement(root, node_id, node_cpus=None, mode="strict"):
+    """
+    Bind guest memory to one host NUMA node and expose a single matching guest cell
+
+    Args:
+        root: Parsed <domain> tree
+        node_id: Host NUMA node the GPU sits on
+        node_cpus: Host CPUs of that node, used to place unpinned vCPUs
+        mode: numatune memory mode (strict, preferred, interleave, restrictive)
+    """
+    for old in root.findall("numatune"):
+        root.remove(old)
+    numatune = ET.Element("numatune")
+    ET.SubElement(numatune, "memory", {"mode": mode, "nodeset": str(node_id)})
+    ET.SubElement(numatune, "memnode", {"cellid": "0", "mode": mode, "nodeset": str(node_id)})
+    anchor = root.find("cputune")
+    if anchor is None:
+        anchor = root.find("vcpu")
+    index = list(root).index(anchor) + 1 if anchor is not None else len(root)
+    root.insert(index, numatune)
+
+    #Without explicit pinning keep the vCPU threads on the node's CPUs
+    vcpu = root.find("vcpu")
+    if vcpu is not None and node_cpus and root.find("cputune/vcpupin") is None:
+        vcpu.set("cpuset", format_cpu_list(node_cpus))
+
+    memory = root.find("memory")
+    memory_kib = int(memory.text) * {"KiB": 1, "MiB": 1024, "GiB": 1024**2}.get(memory.get("unit", "KiB"), 1)
+    vcpus = int(vcpu.text) if vcpu is not None else 1
+
+    cpu = root.find("cpu")
+    if cpu is None:
+        cpu = ET.SubElement(root, "cpu", {"mode": "host-passthrough"})
+    for old in cpu.findall("numa"):
+        cpu.remove(old)
+    numa = ET.SubElement(cpu, "numa")
+    ET.SubElement(numa, "cell", {
+        "id": "0",
+        "cpus": f"0-{vcpus - 1}",
+        "memory": str(memory_kib),
+        "unit": "KiB",
+    })
+    return root
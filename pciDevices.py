@@ -0,0 +1,205 @@
+import os
+import threading
+from dataclasses import dataclass, field
+
+BLUE = '\033[94m'
+GREEN = '\033[92m'
+YELLOW = '\033[93m'
+RESET = '\033[0m'
+
+PCI_DEVICES = "sys/bus/pci/devices"
+
+#PCI class codes (base class and subclass) this tool cares about
+CLASS_DISPLAY = 0x03          #base class: VGA (0x0300), XGA, 3D controller (0x0302), other (0x0380)
+CLASS_VGA = 0x0300
+CLASS_3D = 0x0302
+CLASS_AUDIO = 0x0403
+CLASS_USB = 0x0c03
+
+VENDOR_NVIDIA = 0x10de
+VENDORS = {VENDOR_NVIDIA: "NVIDIA", 0x1002: "AMD", 0x1022: "AMD", 0x8086: "Intel", 0x1b21: "ASMedia", 0x1af4: "Red Hat (virtio)"}
+
+def _read(path, default=None):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return default
+
+def _link_name(path):
+    """Last component of a sysfs symlink (driver, iommu_group), None when it doesn't exist"""
+    try:
+        return os.path.basename(os.readlink(path))
+    except OSError:
+        return None
+
+@dataclass
+class PciDevice:
+    """One PCI function as sysfs describes it"""
+    bdf: str                      #0000:01:00.0
+    vendor: int
+    device: int
+    class_code: int               #24 bit: base class, subclass, programming interface
+    driver: str = None
+    iommu_group: int = None
+    numa_node: int = None
+    boot_vga: bool = False
+
+    @property
+    def class_id(self):
+        """Base class and subclass, e.g. 0x0300 for VGA"""
+        return self.class_code >> 8
+
+    @property
+    def slot(self):
+        """The card the function belongs to (0000:01:00)"""
+        return self.bdf.rsplit(".", 1)[0]
+
+    @property
+    def vendor_name(self):
+        return VENDORS.get(self.vendor, f"{self.vendor:04x}")
+
+    @property
+    def ids(self):
+        """vendor:device as lspci -nn and vfio-pci.ids= write it"""
+        return f"{self.vendor:04x}:{self.device:04x}"
+
+@dataclass
+class PciInventory:
+    """Every PCI function of the host, by BDF and by class"""
+    devices: dict = field(default_factory=dict)    #bdf -> PciDevice
+    by_class: dict = field(default_factory=dict)   #class_id -> [PciDevice]
+
+    def add(self, device):
+        self.devices[device.bdf] = device
+        self.by_class.setdefault(device.class_id, []).append(device)
+
+    def of_class(self, *class_ids):
+        return sorted((device for class_id in class_ids for device in self.by_class.get(class_id, [])),
+                      key=lambda device: device.bdf)
+
+    def gpus(self):
+        """Display controllers of any subclass (VGA, 3D controller, ...)"""
+        return sorted((device for device in self.devices.values() if device.class_id >> 8 == CLASS_DISPLAY),
+                      key=lambda device: device.bdf)
+
+    def functions_of(self, device):
+        """All functions of the card device is on (GPU, its HDMI audio, USB-C, ...), function 0 first"""
+        return sorted((other for other in self.devices.values() if other.slot == device.slot),
+                      key=lambda other: other.bdf)
+
+    def iommu_group_of(self, device):
+        """Every function sharing device's IOMMU group"""
+        if device.iommu_group is None:
+            return [device]
+        return sorted((other for other in self.devices.values() if other.iommu_group == device.iommu_group),
+                      key=lambda other: other.bdf)
+
+def read_pci_device(bdf, root="/"):
+    """PciDevice for one entry of /sys/bus/pci/devices"""
+    base = os.path.join(root, PCI_DEVICES, bdf)
+    group = _link_name(os.path.join(base, "iommu_group"))
+    numa_node = _read(os.path.join(base, "numa_node"))
+    return PciDevice(
+        bdf=bdf,
+        vendor=int(_read(os.path.join(base, "vendor"), "0"), 16),
+        device=int(_read(os.path.join(base, "device"), "0"), 16),
+        class_code=int(_read(os.path.join(base, "class"), "0"), 16),
+        driver=_link_name(os.path.join(base, "driver")),
+        iommu_group=int(group) if group and group.isdigit() else None,
+        numa_node=int(numa_node) if numa_node and int(numa_node) >= 0 else None,
+        boot_vga=_read(os.path.join(base, "boot_vga")) == "1",
+    )
+
+def scan_pci(root="/"):
+    """Read every PCI function from sysfs. Returns a PciInventory"""
+    inventory = PciInventory()
+    try:
+        entries = sorted(os.listdir(os.path.join(root, PCI_DEVICES)))
+    except OSError:
+        return inventory
+    for bdf in entries:
+        inventory.add(read_pci_device(bdf, root))
+    return inventory
+
+#Drivers change as devices move to vfio-pci, but which devices exist doesn't, so one scan per run is enough
+_inventories = {}
+_selected_gpus = {}
+#Batch workers share the choice, only one of them may ask
+_select_lock = threading.Lock()
+
+#Spec files name the GPU with this instead of an address
+BOOT_VGA = "boot_vga"
+
+def pci_inventory(root="/", refresh=False):
+    """The PciInventory of the host, scanned once per process"""
+    if refresh or root not in _inventories:
+        _inventories[root] = scan_pci(root)
+    return _inventories[root]
+
+def describe(device):
+    driver = device.driver or "no driver"
+    group = f"IOMMU group {device.iommu_group}" if device.iommu_group is not None else "no IOMMU group"
+    return f"{device.bdf} {device.vendor_name} [{device.ids}] ({driver}, {group})"
+
+def find_gpu(choice, root="/"):
+    """
+    The GPU a spec file names: a PCI address (01:00.0 or 0000:01:00.0) or
+    'boot_vga' for the one the firmware booted on. Raises ValueError
+    """
+    gpus = pci_inventory(root).gpus()
+    if not gpus:
+        raise ValueError("The host has no GPU")
+    if choice == BOOT_VGA:
+        if len(gpus) == 1:
+            return gpus[0]
+        gpu = next((gpu for gpu in gpus if gpu.boot_vga), None)
+        if gpu is None:
+            raise ValueError(f"None of the GPUs is the boot display, set gpu to one of "
+                             f"{', '.join(gpu.bdf for gpu in gpus)}")
+        return gpu
+    bdf = choice if choice.count(":") == 2 else f"0000:{choice}"
+    gpu = next((gpu for gpu in gpus if gpu.bdf == bdf), None)
+    if gpu is None:
+        raise ValueError(f"{choice} is not a GPU, the host has {', '.join(gpu.bdf for gpu in gpus)}")
+    return gpu
+
+def select_gpu(root="/", choice=None):
+    """
+    The GPU to pass through. A choice (from a spec file) is looked up without
+    asking, otherwise with several GPUs the user picks one and the pick is
+    remembered for the rest of the run
+
+    Returns:
+        PciDevice or None when the host has no GPU
+    """
+    if choice:
+        return find_gpu(choice, root)
+    with _select_lock:
+        if root in _selected_gpus:
+            return _selected_gpus[root]
+        gpus = pci_inventory(root).gpus()
+        if not gpus:
+            return None
+        if len(gpus) == 1:
+            gpu = gpus[0]
+        else:
+            #The GPU the firmware booted on is the one a single-GPU setup hands over
+            default = next((number for number, gpu in enumerate(gpus, 1) if gpu.boot_vga), 1)
+            print("Several GPUs found:")
+            for number, gpu in enumerate(gpus, 1):
+                boot = f" {YELLOW}(boot display){RESET}" if gpu.boot_vga else ""
+                print(f"  {BLUE}{number}{RESET}) {describe(gpu)}{boot}")
+            while True:
+                choice = input(f"GPU to pass through (Default {BLUE}{default}{RESET}): ").strip() or str(default)
+                if choice.isdigit() and 1 <= int(choice) <= len(gpus):
+                    break
+                print("Invalid input!")
+            gpu = gpus[int(choice) - 1]
+        _selected_gpus[root] = gpu
+        return gpu
+
+def gpu_functions(root="/", choice=None):
+    """Every function of the selected GPU's card. Empty when there is no GPU"""
+    gpu = select_gpu(root, choice)
+    return pci_inventory(root).functions_of(gpu) if gpu else []
@@ -0,0 +1,181 @@
+import os
+import struct
+
+QCOW2_MAGIC = b"QFI\xfb"
+HEADER_FORMAT = ">4sIQIIQIIQQIIQ"
+HEADER_V2_LENGTH = struct.calcsize(HEADER_FORMAT)
+HEADER_V3_LENGTH = HEADER_V2_LENGTH + 32
+DEFAULT_CLUSTER_BITS = 16
+
+#Header extension types
+EXT_END = 0
+EXT_BACKING_FORMAT = 0xE2792ACA
+
+#Feature bits
+INCOMPAT_DIRTY = 1
+INCOMPAT_CORRUPT = 2
+INCOMPAT_EXTENDED_L2 = 16
+COMPAT_LAZY_REFCOUNTS = 1
+
+class Qcow2Error(Exception):
+    pass
+
+def _round_up(value, multiple):
+    return -(-value // multiple) * multiple
+
+def read_header(path):
+    """
+    Parse the qcow2 header of path
+
+    Returns:
+        dict with version, size, cluster_bits, backing_file, backing_format,
+        incompatible_features, header_length and the other header extensions
+    """
+    with open(path, "rb") as f:
+        head = f.read(HEADER_V3_LENGTH)
+        if len(head) < HEADER_V2_LENGTH or head[:4] != QCOW2_MAGIC:
+            raise Qcow2Error(f"{path} is not a qcow2 image")
+        (_, version, backing_offset, backing_size, cluster_bits, size, crypt, l1_size, l1_offset,
+         refcount_offset, refcount_clusters, snapshots, snapshots_offset) = struct.unpack_from(HEADER_FORMAT, head)
+        header = {"version": version, "size": size, "cluster_bits": cluster_bits, "encrypted": bool(crypt),
+                  "l1_size": l1_size, "snapshots": snapshots, "incompatible_features": 0,
+                  "header_length": HEADER_V2_LENGTH, "backing_format": None, "extensions": []}
+        if version >= 3:
+            if len(head) < HEADER_V3_LENGTH:
+                raise Qcow2Error(f"{path} has a truncated header")
+            incompatible, _, _, _, header_length = struct.unpack_from(">QQQII", head, HEADER_V2_LENGTH)
+            header["incompatible_features"] = incompatible
+            header["header_length"] = header_length
+
+        #Extensions follow the header, each 8 byte aligned, until the end marker
+        offset = header["header_length"]
+        cluster_size = 1 << cluster_bits
+        f.seek(offset)
+        while offset + 8 <= cluster_size:
+            raw = f.read(8)
+            if len(raw) < 8:
+                break
+            ext_type, length = struct.unpack(">II", raw)
+            if ext_type == EXT_END:
+                break
+            data = f.read(length)
+            if ext_type == EXT_BACKING_FORMAT:
+                header["backing_format"] = data.decode("ascii", "replace")
+            else:
+                header["extensions"].append((ext_type, data))
+            offset += 8 + _round_up(length, 8)
+            f.seek(offset)
+
+        header["backing_file"] = None
+        if backing_offset:
+            f.seek(backing_offset)
+            header["backing_file"] = f.read(backing_size).decode("utf-8", "replace")
+    return header
+
+def _extensions_blob(backing_format, extensions=()):
+    blob = b""
+    if backing_format:
+        data = backing_format.encode("ascii")
+        blob += struct.pack(">II", EXT_BACKING_FORMAT, len(data)) + data.ljust(_round_up(len(data), 8), b"\x00")
+    for ext_type, data in extensions:
+        blob += struct.pack(">II", ext_type, len(data)) + data.ljust(_round_up(len(data), 8), b"\x00")
+    return blob + struct.pack(">II", EXT_END, 0)
+
+def create_overlay(path, backing_file, backing_format="qcow2", size=None, cluster_bits=DEFAULT_CLUSTER_BITS,
+                   extended_l2=False, lazy_refcounts=False):
+    """
+    Write an empty qcow2 v3 image whose reads fall through to backing_file,
+    the native equivalent of 'qemu-img create -f qcow2 -b backing -F fmt'.
+    Only metadata is written: header, refcount table and block, L1 table
+
+    Args:
+        backing_file: absolute path stored in the header
+        size: virtual size in bytes (the backing image's when not given)
+        extended_l2: subclusters, so a small write to a large cluster doesn't
+                     copy the whole cluster up from the backing file
+
+    Returns:
+        Bytes written
+    """
+    if size is None:
+        size = read_header(backing_file)["size"] if backing_format == "qcow2" else os.path.getsize(backing_file)
+    cluster_size = 1 << cluster_bits
+
+    name = backing_file.encode("utf-8")
+    extensions = _extensions_blob(backing_format)
+    backing_offset = HEADER_V3_LENGTH + len(extensions)
+    if backing_offset + len(name) > cluster_size:
+        raise Qcow2Error("Backing file path is too long for the header cluster")
+
+    #One L2 table maps cluster_size / 8 clusters (16 byte entries with subclusters)
+    l2_entries = cluster_size // (16 if extended_l2 else 8)
+    l1_size = max(1, -(-size // (cluster_size * l2_entries)))
+    l1_clusters = -(-l1_size * 8 // cluster_size)
+    refcount_table_offset = cluster_size
+    refcount_block_offset = 2 * cluster_size
+    l1_offset = 3 * cluster_size
+    used_clusters = 3 + l1_clusters
+    #16 bit refcounts, one block covers cluster_size / 2 clusters
+    if used_clusters > cluster_size // 2:
+        raise Qcow2Error("Image is too large for a single refcount block")
+
+    header = struct.pack(HEADER_FORMAT, QCOW2_MAGIC, 3, backing_offset, len(name), cluster_bits, size,
+                         0, l1_size, l1_offset, refcount_table_offset, 1, 0, 0)
+    header += struct.pack(">QQQII", INCOMPAT_EXTENDED_L2 if extended_l2 else 0,
+                          COMPAT_LAZY_REFCOUNTS if lazy_refcounts else 0, 0, 4, HEADER_V3_LENGTH)
+    first_cluster = (header + extensions + name).ljust(cluster_size, b"\x00")
+    refcount_table = struct.pack(">Q", refcount_block_offset).ljust(cluster_size, b"\x00")
+    refcount_block = (struct.pack(">H", 1) * used_clusters).ljust(cluster_size, b"\x00")
+
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(first_cluster + refcount_table + refcount_block)
+        f.write(b"\x00" * l1_clusters * cluster_size)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return used_clusters * cluster_size
+
+def set_backing_file(path, backing_file, backing_format="qcow2"):
+    """
+    Point an image at another backing file without touching its data, the
+    native equivalent of 'qemu-img rebase -u'. Only safe when the new
+    backing file has the same contents (e.g. the golden image was moved)
+    """
+    header = read_header(path)
+    if header["version"] < 3:
+        raise Qcow2Error(f"{path} is a qcow2 v2 image, convert it with 'qemu-img amend -o compat=1.1'")
+    if header["incompatible_features"] & (INCOMPAT_DIRTY | INCOMPAT_CORRUPT):
+        raise Qcow2Error(f"{path} is marked dirty or corrupt, run 'qemu-img check -r all' on it first")
+
+    cluster_size = 1 << header["cluster_bits"]
+    name = backing_file.encode("utf-8") if backing_file else b""
+    extensions = _extensions_blob(backing_format if backing_file else None, header["extensions"])
+    backing_offset = header["header_length"] + len(extensions)
+    if backing_offset + len(name) > cluster_size:
+        raise Qcow2Error("Backing file path is too long for the header cluster")
+
+    with open(path, "r+b") as f:
+        f.seek(8)
+        f.write(struct.pack(">QI", backing_offset if name else 0, len(name)))
+        f.seek(header["header_length"])
+        f.write((extensions + name).ljust(cluster_size - header["header_length"], b"\x00"))
+        f.flush()
+        os.fsync(f.fileno())
+
+def backing_chain(path):
+    """[path, its backing file, that one's backing file, ...]"""
+    chain = [path]
+    while True:
+        try:
+            backing = read_header(chain[-1])["backing_file"]
+        except (OSError, Qcow2Error):
+            break
+        if not backing:
+            break
+        if not os.path.isabs(backing):
+            backing = os.path.join(os.path.dirname(chain[-1]), backing)
+        if backing in chain:
+            raise Qcow2Error(f"Backing chain of {path} loops at {backing}")
+        chain.append(backing)
+    return chain
@@ -1,20 +1,5 @@
 #!/bin/bash
 set -x
 
-# Reload nvidia modules
-modprobe nvidia
-modprobe nvidia_modeset
-modprobe nvidia_uvm
-modprobe nvidia_drm
-
-# Rebind VT consoles
-echo 1 > /sys/class/vtconsole/vtcon0/bind
-# Some machines might have more than 1 virtual console. Add a line for each corresponding VTConsole
-#echo 1 > /sys/class/vtconsole/vtcon1/bind
-
-nvidia-xconfig --query-gpu-info > /dev/null 2>&1
-echo "efi-framebuffer.0" > /sys/bus/platform/drivers/efi-framebuffer/bind
-
-# Restart Display Manager
-systemctl start display-manager.service
-
+# Give the VM's PCI devices and cores back to the host, reload the nvidia modules and restart the display manager
+python3 /etc/libvirt/hooks/lib/hookEngine.py release "$1"
@@ -0,0 +1,146 @@
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import time
+
+from hostProbe import IMAGES_PATH
+from storageTuning import DiskAllocation, create_image
+
+BLUE = '\033[94m'
+RED = '\033[91m'
+RESET = '\033[0m'
+
+#Host-side equivalents of the libvirt disk cache/io modes
+IO_MODE_ENGINES = {
+    "default (cache=writeback, io=threads)": ["--ioengine=psync", "--direct=0"],
+    "cache=none, io=native": ["--ioengine=libaio", "--direct=1", "--iodepth=32"],
+    "cache=none, io=io_uring": ["--ioengine=io_uring", "--direct=1", "--iodepth=32"],
+}
+
+WORKLOADS = {
+    "4k random read": ["--rw=randread", "--bs=4k"],
+    "4k random write": ["--rw=randwrite", "--bs=4k"],
+    "1M sequential write": ["--rw=write", "--bs=1M"],
+}
+
+def run_fio(path, engine_args, workload_args, size="1G", runtime=10):
+    """
+    Run one fio job and return (iops, bandwidth MiB/s, p99 latency usec)
+    """
+    command = [
+        "fio", "--name=bench", f"--filename={path}", f"--size={size}",
+        f"--runtime={runtime}", "--time_based", "--group_reporting",
+        "--output-format=json",
+    ] + engine_args + workload_args
+    result = subprocess.run(command, capture_output=True, text=True, check=True)
+    job = json.loads(result.stdout)["jobs"][0]
+    side = job["write"] if job["write"]["io_bytes"] else job["read"]
+    p99 = side.get("clat_ns", {}).get("percentile", {}).get("99.000000", 0) / 1000
+    return side["iops"], side["bw"] / 1024, p99
+
+def compare_io_modes(directory=IMAGES_PATH, size="1G", runtime=10):
+    """Compare the default disk I/O mode with cache=none/io=native/io_uring on this host"""
+    if not shutil.which("fio"):
+        print(f"🚨 Error 🚨 : {RED}fio is not installed{RESET}")
+        return None
+
+    path = os.path.join(directory, ".fio-bench.img")
+    results = {}
+    try:
+        for mode, engine_args in IO_MODE_ENGINES.items():
+            for workload, workload_args in WORKLOADS.items():
+                print(f"Running {workload} with {mode}...")
+                try:
+                    results[(mode, workload)] = run_fio(path, engine_args, workload_args, size, runtime)
+                except subprocess.CalledProcessError as e:
+                    print(f"fio failed for {mode}: {RED}{e.stderr.strip() or e}{RESET}")
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+    print("=" * 88)
+    print(f"{'Mode':<40}{'Workload':<22}{'IOPS':>10}{'MiB/s':>8}{'p99 us':>8}")
+    for (mode, workload), (iops, bw, p99) in results.items():
+        print(f"{mode:<40}{workload:<22}{BLUE}{iops:>10.0f}{RESET}{bw:>8.1f}{p99:>8.0f}")
+    print("=" * 88)
+    return results
+
+#Image layouts compared by compare_disk_allocations
+ALLOCATION_CANDIDATES = {
+    "qcow2 qemu defaults (64k)": DiskAllocation(preallocation="off", cluster_size="64k",
+                                                lazy_refcounts=False, extended_l2=False),
+    "qcow2 metadata, 64k": DiskAllocation(cluster_size="64k", lazy_refcounts=False, extended_l2=False),
+    "qcow2 metadata, 128k+subcl, lazy": DiskAllocation(),
+    "qcow2 falloc, 128k+subcl, lazy": DiskAllocation(preallocation="falloc"),
+    "qcow2 full, 2M": DiskAllocation(preallocation="full", cluster_size="2M", extended_l2=False),
+    "raw falloc": DiskAllocation(format="raw", preallocation="falloc"),
+}
+
+#(request size, step between requests): the 4k writes each land on a cluster
+#nothing was written to yet, the worst case for allocation and refcount updates
+ALLOCATION_WORKLOADS = {
+    "4k scattered writes": ("4k", 1024**2),
+    "1M sequential write": ("1M", 1024**2),
+}
+
+def run_qemu_img_bench(path, fmt, request_size, step, count):
+    """
+    Write count requests through QEMU's block layer (O_DIRECT, native AIO,
+    queue depth 1) and return (MiB/s, mean latency usec)
+    """
+    command = ["qemu-img", "bench", "-w", "-f", fmt, "-t", "none", "-i", "native", "-d", "1",
+               "-s", request_size, "-S", str(step), "-c", str(count), path]
+    result = subprocess.run(command, capture_output=True, text=True, check=True)
+    match = re.search(r"Run completed in ([\d.]+) seconds", result.stdout)
+    if not match:
+        raise ValueError(f"Unexpected qemu-img bench output: {result.stdout.strip()}")
+    seconds = max(float(match.group(1)), 1e-6)
+    request_bytes = int(request_size[:-1]) * (1024 if request_size[-1] == "k" else 1024**2)
+    return count * request_bytes / 1024**2 / seconds, seconds / count * 1e6
+
+def compare_disk_allocations(directory=IMAGES_PATH, size_gb=2, candidates=None):
+    """
+    Create each candidate image layout and time first writes into it, since
+    that is where preallocation, cluster size, lazy refcounts and
+    subclusters make a difference
+    """
+    if not shutil.which("qemu-img"):
+        print(f"🚨 Error 🚨 : {RED}qemu-img is not installed{RESET}")
+        return None
+
+    candidates = candidates or ALLOCATION_CANDIDATES
+    count = size_gb * 1024**3 // (1024**2)
+    results = {}
+    for name, allocation in candidates.items():
+        for workload, (request_size, step) in ALLOCATION_WORKLOADS.items():
+            path = os.path.join(directory, f".alloc-bench{allocation.extension()}")
+            print(f"Running {workload} on {name}...")
+            try:
+                started = time.monotonic()
+                create_image(path, f"{size_gb}G", allocation)
+                created = time.monotonic() - started
+                bandwidth, latency = run_qemu_img_bench(path, allocation.format, request_size, step, count)
+                results[(name, workload)] = (bandwidth, latency, created)
+            except (subprocess.CalledProcessError, ValueError) as e:
+                print(f"qemu-img failed for {name}: {RED}{getattr(e, 'stderr', None) or e}{RESET}")
+            finally:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    print("=" * 92)
+    print(f"{'Image':<36}{'Workload':<24}{'MiB/s':>10}{'mean us':>10}{'create s':>10}")
+    for (name, workload), (bandwidth, latency, created) in results.items():
+        print(f"{name:<36}{workload:<24}{BLUE}{bandwidth:>10.1f}{RESET}{latency:>10.0f}{created:>10.1f}")
+    print("=" * 92)
+    return results
+
+if __name__ == "__main__":
+    #Usage: python3 storageBench.py [directory] [--allocation]
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    if "--allocation" in sys.argv:
+        compare_disk_allocations(args[0] if args else IMAGES_PATH)
+    else:
+        compare_io_modes(args[0] if args else IMAGES_PATH)
@@ -0,0 +1,207 @@
+import re
+import string
+import subprocess
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass
+
+STORAGE_BUSES = ("virtio-blk", "virtio-scsi")
+IO_MODES = ("native", "io_uring", "threads")
+DISK_FORMATS = ("qcow2", "raw")
+PREALLOCATIONS = ("off", "metadata", "falloc", "full")
+CLUSTER_SIZES = ("64k", "128k", "256k", "512k", "1M", "2M")
+
+@dataclass
+class StorageProfile:
+    """Driver and controller options for the main VM disk"""
+    bus: str = "virtio-blk"
+    cache: str = "none"
+    io: str = "native"
+    discard: str = "unmap"
+    detect_zeroes: str = "unmap"
+    iothreads: int = 1
+    queues: int = None      #None uses the vCPU count
+
+@dataclass
+class DiskAllocation:
+    """How the main disk image is laid out when it is created"""
+    format: str = "qcow2"
+    preallocation: str = "metadata"
+    cluster_size: str = "128k"
+    lazy_refcounts: bool = True
+    #32 subclusters per cluster: 128k clusters still allocate (and copy on write) in 4k steps
+    extended_l2: bool = True
+
+    def extension(self):
+        return ".img" if self.format == "raw" else ".qcow2"
+
+def cluster_bits(cluster_size):
+    """'128k' -> 17"""
+    match = re.fullmatch(r"(\d+)([kKmM])", cluster_size or "")
+    if not match:
+        raise ValueError(f"Cluster size must look like 64k or 2M, got '{cluster_size}'")
+    size = int(match.group(1)) * (1024 if match.group(2).lower() == "k" else 1024**2)
+    if size & (size - 1):
+        raise ValueError(f"Cluster size must be a power of two, got '{cluster_size}'")
+    return size.bit_length() - 1
+
+def validate_allocation(allocation):
+    if allocation.format not in DISK_FORMATS:
+        raise ValueError(f"Disk format must be one of {', '.join(DISK_FORMATS)}")
+    if allocation.preallocation not in PREALLOCATIONS:
+        raise ValueError(f"Preallocation must be one of {', '.join(PREALLOCATIONS)}")
+    if allocation.format == "raw" and allocation.preallocation == "metadata":
+        raise ValueError("Raw images have no metadata to preallocate, use off, falloc or full")
+    if allocation.format == "qcow2":
+        bits = cluster_bits(allocation.cluster_size)
+        if not 9 <= bits <= 21:
+            raise ValueError("qcow2 cluster size must be between 512 and 2M")
+        if allocation.extended_l2 and bits < 14:
+            raise ValueError("Subclusters (extended_l2) need clusters of 16k or more")
+
+def qemu_img_options(allocation):
+    """-o string for 'qemu-img create'"""
+    options = [f"preallocation={allocation.preallocation}"]
+    if allocation.format == "qcow2":
+        options += ["compat=1.1", f"cluster_size={allocation.cluster_size}",
+                    f"lazy_refcounts={'on' if allocation.lazy_refcounts else 'off'}",
+                    f"extended_l2={'on' if allocation.extended_l2 else 'off'}"]
+    return ",".join(options)
+
+def volume_xml(name, capacity_gb, allocation=None):
+    """
+    Storage volume XML for the allocation options. libvirt preallocates the
+    whole image when allocation equals capacity (falloc; full has no pool
+    equivalent) and only the metadata with VIR_STORAGE_VOL_CREATE_PREALLOC_METADATA
+
+    Returns:
+        (xml, whether the metadata flag is needed)
+    """
+    allocation = allocation or DiskAllocation()
+    validate_allocation(allocation)
+    volume = ET.Element("volume")
+    ET.SubElement(volume, "name").text = name
+    ET.SubElement(volume, "capacity", {"unit": "G"}).text = str(capacity_gb)
+    preallocated = allocation.preallocation in ("falloc", "full")
+    ET.SubElement(volume, "allocation", {"unit": "G"}).text = str(capacity_gb if preallocated else 0)
+    target = ET.SubElement(volume, "target")
+    ET.SubElement(target, "format", {"type": allocation.format})
+    if allocation.format == "qcow2":
+        ET.SubElement(target, "compat").text = "1.1"
+        ET.SubElement(target, "clusterSize", {"unit": "B"}).text = str(1 << cluster_bits(allocation.cluster_size))
+        features = ET.SubElement(target, "features")
+        if allocation.lazy_refcounts:
+            ET.SubElement(features, "lazy_refcounts")
+        if allocation.extended_l2:
+            ET.SubElement(features, "extended_l2")
+    metadata = allocation.format == "qcow2" and allocation.preallocation != "off"
+    return ET.tostring(volume, encoding="unicode"), metadata
+
+def create_image(path, size, allocation=None):
+    """
+    Create a disk image with the allocation options outside of a storage
+    pool ('qemu-img create')
+
+    Args:
+        size: qemu-img size, e.g. '50G'
+    """
+    allocation = allocation or DiskAllocation()
+    validate_allocation(allocation)
+    subprocess.run(["qemu-img", "create", "-q", "-f", allocation.format,
+                    "-o", qemu_img_options(allocation), path, str(size)], check=True)
+
+def _target_dev(bus, dev, used):
+    """Keep the drive letter if free but use the device prefix the new bus expects"""
+    prefix = "vd" if bus == "virtio-blk" else "sd"
+    if dev and dev.startswith(prefix) and dev not in used:
+        return dev
+    letter = dev[-1] if dev and dev[-1] in string.ascii_lowercase else "a"
+    letters = [letter] + [l for l in string.ascii_lowercase if l != letter]
+    return next(prefix + l for l in letters if prefix + l not in used)
+
+def _ensure_iothreads(root, count):
+    iothreads = root.find("iothreads")
+    if iothreads is None:
+        iothreads = ET.Element("iothreads")
+        vcpu = root.find("vcpu")
+        index = list(root).index(vcpu) + 1 if vcpu is not None else len(root)
+        root.insert(index, iothreads)
+    iothreads.text = str(max(count, int(iothreads.text or 0)))
+
+    #Pinned domains keep their IO threads beside the emulator
+    cputune = root.find("cputune")
+    if cputune is not None:
+        emulatorpin = cputune.find("emulatorpin")
+        pinned = {pin.get("iothread") for pin in cputune.findall("iothreadpin")}
+        if emulatorpin is not None:
+            for iothread in range(1, int(iothreads.text) + 1):
+                if str(iothread) not in pinned:
+                    ET.SubElement(cputune, "iothreadpin", {
+                        "iothread": str(iothread),
+                        "cpuset": emulatorpin.get("cpuset"),
+                    })
+
+def _ensure_scsi_controller(root, queues, iothreads):
+    devices = root.find("devices")
+    controller = devices.find("controller[@type='scsi']")
+    if controller is None:
+        controller = ET.SubElement(devices, "controller", {"type": "scsi", "index": "0"})
+    controller.set("model", "virtio-scsi")
+    for old in controller.findall("address"):
+        controller.remove(old)
+    driver = controller.find("driver")
+    if driver is None:
+        driver = ET.SubElement(controller, "driver")
+    #iothread='1' without an <iothreads> element makes libvirt reject the domain
+    if iothreads:
+        driver.set("iothread", "1")
+    else:
+        driver.attrib.pop("iothread", None)
+    driver.set("queues", str(queues))
+
+def apply_storage_profile(root, profile):
+    """
+    Move every non-CD-ROM disk onto virtio with tuned driver options
+
+    Returns:
+        List of target devs that were changed
+    """
+    vcpu = root.find("vcpu")
+    queues = profile.queues or (int(vcpu.text) if vcpu is not None and vcpu.text else 1)
+
+    if profile.iothreads:
+        _ensure_iothreads(root, profile.iothreads)
+    if profile.bus == "virtio-scsi":
+        _ensure_scsi_controller(root, queues, profile.iothreads)
+
+    disks = [disk for disk in root.findall("./devices/disk")
+             if disk.get("device") == "disk" and disk.find("target") is not None]
+    used = {target.get("dev") for target in root.findall("./devices/disk/target")}
+
+    changed = []
+    for disk in disks:
+        target = disk.find("target")
+        used.discard(target.get("dev"))
+        target.set("bus", "virtio" if profile.bus == "virtio-blk" else "scsi")
+        target.set("dev", _target_dev(profile.bus, target.get("dev"), used))
+        used.add(target.get("dev"))
+
+        #The old SATA drive address no longer applies, libvirt assigns a new one
+        for address in disk.findall("address"):
+            disk.remove(address)
+
+        driver = disk.find("driver")
+        if driver is None:
+            driver = ET.SubElement(disk, "driver", {"name": "qemu"})
+        driver.set("cache", profile.cache)
+        driver.set("io", profile.io)
+        driver.set("discard", profile.discard)
+        driver.set("detect_zeroes", profile.detect_zeroes)
+        for attr in ("iothread", "queues"):
+            driver.attrib.pop(attr, None)
+        if profile.bus == "virtio-blk":
+            if profile.iothreads:
+                driver.set("iothread", "1")
+            driver.set("queues", str(queues))
+
+        changed.append(target.get("dev"))
+    return changed
@@ -0,0 +1,50 @@
+import os
+import sys
+
+import pytest
+
+#The modules live at the top of the repo, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def write(path, text=""):
+    """Create a file of a fake sysfs/proc/dev tree, with its directories"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(text)
+
+def symlink(target, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.symlink(target, path)
+
+def add_pci(root, bdf, vendor, device, class_code, driver=None, iommu_group=None, numa_node=-1, boot_vga=None):
+    """A PCI function in sys/bus/pci/devices with its driver and IOMMU group links"""
+    base = os.path.join(root, "sys/bus/pci/devices", bdf)
+    write(os.path.join(base, "vendor"), f"0x{vendor:04x}\n")
+    write(os.path.join(base, "device"), f"0x{device:04x}\n")
+    write(os.path.join(base, "class"), f"0x{class_code:06x}\n")
+    write(os.path.join(base, "numa_node"), f"{numa_node}\n")
+    if boot_vga is not None:
+        write(os.path.join(base, "boot_vga"), "1\n" if boot_vga else "0\n")
+    if driver:
+        os.makedirs(os.path.join(root, "sys/bus/pci/drivers", driver), exist_ok=True)
+        os.symlink(f"../../drivers/{driver}", os.path.join(base, "driver"))
+    if iommu_group is not None:
+        os.makedirs(os.path.join(root, "sys/kernel/iommu_groups", str(iommu_group)), exist_ok=True)
+        os.symlink(f"../../../../kernel/iommu_groups/{iommu_group}", os.path.join(base, "iommu_group"))
+    return base
+
+@pytest.fixture
+def test_conn():
+    """
+    libvirt's test driver. test:///default is one host per process, so tests
+    define their own domains and undefine them afterwards
+    """
+    libvirt = pytest.importorskip("libvirt")
+    conn = libvirt.open("test:///default")
+    yield conn
+    conn.close()
+
+def define_test_domain(conn, name, devices=""):
+    """A shut off domain of the test driver with the given <devices> children"""
+    return conn.defineXML(f"<domain type='test'><name>{name}</name><memory unit='MiB'>64</memory>"
+                          f"<os><type>hvm</type></os><devices>{devices}</devices></domain>")
@@ -0,0 +1,76 @@
+import os
+import shutil
+import subprocess
+import xml.etree.ElementTree as ET
+
+import pytest
+
+pytest.importorskip("libvirt")
+
+from conftest import write
+from blockBackend import device_in_use, device_size, block_disk_transform, _block_name
+
+@pytest.fixture
+def disks(tmp_path):
+    """sdb with a partition, sdc whole, sdd under device mapper, sde free"""
+    for name in ("sdb", "sdc", "sdd", "sde"):
+        write(str(tmp_path / f"sys/class/block/{name}/size"), "209715200\n")
+    write(str(tmp_path / "sys/class/block/sdb/sdb1/partition"), "1\n")
+    os.makedirs(tmp_path / "sys/class/block/sdb1/holders")
+    os.makedirs(tmp_path / "sys/class/block/sdd/holders/dm-0")
+    write(str(tmp_path / "proc/self/mounts"), "/dev/sdb1 /mnt ext4 rw 0 0\ntmpfs /tmp tmpfs rw 0 0\n")
+    write(str(tmp_path / "proc/swaps"), "Filename\tType\tSize\tUsed\tPriority\n/dev/sdc\tpartition\t8388604\t0\t-2\n")
+    return str(tmp_path)
+
+def test_mounted_partition_blocks_the_disk(disks):
+    assert device_in_use("/dev/sdb", "sdb", root=disks) == "sdb1 is mounted or used as swap"
+
+def test_swap_disk_is_in_use(disks):
+    assert device_in_use("/dev/sdc", "sdc", root=disks) == "sdc is mounted or used as swap"
+
+def test_device_mapper_holder(disks):
+    assert "held by dm-0" in device_in_use("/dev/sdd", "sdd", root=disks)
+
+def test_free_disk(disks):
+    assert device_in_use("/dev/sde", "sde", root=disks) is None
+    assert device_size("sde", root=disks) == 100 * 1024**3
+
+def test_block_disk_transform_keeps_target_and_boot_order():
+    root = ET.fromstring(
+        "<domain><devices>"
+        "<disk type='file' device='cdrom'><source file='/isos/win.iso'/><target dev='sda' bus='sata'/></disk>"
+        "<disk type='file' device='disk'><driver name='qemu' type='qcow2'/>"
+        "<source file='/var/lib/libvirt/images/win.qcow2'/><target dev='vda' bus='virtio'/><boot order='2'/></disk>"
+        "</devices></domain>")
+    assert block_disk_transform(root, "win", "/dev/vg/win") == "/var/lib/libvirt/images/win.qcow2"
+    cdrom, disk = root.findall("devices/disk")
+    assert cdrom.get("device") == "cdrom"
+    assert disk.get("type") == "block" and disk.find("source").get("dev") == "/dev/vg/win"
+    assert disk.find("target").attrib == {"dev": "vda", "bus": "virtio"}
+    assert disk.find("boot").get("order") == "2"
+    assert disk.find("driver").get("type") == "raw"
+    assert block_disk_transform(root, "other", "/dev/sdz") is None
+
+@pytest.mark.skipif(os.geteuid() != 0 or not shutil.which("losetup"), reason="loop devices need root")
+def test_loop_device(tmp_path, test_conn):
+    image = tmp_path / "disk.img"
+    with open(image, "wb") as f:
+        f.truncate(64 * 1024**2)
+    try:
+        device = subprocess.run(["losetup", "--find", "--show", str(image)], capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except subprocess.CalledProcessError as e:
+        pytest.skip(f"no loop device: {e.stderr.strip()}")
+    try:
+        name = _block_name(device)
+        assert name == os.path.basename(device)
+        assert device_size(name) == 64 * 1024**2
+        assert device_in_use(device, name, conn=test_conn) is None
+        #Held open with O_EXCL, as a mounted filesystem would hold it
+        fd = os.open(device, os.O_RDONLY | os.O_EXCL)
+        try:
+            assert "busy" in device_in_use(device, name, conn=test_conn)
+        finally:
+            os.close(fd)
+    finally:
+        subprocess.run(["losetup", "--detach", device])
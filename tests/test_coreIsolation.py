@@ -0,0 +1,62 @@
+import os
+import xml.etree.ElementTree as ET
+
+import pytest
+
+from conftest import write
+from coreIsolation import (plan_isolation, isolate_host, release_host, cpu_mask, HOST_UNITS, WORKQUEUE_MASKS,
+                           CGROUP_DIR, DOMAIN_XML_DIR)
+
+PINNED = """<domain><name>win</name><vcpu>4</vcpu><cputune>
+<vcpupin vcpu='0' cpuset='2'/><vcpupin vcpu='1' cpuset='6'/><vcpupin vcpu='2' cpuset='3'/><vcpupin vcpu='3' cpuset='7'/>
+</cputune></domain>"""
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+@pytest.fixture
+def host(tmp_path):
+    """Eight online CPUs, host cgroups and workqueues on all of them, and a VM pinned to 2,3,6,7"""
+    root = str(tmp_path)
+    write(os.path.join(root, "sys/devices/system/cpu/online"), "0-7\n")
+    for unit in HOST_UNITS:
+        write(os.path.join(root, CGROUP_DIR, unit, "cpuset.cpus"), "")
+    for mask in WORKQUEUE_MASKS:
+        write(os.path.join(root, mask), "ff\n")
+    write(os.path.join(root, DOMAIN_XML_DIR, "win.xml"), PINNED)
+    write(os.path.join(root, DOMAIN_XML_DIR, "plain.xml"), "<domain><name>plain</name><vcpu>4</vcpu></domain>")
+    return root
+
+def test_cpu_mask():
+    assert cpu_mask([0, 1, 4, 5]) == "33"
+    assert cpu_mask([0, 1, 33]) == "2,00000003"
+
+def test_plan_isolation(host):
+    assert plan_isolation(ET.fromstring(PINNED), host) == ([2, 3, 6, 7], [0, 1, 4, 5])
+
+def test_plan_isolation_needs_pinning_and_host_cpus(host):
+    assert plan_isolation(ET.fromstring("<domain/>"), host) == ([], [])
+    write(os.path.join(host, "sys/devices/system/cpu/online"), "2-3,6-7\n")
+    assert plan_isolation(ET.fromstring(PINNED), host) == ([2, 3, 6, 7], [])
+
+def test_isolate_and_release(host):
+    assert isolate_host("win", host) == [0, 1, 4, 5]
+    for unit in HOST_UNITS:
+        assert read(os.path.join(host, CGROUP_DIR, unit, "cpuset.cpus")) == "0-1,4-5"
+    for mask in WORKQUEUE_MASKS:
+        assert read(os.path.join(host, mask)) == "33"
+
+    #A second prepare must not save the isolated state as the one to restore
+    isolate_host("win", host)
+    assert release_host("win", host)
+    for unit in HOST_UNITS:
+        assert read(os.path.join(host, CGROUP_DIR, unit, "cpuset.cpus")) == ""
+    for mask in WORKQUEUE_MASKS:
+        assert read(os.path.join(host, mask)) == "ff"
+    assert not release_host("win", host)
+
+def test_unpinned_vm_is_left_alone(host):
+    assert isolate_host("plain", host) == []
+    assert not release_host("plain", host)
+    assert read(os.path.join(host, WORKQUEUE_MASKS[0])) == "ff\n"
@@ -0,0 +1,63 @@
+import xml.etree.ElementTree as ET
+
+import pytest
+
+libvirt = pytest.importorskip("libvirt")
+
+from conftest import define_test_domain
+from domainXml import apply_transforms
+
+class CountingConn:
+    """test:///default connection that counts defineXML calls"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.defines = 0
+
+    def defineXML(self, xml):
+        self.defines += 1
+        return self.conn.defineXML(xml)
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+@pytest.fixture
+def conn(test_conn):
+    dom = define_test_domain(test_conn, "xml")
+    yield CountingConn(test_conn)
+    dom.undefine()
+
+def describe(root):
+    ET.SubElement(root, "description").text = "transformed"
+
+def add_disk(root):
+    disk = ET.SubElement(root.find("devices"), "disk", {"type": "file", "device": "cdrom"})
+    ET.SubElement(disk, "source", {"file": "/isos/virtio-win.iso"})
+    ET.SubElement(disk, "target", {"dev": "sdc", "bus": "sata"})
+
+def current(conn):
+    return ET.fromstring(conn.lookupByName("xml").XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE))
+
+def test_transforms_are_committed_with_one_define(conn):
+    diff = apply_transforms("xml", [describe, add_disk], conn=conn)
+    assert conn.defines == 1
+    assert "+  <description>transformed</description>" in diff
+    assert any(line.startswith("+") and "virtio-win.iso" in line for line in diff.splitlines())
+    root = current(conn)
+    assert root.findtext("description") == "transformed"
+    assert root.find("devices/disk/source").get("file") == "/isos/virtio-win.iso"
+
+def test_dry_run_and_no_change_define_nothing(conn):
+    assert apply_transforms("xml", [describe], conn=conn, dry_run=True)
+    assert apply_transforms("xml", [lambda root: None], conn=conn) == ""
+    assert conn.defines == 0
+    assert current(conn).find("description") is None
+
+def test_failing_transform_leaves_the_domain_alone(conn):
+    def fail(root):
+        raise ValueError("bad transform")
+
+    with pytest.raises(ValueError):
+        apply_transforms("xml", [describe, fail], conn=conn)
+    assert conn.defines == 0
+    assert current(conn).find("description") is None
@@ -0,0 +1,96 @@
+import hashlib
+import http.server
+import os
+import re
+import threading
+
+import pytest
+
+import downloader
+from downloader import download, DownloadError
+
+DATA = os.urandom(256 * 1024)
+SHA256 = hashlib.sha256(DATA).hexdigest()
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """Serves DATA. The server's mode says whether Range works and whether range bodies get cut short"""
+    protocol_version = "HTTP/1.0"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        match = re.fullmatch(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+        if server.mode == "no-ranges" or not match:
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(DATA)))
+            self.end_headers()
+            self.wfile.write(DATA)
+            server.sent += len(DATA)
+            return
+        start, end = int(match.group(1)), int(match.group(2))
+        body = DATA[start:end + 1]
+        self.send_response(206)
+        self.send_header("Content-Range", f"bytes {start}-{end}/{len(DATA)}")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", '"v1"')
+        self.end_headers()
+        #The connection drops halfway through every segment
+        if server.mode == "cut" and len(body) > 1:
+            body = body[:len(body) // 2]
+        self.wfile.write(body)
+        server.sent += len(body)
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(downloader, "MIN_SEGMENT_SIZE", 16 * 1024)
+    monkeypatch.setattr(downloader, "CHUNK_SIZE", 8 * 1024)
+    monkeypatch.setattr(downloader, "RETRIES", 1)
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    httpd.mode = "ranges"
+    httpd.sent = 0
+    httpd.url = f"http://127.0.0.1:{httpd.server_port}/virtio-win.iso"
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+def test_segmented_download(server, tmp_path):
+    dest = str(tmp_path / "virtio-win.iso")
+    assert download(server.url, dest, connections=4, expected_sha256=SHA256, quiet=True) == SHA256
+    assert read(dest) == DATA
+    assert sorted(os.listdir(tmp_path)) == ["virtio-win.iso"]
+
+def test_interrupted_download_resumes(server, tmp_path):
+    dest = str(tmp_path / "virtio-win.iso")
+    server.mode = "cut"
+    with pytest.raises(DownloadError):
+        download(server.url, dest, connections=4, quiet=True)
+    assert not os.path.exists(dest)
+    assert os.path.exists(dest + ".part") and os.path.exists(dest + ".part.json")
+
+    server.mode = "ranges"
+    sent = server.sent
+    assert download(server.url, dest, connections=4, expected_sha256=SHA256, quiet=True) == SHA256
+    assert read(dest) == DATA
+    #Only what the first run didn't get is fetched again (plus the one byte probe)
+    assert server.sent - sent <= len(DATA) // 2 + 1
+    assert not os.path.exists(dest + ".part.json")
+
+def test_server_without_ranges(server, tmp_path):
+    dest = str(tmp_path / "virtio-win.iso")
+    server.mode = "no-ranges"
+    assert download(server.url, dest, expected_sha256=SHA256, quiet=True) == SHA256
+    assert read(dest) == DATA
+
+def test_checksum_mismatch_keeps_nothing(server, tmp_path):
+    dest = str(tmp_path / "virtio-win.iso")
+    with pytest.raises(DownloadError, match="SHA-256 mismatch"):
+        download(server.url, dest, expected_sha256="0" * 64, quiet=True)
+    assert os.listdir(tmp_path) == []
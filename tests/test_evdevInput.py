@@ -0,0 +1,70 @@
+import os
+import xml.etree.ElementTree as ET
+
+import pytest
+
+from conftest import write, symlink
+from evdevInput import list_input_devices, resolve_input_devices, evdev_transform
+
+def add_input(root, name, event):
+    """A by-id link to /dev/input/<event> like udev creates"""
+    write(os.path.join(root, "dev/input", event))
+    symlink(f"../{event}", os.path.join(root, "dev/input/by-id", name))
+
+@pytest.fixture
+def inputs(tmp_path):
+    root = str(tmp_path)
+    add_input(root, "usb-Logitech_USB_Receiver-event-mouse", "event5")
+    add_input(root, "usb-Logitech_USB_Receiver-event-kbd", "event3")
+    add_input(root, "usb-Razer_Keyboard-if01-event-kbd", "event7")
+    add_input(root, "usb-Logitech_USB_Receiver-event-joystick", "event9")
+    #Left behind by an unplugged device
+    symlink("../event11", os.path.join(root, "dev/input/by-id/usb-Gone-event-kbd"))
+    return root
+
+def test_list_input_devices_keyboards_first(inputs):
+    devices = list_input_devices(inputs)
+    assert [(device.name, device.kind) for device in devices] == [
+        ("usb-Logitech_USB_Receiver-event-kbd", "keyboard"),
+        ("usb-Razer_Keyboard-if01-event-kbd", "keyboard"),
+        ("usb-Logitech_USB_Receiver-event-mouse", "mouse"),
+    ]
+    assert devices[0].path == "/dev/input/by-id/usb-Logitech_USB_Receiver-event-kbd"
+    assert [device.secondary for device in devices] == [False, True, False]
+
+def test_list_input_devices_without_by_id(tmp_path):
+    assert list_input_devices(str(tmp_path)) == []
+
+def test_resolve_input_devices(inputs):
+    devices = resolve_input_devices(["/dev/input/by-id/usb-Logitech_USB_Receiver-event-mouse"], inputs)
+    assert [device.kind for device in devices] == ["mouse"]
+    with pytest.raises(ValueError):
+        resolve_input_devices(["usb-Gone-event-kbd"], inputs)
+
+def test_evdev_transform(inputs):
+    root = ET.fromstring("<domain><devices><disk/><input type='evdev'><source dev='/dev/old'/></input>"
+                         "<graphics type='vnc'/></devices></domain>")
+    added = evdev_transform(root, list_input_devices(inputs), "alt-alt")
+    sources = root.findall("./devices/input[@type='evdev']/source")
+    assert added == [source.get("dev") for source in sources]
+    assert "/dev/old" not in added
+    #Only the first keyboard owns the toggle
+    assert [source.get("grabToggle") for source in sources] == ["alt-alt", None, None]
+    assert root.find("./devices/input[@type='keyboard'][@bus='virtio']") is not None
+    assert root.find("./devices/input[@type='mouse'][@bus='virtio']") is not None
+    assert [child.tag for child in root.find("devices")][-1] == "graphics"
+
+def test_devices_on_passed_through_controller(tmp_path):
+    root = str(tmp_path)
+    for name, event, controller in (("usb-Logitech_USB_Receiver-event-kbd", "event3", "0000:00:14.0/usb1/1-2"),
+                                    ("usb-Razer_Keyboard-event-kbd", "event7", "0000:00:1c.0/0000:05:00.0/usb3/3-1")):
+        add_input(root, name, event)
+        device = f"devices/pci0000:00/{controller}/1-2:1.0/input/input1/{event}"
+        os.makedirs(os.path.join(root, "sys", device))
+        symlink(f"../../{device}", os.path.join(root, "sys/class/input", event))
+
+    assert [device.name for device in list_input_devices(root, ["0000:05:00.0"])] == [
+        "usb-Logitech_USB_Receiver-event-kbd"]
+    assert len(list_input_devices(root)) == 2
+    with pytest.raises(ValueError, match="0000:05:00.0"):
+        resolve_input_devices(["usb-Razer_Keyboard-event-kbd"], root, ["0000:05:00.0"])
@@ -0,0 +1,67 @@
+import os
+
+import pytest
+
+from conftest import write
+from hostProbe import (parse_cpu_list, format_cpu_list, read_cpu_topology, read_l3_domains, read_numa_nodes,
+                       read_meminfo, probe_host, HostTopology)
+
+CPU_DIR = "sys/devices/system/cpu"
+
+@pytest.fixture
+def host(tmp_path):
+    """Two NUMA nodes with two SMT cores each, one L3 per node. CPU 7 is offline"""
+    root = str(tmp_path)
+    write(os.path.join(root, CPU_DIR, "online"), "0-6\n")
+    for cpu in range(8):
+        core = cpu % 4
+        topology = os.path.join(root, CPU_DIR, f"cpu{cpu}/topology")
+        write(os.path.join(topology, "physical_package_id"), f"{core // 2}\n")
+        write(os.path.join(topology, "core_id"), f"{core % 2}\n")
+        #Older kernels only have thread_siblings_list
+        siblings = "core_cpus_list" if cpu < 4 else "thread_siblings_list"
+        write(os.path.join(topology, siblings), f"{core},{core + 4}\n")
+        cache = os.path.join(root, CPU_DIR, f"cpu{cpu}/cache/index3")
+        write(os.path.join(cache, "level"), "3\n")
+        write(os.path.join(cache, "id"), f"{core // 2}\n")
+        write(os.path.join(cache, "size"), "32768K\n")
+        write(os.path.join(cache, "shared_cpu_list"), "0-1,4-5\n" if core < 2 else "2-3,6-7\n")
+    for node, cpus in ((0, "0-1,4-5"), (1, "2-3,6")):
+        write(os.path.join(root, f"sys/devices/system/node/node{node}/cpulist"), f"{cpus}\n")
+        write(os.path.join(root, f"sys/devices/system/node/node{node}/meminfo"),
+              f"Node {node} MemTotal:       16777216 kB\nNode {node} MemFree:        8388608 kB\n")
+    write(os.path.join(root, "proc/meminfo"), "MemTotal:       32768000 kB\nMemFree: 1 kB\nMemAvailable:   16384000 kB\n")
+    return root
+
+def test_cpu_list_round_trip():
+    assert parse_cpu_list("0-3,8,10-11\n") == [0, 1, 2, 3, 8, 10, 11]
+    assert parse_cpu_list("") == []
+    assert format_cpu_list([11, 0, 1, 2, 3, 8, 10]) == "0-3,8,10-11"
+
+def test_cores_group_smt_siblings(host):
+    cores = read_cpu_topology(host)
+    assert [core.cpus for core in cores] == [[0, 4], [1, 5], [2, 6], [3]]
+    assert [(core.package_id, core.core_id) for core in cores] == [(0, 0), (0, 1), (1, 0), (1, 1)]
+    assert [core.numa_node for core in cores] == [0, 0, 1, 1]
+    assert [core.l3_id for core in cores] == [0, 0, 1, 1]
+
+def test_l3_domains_and_numa_nodes(host):
+    domains = read_l3_domains(host)
+    assert [(domain.id, domain.cpus, domain.size_kb) for domain in domains] == [
+        (0, [0, 1, 4, 5], 32768), (1, [2, 3, 6, 7], 32768)]
+    nodes = read_numa_nodes(host)
+    assert [(node.id, node.cpus, node.total_mb, node.free_mb) for node in nodes] == [
+        (0, [0, 1, 4, 5], 16384, 8192), (1, [2, 3, 6], 16384, 8192)]
+
+def test_probe_host(host):
+    probed = probe_host(host)
+    assert (probed.sockets, probed.cores_per_socket, probed.threads_per_core) == (2, 2, 2)
+    assert probed.logical_cpus == [0, 1, 2, 3, 4, 5, 6]
+    assert (probed.total_memory_mb, probed.available_memory_mb) == read_meminfo(host) == (32000, 16000)
+    assert probed.free_disk_gb is not None
+    assert probed.core_of(6).cpus == [2, 6] and probed.core_of(7) is None
+
+def test_nothing_readable():
+    empty = HostTopology()
+    assert (empty.sockets, empty.cores_per_socket, empty.threads_per_core, empty.free_disk_gb) == (None,) * 4
+    assert empty.logical_cpus == []
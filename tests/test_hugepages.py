@@ -0,0 +1,28 @@
+from conftest import write
+from hugepages import record_reservation, total_kernel_params
+from kernelUpdates import mergeKernelOptions
+
+def test_boot_reservation_is_the_sum_of_all_vms(tmp_path):
+    root = str(tmp_path)
+    record_reservation("win1", 8192, "2M", root)
+    write(str(tmp_path / "etc/libvirt/qemu/win1.xml"), "<domain/>")
+    params = total_kernel_params(record_reservation("win2", 4096, "2M", root))
+    assert params == "default_hugepagesz=2M hugepagesz=2M hugepages=6144"
+
+    #Recreating a VM replaces its share instead of adding to it
+    params = total_kernel_params(record_reservation("win2", 2048, "2M", root))
+    assert params == "default_hugepagesz=2M hugepagesz=2M hugepages=5120"
+
+def test_undefined_vm_gives_its_pages_back(tmp_path):
+    root = str(tmp_path)
+    record_reservation("gone", 8192, "2M", root)
+    params = total_kernel_params(record_reservation("win", 4096, "1G", root))
+    assert params == "default_hugepagesz=1G hugepagesz=1G hugepages=4"
+
+def test_every_size_keeps_its_pair_on_the_cmdline(tmp_path):
+    root = str(tmp_path)
+    record_reservation("small", 1024, "2M", root)
+    write(str(tmp_path / "etc/libvirt/qemu/small.xml"), "<domain/>")
+    params = total_kernel_params(record_reservation("big", 16384, "1G", root))
+    cmdline = mergeKernelOptions("quiet default_hugepagesz=2M hugepagesz=2M hugepages=512", params)
+    assert cmdline == "quiet default_hugepagesz=1G hugepagesz=2M hugepages=512 hugepagesz=1G hugepages=16"
@@ -0,0 +1,37 @@
+import os
+
+import pytest
+
+from conftest import write
+from isoCache import IsoCache
+
+@pytest.fixture
+def cache(tmp_path):
+    for name in ("a.iso", "b.iso", "c.iso"):
+        with open(tmp_path / name, "wb") as f:
+            f.write(os.urandom(10000))
+    write(str(tmp_path / "qemu/win.xml"), "<domain/>")
+    return IsoCache(str(tmp_path / "cache"), max_bytes=25000, domain_xml_dir=str(tmp_path / "qemu"))
+
+def test_attached_iso_is_kept_until_released(cache, tmp_path):
+    attached = cache.add_file(str(tmp_path / "a.iso"))
+    cache.use(attached, "win")
+    cache.add_file(str(tmp_path / "b.iso"))
+    cache.add_file(str(tmp_path / "c.iso"))
+    assert os.path.exists(attached)
+
+    cache.release(attached, "win")
+    cache.add_file(str(tmp_path / "b.iso"))
+    assert not os.path.exists(attached)
+
+def test_undefined_vm_doesnt_hold_its_iso(cache, tmp_path):
+    attached = cache.add_file(str(tmp_path / "a.iso"))
+    cache.use(attached, "gone")
+    cache.add_file(str(tmp_path / "b.iso"))
+    cache.add_file(str(tmp_path / "c.iso"))
+    assert not os.path.exists(attached)
+
+def test_hard_link_keeps_the_users_mode(cache, tmp_path):
+    os.chmod(tmp_path / "a.iso", 0o600)
+    cache.add_file(str(tmp_path / "a.iso"))
+    assert os.stat(tmp_path / "a.iso").st_mode & 0o777 == 0o600
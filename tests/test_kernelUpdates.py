@@ -0,0 +1,22 @@
+from kernelUpdates import mergeKernelOptions, replaceOptions
+
+FIRST = "isolcpus=managed_irq,domain,2-3 nohz_full=2-3 rcu_nocbs=2-3 irqaffinity=0-1,4-7"
+SECOND = "isolcpus=managed_irq,domain,6-7 nohz_full=6-7 rcu_nocbs=6-7 irqaffinity=0-5"
+
+def test_second_vm_keeps_the_first_vms_cores_isolated():
+    cmdline = mergeKernelOptions("quiet splash", FIRST)
+    cmdline = mergeKernelOptions(cmdline, SECOND)
+    assert cmdline == ("quiet splash isolcpus=managed_irq,domain,2-3,6-7 nohz_full=2-3,6-7 "
+                       "rcu_nocbs=2-3,6-7 irqaffinity=0-1,4-5")
+
+def test_same_vm_again_changes_nothing():
+    cmdline = mergeKernelOptions("quiet", FIRST)
+    assert mergeKernelOptions(cmdline, FIRST) == cmdline
+
+def test_other_options_are_still_replaced():
+    assert mergeKernelOptions("iommu=soft quiet", "iommu=pt") == "quiet iommu=pt"
+
+def test_tools_get_the_joined_lists():
+    stale, add = replaceOptions(["quiet", "nohz_full=2-3", "irqaffinity=0-1,4-7"], "nohz_full=6-7 irqaffinity=0-5")
+    assert stale == ["nohz_full=2-3", "irqaffinity=0-1,4-7"]
+    assert add == ["nohz_full=2-3,6-7", "irqaffinity=0-1,4-5"]
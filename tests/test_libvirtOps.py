@@ -0,0 +1,43 @@
+import pytest
+
+pytest.importorskip("libvirt")
+
+from conftest import define_test_domain
+from libvirtOps import (start_domain, wait_for_shutoff, send_key, attach_disk, list_block_devices, start_network,
+                        connection)
+
+DISK = "<disk type='file' device='disk'><source file='/var/lib/libvirt/images/ops.qcow2'/><target dev='vda' bus='virtio'/></disk>"
+
+@pytest.fixture
+def domain(test_conn):
+    dom = define_test_domain(test_conn, "ops", DISK)
+    yield dom
+    if dom.isActive():
+        dom.destroy()
+    dom.undefine()
+
+def test_start_domain_and_wait_for_shutoff(test_conn, domain):
+    assert start_domain("ops", conn=test_conn)
+    assert not start_domain("ops", conn=test_conn)
+    assert not wait_for_shutoff("ops", timeout=0, conn=test_conn)
+    domain.destroy()
+    assert wait_for_shutoff("ops", timeout=0, conn=test_conn)
+
+def test_send_key_to_running_domain(test_conn, domain):
+    start_domain("ops", conn=test_conn)
+    send_key("ops", [28], conn=test_conn)
+
+def test_attach_disk_shows_in_block_devices(test_conn, domain):
+    assert list_block_devices("ops", conn=test_conn) == [("vda", "/var/lib/libvirt/images/ops.qcow2")]
+    attach_disk("ops", "/tmp/virtio-win.iso", "sdc", bus="sata", device="cdrom", readonly=True, conn=test_conn)
+    assert ("sdc", "/tmp/virtio-win.iso") in list_block_devices("ops", conn=test_conn)
+
+def test_start_network_sets_autostart(test_conn):
+    start_network("default", conn=test_conn)
+    network = test_conn.networkLookupByName("default")
+    assert network.isActive() and network.autostart()
+
+def test_given_connection_is_left_open(test_conn):
+    with connection(test_conn) as conn:
+        assert conn is test_conn
+    assert test_conn.isAlive()
@@ -0,0 +1,71 @@
+import pytest
+
+from conftest import add_pci
+from pciDevices import scan_pci, read_pci_device, pci_inventory, select_gpu, gpu_functions, find_gpu, CLASS_USB
+
+@pytest.fixture
+def host(tmp_path):
+    """Intel iGPU, an NVIDIA card with audio and USB-C functions, and a USB controller behind a bridge"""
+    root = str(tmp_path)
+    add_pci(root, "0000:00:01.0", 0x8086, 0x1901, 0x060400, driver="pcieport", iommu_group=1)
+    add_pci(root, "0000:00:02.0", 0x8086, 0x3e92, 0x030000, driver="i915", iommu_group=0, boot_vga=False)
+    add_pci(root, "0000:01:00.0", 0x10de, 0x1e87, 0x030000, driver="nvidia", iommu_group=1, numa_node=0,
+            boot_vga=True)
+    add_pci(root, "0000:01:00.1", 0x10de, 0x10f8, 0x040300, driver="snd_hda_intel", iommu_group=1)
+    add_pci(root, "0000:01:00.2", 0x10de, 0x1ad8, 0x0c0330, driver="xhci_hcd", iommu_group=1)
+    add_pci(root, "0000:05:00.0", 0x1b21, 0x2142, 0x0c0330, iommu_group=14)
+    return root
+
+def test_read_pci_device(host):
+    gpu = read_pci_device("0000:01:00.0", host)
+    assert (gpu.vendor, gpu.device, gpu.class_id) == (0x10de, 0x1e87, 0x0300)
+    assert (gpu.driver, gpu.iommu_group, gpu.numa_node, gpu.boot_vga) == ("nvidia", 1, 0, True)
+    assert (gpu.ids, gpu.slot, gpu.vendor_name) == ("10de:1e87", "0000:01:00", "NVIDIA")
+
+    usb = read_pci_device("0000:05:00.0", host)
+    #numa_node -1 means the platform doesn't say
+    assert (usb.driver, usb.numa_node, usb.boot_vga) == (None, None, False)
+
+def test_scan_pci(host):
+    inventory = scan_pci(host)
+    assert [device.bdf for device in inventory.gpus()] == ["0000:00:02.0", "0000:01:00.0"]
+    assert [device.bdf for device in inventory.of_class(CLASS_USB)] == ["0000:01:00.2", "0000:05:00.0"]
+
+def test_functions_and_iommu_group(host):
+    inventory = scan_pci(host)
+    gpu = inventory.devices["0000:01:00.0"]
+    assert [device.bdf for device in inventory.functions_of(gpu)] == ["0000:01:00.0", "0000:01:00.1", "0000:01:00.2"]
+    assert [device.bdf for device in inventory.iommu_group_of(gpu)] == [
+        "0000:00:01.0", "0000:01:00.0", "0000:01:00.1", "0000:01:00.2"]
+
+def test_scan_pci_without_sysfs(tmp_path):
+    assert scan_pci(str(tmp_path)).devices == {}
+
+def test_select_gpu_defaults_to_boot_display(host, monkeypatch):
+    monkeypatch.setattr("builtins.input", lambda prompt: "")
+    pci_inventory(host, refresh=True)
+    assert select_gpu(host).bdf == "0000:01:00.0"
+    assert [device.bdf for device in gpu_functions(host)] == ["0000:01:00.0", "0000:01:00.1", "0000:01:00.2"]
+
+def test_find_gpu(host):
+    pci_inventory(host, refresh=True)
+    assert find_gpu("boot_vga", host).bdf == "0000:01:00.0"
+    assert find_gpu("00:02.0", host).bdf == "0000:00:02.0"
+    with pytest.raises(ValueError, match="not a GPU"):
+        find_gpu("0000:01:00.1", host)
+
+def test_select_gpu_with_choice_never_asks(host, monkeypatch):
+    def no_input(prompt):
+        raise AssertionError("asked")
+    monkeypatch.setattr("builtins.input", no_input)
+    pci_inventory(host, refresh=True)
+    assert select_gpu(host, "0000:00:02.0").bdf == "0000:00:02.0"
+    assert [device.bdf for device in gpu_functions(host, "boot_vga")] == ["0000:01:00.0", "0000:01:00.1",
+                                                                          "0000:01:00.2"]
+
+def test_boot_vga_needs_a_boot_display(tmp_path):
+    root = str(tmp_path)
+    add_pci(root, "0000:01:00.0", 0x10de, 0x1e87, 0x030000, boot_vga=False)
+    add_pci(root, "0000:02:00.0", 0x1002, 0x73bf, 0x030000, boot_vga=False)
+    with pytest.raises(ValueError, match="boot display"):
+        find_gpu("boot_vga", root)
@@ -0,0 +1,38 @@
+import xml.etree.ElementTree as ET
+
+from storageTuning import volume_xml, apply_storage_profile, DiskAllocation, StorageProfile
+
+def test_volume_xml_keeps_the_qcow2_layout():
+    xml, metadata = volume_xml("win.qcow2", 50, DiskAllocation())
+    volume = ET.fromstring(xml)
+    assert metadata
+    assert volume.find("capacity").text == "50" and volume.find("allocation").text == "0"
+    assert volume.find("target/format").get("type") == "qcow2"
+    assert volume.find("target/clusterSize").text == str(128 * 1024)
+    assert volume.find("target/features/lazy_refcounts") is not None
+    assert volume.find("target/features/extended_l2") is not None
+
+def test_falloc_allocates_the_whole_volume():
+    xml, metadata = volume_xml("win.img", 50, DiskAllocation(format="raw", preallocation="falloc"))
+    volume = ET.fromstring(xml)
+    assert not metadata
+    assert volume.find("allocation").text == "50"
+    assert volume.find("target/clusterSize") is None
+
+def scsi_domain():
+    return ET.fromstring("<domain><vcpu>4</vcpu><devices><disk type='file' device='disk'>"
+                         "<source file='/images/win.qcow2'/><target dev='sdb' bus='sata'/></disk></devices></domain>")
+
+def test_scsi_controller_iothread_follows_the_profile():
+    root = scsi_domain()
+    apply_storage_profile(root, StorageProfile(bus="virtio-scsi", iothreads=1))
+    driver = root.find("devices/controller[@type='scsi']/driver")
+    assert driver.attrib == {"iothread": "1", "queues": "4"}
+    assert root.findtext("iothreads") == "1"
+
+    root = scsi_domain()
+    apply_storage_profile(root, StorageProfile(bus="virtio-scsi", iothreads=0))
+    driver = root.find("devices/controller[@type='scsi']/driver")
+    assert driver.attrib == {"queues": "4"}
+    assert root.find("iothreads") is None
+    assert root.find("devices/disk/target").attrib == {"dev": "sdb", "bus": "scsi"}
@@ -0,0 +1,55 @@
+import os
+
+import pytest
+
+from conftest import write, add_pci
+from usbControllers import plan_usb_controllers, resolve_usb_controllers, controller_buses
+
+def add_usb_device(root, port, ids, product, speed="480", interface_class="09"):
+    base = os.path.join(root, "sys/bus/usb/devices", port)
+    vendor, product_id = ids.split(":")
+    write(os.path.join(base, "idVendor"), vendor + "\n")
+    write(os.path.join(base, "idProduct"), product_id + "\n")
+    write(os.path.join(base, "product"), product + "\n")
+    write(os.path.join(base, "speed"), speed + "\n")
+    write(os.path.join(root, "sys/bus/usb/devices", f"{port}:1.0", "bInterfaceClass"), interface_class + "\n")
+
+@pytest.fixture
+def host(tmp_path):
+    """
+    The chipset controller shares its group with a SATA controller, the
+    ASMedia card is alone behind a bridge
+    """
+    root = str(tmp_path)
+    add_pci(root, "0000:00:14.0", 0x8086, 0xa36d, 0x0c0330, driver="xhci_hcd", iommu_group=5)
+    add_pci(root, "0000:00:17.0", 0x8086, 0xa352, 0x010601, driver="ahci", iommu_group=5)
+    add_pci(root, "0000:00:1c.0", 0x8086, 0xa33c, 0x060400, driver="pcieport", iommu_group=9)
+    add_pci(root, "0000:05:00.0", 0x1b21, 0x2142, 0x0c0330, driver="xhci_hcd", iommu_group=9)
+    for bdf, bus in (("0000:00:14.0", 1), ("0000:00:14.0", 2), ("0000:05:00.0", 3), ("0000:05:00.0", 4)):
+        os.makedirs(os.path.join(root, "sys/bus/pci/devices", bdf, f"usb{bus}"))
+    add_usb_device(root, "1-2", "046d:c52b", "USB Receiver", speed="12", interface_class="03")
+    add_usb_device(root, "3-1", "05e3:0610", "USB2.0 Hub")
+    add_usb_device(root, "3-1.4", "0781:5583", "Ultra Fit", speed="5000", interface_class="08")
+    return root
+
+def test_controller_buses(host):
+    assert controller_buses("0000:05:00.0", host) == [3, 4]
+    assert controller_buses("0000:99:00.0", host) == []
+
+def test_plan_usb_controllers(host):
+    asmedia, chipset = plan_usb_controllers(host)
+    #Isolated first, the bridge in its group doesn't count
+    assert asmedia.pci.bdf == "0000:05:00.0" and asmedia.isolated
+    assert [(device.port, device.ids, device.hid) for device in asmedia.devices] == [
+        ("3-1", "05e3:0610", False), ("3-1.4", "0781:5583", False)]
+
+    assert chipset.pci.bdf == "0000:00:14.0" and not chipset.isolated
+    assert [blocker.bdf for blocker in chipset.blockers] == ["0000:00:17.0"]
+    assert [(device.port, device.hid, device.speed) for device in chipset.devices] == [("1-2", True, "12")]
+
+def test_resolve_usb_controllers(host):
+    assert [controller.pci.bdf for controller in resolve_usb_controllers(["05:00.0"], host)] == ["0000:05:00.0"]
+    with pytest.raises(ValueError, match="shares its IOMMU group"):
+        resolve_usb_controllers(["0000:00:14.0"], host)
+    with pytest.raises(ValueError, match="not a USB controller"):
+        resolve_usb_controllers(["0000:00:17.0"], host)
@@ -0,0 +1,267 @@
+import base64
+import getpass
+import os
+import re
+import time
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass
+
+from hostProbe import IMAGES_PATH
+from isoWriter import write_iso
+from libvirtOps import start_domain, send_key, wait_for_shutoff
+
+BLUE = '\033[94m'
+RED = '\033[91m'
+YELLOW = '\033[93m'
+RESET = '\033[0m'
+
+UNATTEND_NS = "urn:schemas-microsoft-com:unattend"
+WCM_NS = "http://schemas.microsoft.com/WMIConfig/2002/State"
+
+#Windows installs, runs the first logon commands and powers off in well under this
+UNATTEND_TIMEOUT_MIN = 90
+#OVMF only boots the install media after "Press any key to boot from CD or DVD"
+BOOT_KEY_SECONDS = 20
+KEY_ENTER = 28
+
+#Drive letters the CD-ROMs can get in Windows PE and after setup
+DRIVE_LETTERS = "DEFGHIJK"
+VIRTIO_MSI = "virtio-win-gt-x64.msi"
+#Storage (viostor, vioscsi) is needed to see a virtio disk, NetKVM once the NIC is switched
+WINPE_DRIVERS = ("viostor", "vioscsi", "NetKVM")
+
+#Microsoft's generic installation keys: they pick the edition but don't activate
+GENERIC_KEYS = {
+    "Home": "YTMG3-N6DKC-DKB77-7M9GH-8HVX7",
+    "Pro": "VK7JG-NPHTM-C97JM-9MPGT-3V66T",
+    "Education": "YNMGQ-8RYV3-4PGQ3-C8XTP-7CFBY",
+    "Enterprise": "NPPR9-FWDCX-D2C8J-H872K-2YT43",
+}
+
+@dataclass
+class UnattendConfig:
+    """Answers for Windows Setup, the prompts of the installer and OOBE"""
+    user: str = "user"
+    password: str = ""
+    computer_name: str = None
+    locale: str = "en-US"
+    keyboard: str = None
+    timezone: str = "UTC"
+    edition: str = "Pro"
+
+def computer_name(vm_name):
+    """NetBIOS-safe computer name from the VM name: letters, digits and '-', at most 15"""
+    name = re.sub(r"[^A-Za-z0-9-]", "-", vm_name).strip("-")[:15] or "WINDOWS-VM"
+    return name if not name.isdigit() else f"VM-{name}"[:15]
+
+def _encode_password(password, suffix):
+    """The form Windows System Image Manager writes with PlainText false (obfuscated, not encrypted)"""
+    return base64.b64encode((password + suffix).encode("utf-16-le")).decode("ascii")
+
+def _sub(parent, tag, text=None, **attrs):
+    elem = ET.SubElement(parent, f"{{{UNATTEND_NS}}}{tag}",
+                         {(f"{{{WCM_NS}}}{k[4:]}" if k.startswith("wcm_") else k): str(v) for k, v in attrs.items()})
+    if text is not None:
+        elem.text = str(text)
+    return elem
+
+def _component(settings, name):
+    return _sub(settings, "component", name=name, processorArchitecture="amd64",
+                publicKeyToken="31bf3856ad364e35", language="neutral", versionScope="nonSxS")
+
+def _international(settings, name, config):
+    component = _component(settings, name)
+    if name.endswith("WinPE"):
+        setup_language = _sub(component, "SetupUILanguage")
+        _sub(setup_language, "UILanguage", config.locale)
+    _sub(component, "InputLocale", config.keyboard or config.locale)
+    _sub(component, "SystemLocale", config.locale)
+    _sub(component, "UILanguage", config.locale)
+    _sub(component, "UserLocale", config.locale)
+
+def _disk_configuration(setup):
+    """GPT for UEFI: EFI system (100MB), MSR (16MB) and Windows on the rest of disk 0"""
+    disk = _sub(_sub(setup, "DiskConfiguration"), "Disk", wcm_action="add")
+    _sub(disk, "DiskID", 0)
+    _sub(disk, "WillWipeDisk", "true")
+    create = _sub(disk, "CreatePartitions")
+    for order, (kind, size) in enumerate((("EFI", 100), ("MSR", 16), ("Primary", None)), 1):
+        partition = _sub(create, "CreatePartition", wcm_action="add")
+        _sub(partition, "Order", order)
+        _sub(partition, "Type", kind)
+        if size:
+            _sub(partition, "Size", size)
+        else:
+            _sub(partition, "Extend", "true")
+    modify = _sub(disk, "ModifyPartitions")
+    for order, (fs, label, letter) in enumerate((("FAT32", "System", None), (None, None, None),
+                                                 ("NTFS", "Windows", "C")), 1):
+        partition = _sub(modify, "ModifyPartition", wcm_action="add")
+        _sub(partition, "Order", order)
+        _sub(partition, "PartitionID", order)
+        if fs:
+            _sub(partition, "Format", fs)
+            _sub(partition, "Label", label)
+        if letter:
+            _sub(partition, "Letter", letter)
+
+def _windows_pe(root, config, os_variant):
+    settings = _sub(root, "settings", **{"pass": "windowsPE"})
+    _international(settings, "Microsoft-Windows-International-Core-WinPE", config)
+
+    #Load the virtio storage drivers so setup sees a virtio disk
+    pnp = _component(settings, "Microsoft-Windows-PnpCustomizationsWinPE")
+    paths = _sub(pnp, "DriverPaths")
+    os_dir = "w11" if os_variant == "win11" else "w10"
+    key = 1
+    for letter in DRIVE_LETTERS:
+        for driver in WINPE_DRIVERS:
+            entry = _sub(paths, "PathAndCredentials", wcm_action="add", wcm_keyValue=key)
+            _sub(entry, "Path", f"{letter}:\\{driver}\\{os_dir}\\amd64")
+            key += 1
+
+    setup = _component(settings, "Microsoft-Windows-Setup")
+    _disk_configuration(setup)
+    image = _sub(_sub(setup, "ImageInstall"), "OSImage")
+    install_to = _sub(image, "InstallTo")
+    _sub(install_to, "DiskID", 0)
+    _sub(install_to, "PartitionID", 3)
+    if config.edition:
+        #install.wim image names look like 'Windows 11 Pro'
+        metadata = _sub(_sub(image, "InstallFrom"), "MetaData", wcm_action="add")
+        _sub(metadata, "Key", "/IMAGE/NAME")
+        _sub(metadata, "Value", f"Windows {'11' if os_variant == 'win11' else '10'} {config.edition}")
+    user_data = _sub(setup, "UserData")
+    _sub(user_data, "AcceptEula", "true")
+    product_key = _sub(user_data, "ProductKey")
+    _sub(product_key, "Key", GENERIC_KEYS.get(config.edition, ""))
+    _sub(product_key, "WillShowUI", "OnError")
+
+def _specialize(root, config):
+    settings = _sub(root, "settings", **{"pass": "specialize"})
+    shell = _component(settings, "Microsoft-Windows-Shell-Setup")
+    _sub(shell, "ComputerName", config.computer_name)
+    _sub(shell, "TimeZone", config.timezone)
+
+def first_logon_commands():
+    """Install the virtio-win drivers from whichever CD has them, then power off"""
+    letters = " ".join(DRIVE_LETTERS)
+    return [
+        ("Install the VirtIO drivers",
+         f"cmd /c \"for %d in ({letters}) do @if exist %d:\\{VIRTIO_MSI} "
+         f"start /wait msiexec /i %d:\\{VIRTIO_MSI} /qn /norestart\""),
+        #wait_for_shutoff on the host takes this as the end of the install
+        ("Power off once setup is done", "shutdown /s /t 30 /c \"Windows setup finished\""),
+    ]
+
+def _oobe_system(root, config):
+    settings = _sub(root, "settings", **{"pass": "oobeSystem"})
+    _international(settings, "Microsoft-Windows-International-Core", config)
+    shell = _component(settings, "Microsoft-Windows-Shell-Setup")
+
+    oobe = _sub(shell, "OOBE")
+    for tag in ("HideEULAPage", "HideOEMRegistrationScreen", "HideOnlineAccountScreens", "HideWirelessSetupInOOBE"):
+        _sub(oobe, tag, "true")
+    _sub(oobe, "ProtectYourPC", 3)
+
+    account = _sub(_sub(_sub(shell, "UserAccounts"), "LocalAccounts"), "LocalAccount", wcm_action="add")
+    password = _sub(account, "Password")
+    _sub(password, "Value", _encode_password(config.password, "Password"))
+    _sub(password, "PlainText", "false")
+    _sub(account, "Group", "Administrators")
+    _sub(account, "Name", config.user)
+    _sub(account, "DisplayName", config.user)
+
+    #Log in once so the first logon commands run
+    auto_logon = _sub(shell, "AutoLogon")
+    password = _sub(auto_logon, "Password")
+    _sub(password, "Value", _encode_password(config.password, "Password"))
+    _sub(password, "PlainText", "false")
+    _sub(auto_logon, "Enabled", "true")
+    _sub(auto_logon, "LogonCount", 1)
+    _sub(auto_logon, "Username", config.user)
+
+    commands = _sub(shell, "FirstLogonCommands")
+    for order, (description, command) in enumerate(first_logon_commands(), 1):
+        synchronous = _sub(commands, "SynchronousCommand", wcm_action="add")
+        _sub(synchronous, "Order", order)
+        _sub(synchronous, "Description", description)
+        _sub(synchronous, "CommandLine", command)
+
+def autounattend_xml(config, os_variant="win11"):
+    """
+    Render autounattend.xml: locale, disk layout, virtio storage drivers in
+    Windows PE, a local administrator and the virtio-win MSI at first logon
+
+    Returns:
+        The XML document as bytes
+    """
+    ET.register_namespace("", UNATTEND_NS)
+    ET.register_namespace("wcm", WCM_NS)
+    root = ET.Element(f"{{{UNATTEND_NS}}}unattend")
+    _windows_pe(root, config, os_variant)
+    _specialize(root, config)
+    _oobe_system(root, config)
+    ET.indent(root)
+    return ET.tostring(root, encoding="utf-8", xml_declaration=True)
+
+def write_unattend_iso(vm_name, config, os_variant="win11", directory=IMAGES_PATH):
+    """
+    Pack autounattend.xml into <vm>_unattend.iso. Windows Setup reads it
+    from the root of any CD-ROM
+
+    Returns:
+        Path of the ISO
+    """
+    config.computer_name = config.computer_name or computer_name(vm_name)
+    path = os.path.join(directory, f"{vm_name}_unattend.iso")
+    write_iso(path, {"autounattend.xml": autounattend_xml(config, os_variant)}, volume_id="UNATTEND")
+    print(f"Answer file written to {path} (user {BLUE}{config.user}{RESET}, {config.locale}, {config.timezone})")
+    return path
+
+def prompt_unattend(vm_name):
+    """
+    Ask whether Windows should install itself and collect the account it creates
+
+    Returns:
+        UnattendConfig or None for the manual install
+    """
+    unattended = input("Install Windows unattended (no clicking through setup) (Y/n)? ").strip().lower()
+    if unattended not in ("yes", "y", ""):
+        return None
+
+    config = UnattendConfig()
+    config.user = input(f"Windows user name (Default {YELLOW}{config.user}{RESET}): ").strip() or config.user
+    while True:
+        password = getpass.getpass("Windows password: 🔑")
+        if password == getpass.getpass("Repeat the password: 🔑"):
+            break
+        print("Passwords don't match, try again")
+    config.password = password
+    config.locale = input(f"Language/locale (Default {YELLOW}{config.locale}{RESET}): ").strip() or config.locale
+    config.timezone = input(f"Windows time zone (Default {YELLOW}{config.timezone}{RESET}, "
+                            "e.g. Pacific Standard Time): ").strip() or config.timezone
+    config.edition = input(f"Edition (Default {YELLOW}{config.edition}{RESET}): ").strip() or config.edition
+    config.computer_name = computer_name(vm_name)
+    return config
+
+def install_unattended(vm_name, timeout_min=UNATTEND_TIMEOUT_MIN):
+    """
+    Boot the installer and wait for the VM to power itself off after the
+    first logon commands
+
+    Returns:
+        True once Windows and the VirtIO drivers are installed
+    """
+    start_domain(vm_name)
+    print(f"Installing Windows in '{vm_name}' unattended, this takes 15 to 40 minutes...")
+    deadline = time.monotonic() + BOOT_KEY_SECONDS
+    while time.monotonic() < deadline:
+        send_key(vm_name, [KEY_ENTER])
+        time.sleep(1)
+    if not wait_for_shutoff(vm_name, timeout_min * 60, interval=15):
+        print(f"🚨 Error 🚨 {RED}'{vm_name}' was still running after {timeout_min} minutes{RESET}. "
+              "Check the console in virt-manager")
+        return False
+    print(f"Windows is installed in '{vm_name}' ✅")
+    return True
@@ -0,0 +1,167 @@
+import os
+import re
+from dataclasses import dataclass, field
+
+from pciDevices import pci_inventory, describe, CLASS_USB
+
+BLUE = '\033[94m'
+GREEN = '\033[92m'
+RED = '\033[91m'
+YELLOW = '\033[93m'
+RESET = '\033[0m'
+
+USB_DEVICES = "sys/bus/usb/devices"
+#PCI bridges share the group with what is behind them without having to be passed through
+CLASS_BRIDGE = 0x06
+#bInterfaceClass of keyboards and mice
+USB_CLASS_HID = "03"
+
+def _read(path, default=None):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return default
+
+@dataclass
+class UsbPortDevice:
+    """Something plugged into a controller: port path (1-2.3), ids, name and speed"""
+    port: str
+    ids: str
+    name: str
+    speed: str = None
+    hid: bool = False
+
+@dataclass
+class UsbController:
+    """A USB host controller (PCI class 0x0c03) and what hangs off it"""
+    pci: object
+    buses: list = field(default_factory=list)
+    devices: list = field(default_factory=list)
+    blockers: list = field(default_factory=list)   #other devices in its IOMMU group
+
+    @property
+    def isolated(self):
+        return not self.blockers
+
+def controller_buses(bdf, root="/"):
+    """USB bus numbers of the root hubs a controller provides (usb1, usb2 -> [1, 2])"""
+    try:
+        entries = os.listdir(os.path.join(root, "sys/bus/pci/devices", bdf))
+    except OSError:
+        return []
+    return sorted(int(match.group(1)) for match in map(re.compile(r"usb(\d+)").fullmatch, entries) if match)
+
+def _is_hid(directory, name):
+    """True if any interface of the device (1-2:1.0, 1-2:1.1, ...) is a keyboard/mouse"""
+    try:
+        entries = os.listdir(directory)
+    except OSError:
+        return False
+    return any(entry.startswith(f"{name}:") and _read(os.path.join(directory, entry, "bInterfaceClass")) == USB_CLASS_HID
+               for entry in entries)
+
+def bus_devices(buses, root="/"):
+    """UsbPortDevices plugged into the given buses, hubs included"""
+    directory = os.path.join(root, USB_DEVICES)
+    try:
+        entries = sorted(os.listdir(directory))
+    except OSError:
+        return []
+    devices = []
+    for name in entries:
+        #1-2.3 is a device, usb1 a root hub, 1-2:1.0 an interface
+        match = re.fullmatch(r"(\d+)-[\d.]+", name)
+        if not match or int(match.group(1)) not in buses:
+            continue
+        base = os.path.join(directory, name)
+        product = " ".join(filter(None, [_read(os.path.join(base, "manufacturer")), _read(os.path.join(base, "product"))]))
+        devices.append(UsbPortDevice(
+            port=name,
+            ids=f"{_read(os.path.join(base, 'idVendor'), '????')}:{_read(os.path.join(base, 'idProduct'), '????')}",
+            name=product or "unknown device",
+            speed=_read(os.path.join(base, "speed")),
+            hid=_is_hid(directory, name),
+        ))
+    return devices
+
+def plan_usb_controllers(root="/"):
+    """
+    Every USB controller with its ports and whether it can be passed through
+    on its own: nothing but PCI bridges may share its IOMMU group
+
+    Returns:
+        List of UsbController, isolated ones first
+    """
+    inventory = pci_inventory(root)
+    controllers = []
+    for device in inventory.of_class(CLASS_USB):
+        buses = controller_buses(device.bdf, root)
+        blockers = [] if device.iommu_group is not None else [device]
+        blockers += [other for other in inventory.iommu_group_of(device)
+                     if other is not device and other.class_id >> 8 != CLASS_BRIDGE]
+        controllers.append(UsbController(pci=device, buses=buses, devices=bus_devices(buses, root),
+                                         blockers=blockers))
+    return sorted(controllers, key=lambda controller: (not controller.isolated, controller.pci.bdf))
+
+def print_usb_controller(number, controller):
+    state = f"{GREEN}isolated{RESET}" if controller.isolated else f"{RED}shares its IOMMU group{RESET}"
+    print(f"  {BLUE}{number}{RESET}) {describe(controller.pci)} {state}")
+    for blocker in controller.blockers:
+        print(f"       ✗ {blocker.bdf} [{blocker.ids}] ({blocker.driver or 'no driver'})")
+    if not controller.devices:
+        print("       (no devices plugged in)")
+    for device in controller.devices:
+        hid = f" {YELLOW}keyboard/mouse{RESET}" if device.hid else ""
+        speed = f" {device.speed}Mb/s" if device.speed else ""
+        print(f"       port {device.port:<8} {device.ids} {device.name}{speed}{hid}")
+
+def resolve_usb_controllers(bdfs, root="/"):
+    """UsbControllers for PCI addresses (from a spec file), ones that aren't isolated raise ValueError"""
+    controllers = {controller.pci.bdf: controller for controller in plan_usb_controllers(root)}
+    chosen = []
+    for bdf in bdfs:
+        controller = controllers.get(bdf if bdf.count(":") == 2 else f"0000:{bdf}")
+        if controller is None:
+            raise ValueError(f"{bdf} is not a USB controller")
+        if not controller.isolated:
+            raise ValueError(f"USB controller {bdf} shares its IOMMU group with "
+                             f"{', '.join(blocker.bdf for blocker in controller.blockers)}")
+        chosen.append(controller)
+    return chosen
+
+def prompt_usb_controllers(root="/"):
+    """
+    Offer the isolated USB controllers for passthrough
+
+    Returns:
+        List of chosen UsbController, empty to skip
+    """
+    controllers = plan_usb_controllers(root)
+    usable = [controller for controller in controllers if controller.isolated]
+    if not usable:
+        if controllers:
+            print("No USB controller has an IOMMU group of its own, so none can be passed through")
+        return []
+
+    print("A whole USB controller gives the VM its ports directly, without QEMU's emulated USB:")
+    for number, controller in enumerate(controllers, 1):
+        print_usb_controller(number, controller)
+    answer = input("Controllers to pass through, e.g. 1,2 (Enter to skip): ").strip()
+    if not answer:
+        return []
+    chosen = []
+    for part in answer.split(","):
+        part = part.strip()
+        if not part.isdigit() or not 1 <= int(part) <= len(controllers):
+            print(f"Invalid input '{part}', skipped")
+            continue
+        controller = controllers[int(part) - 1]
+        if not controller.isolated:
+            print(f"🚨 Error 🚨 : {controller.pci.bdf} shares its IOMMU group, skipped")
+            continue
+        if any(device.hid for device in controller.devices):
+            print(f"⚠️  Note ⚠️ : The keyboard/mouse on {controller.pci.bdf} will only work in the VM while it runs")
+        if controller not in chosen:
+            chosen.append(controller)
+    return chosen
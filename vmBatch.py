@@ -0,0 +1,93 @@
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+GREEN = '\033[92m'
+RED = '\033[91m'
+YELLOW = '\033[93m'
+RESET = '\033[0m'
+
+class ThreadLogRouter:
+    """
+    Stand-in for sys.stdout/sys.stderr that sends each worker thread's
+    prints to that thread's log file. Other threads keep the real stream
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def attach(self, log):
+        self.local.log = log
+
+    def detach(self):
+        self.local.log = None
+
+    def write(self, text):
+        log = getattr(self.local, "log", None)
+        return (log or self.stream).write(text)
+
+    def flush(self):
+        log = getattr(self.local, "log", None)
+        (log or self.stream).flush()
+
+    def isatty(self):
+        return False
+
+def _provision(spec, run_vm, log_dir, routers):
+    """Run one VM in the current worker thread with stdout/stderr going to its log"""
+    log_path = os.path.join(log_dir, f"{spec.name}.log")
+    progress_file = os.path.join(log_dir, f"{spec.name}.progress.json")
+    start = time.monotonic()
+    with open(log_path, "a", buffering=1) as log:
+        for router in routers:
+            router.attach(log)
+        try:
+            print(f"===== {spec.name} {time.strftime('%Y-%m-%d %H:%M:%S')} =====")
+            ok = run_vm(spec, progress_file)
+        except (Exception, SystemExit) as e:
+            #A stray sys.exit or error in one VM must not take the other workers down
+            print(f"🚨 Error 🚨 provisioning {spec.name}: {e}")
+            ok = False
+        finally:
+            for router in routers:
+                router.detach()
+    return spec.name, bool(ok), time.monotonic() - start, log_path
+
+def run_batch(options, run_vm):
+    """
+    Provision every VM of a BatchOptions with at most options.workers at a time
+
+    Args:
+        options: BatchOptions from vmSpec.load_specs
+        run_vm: Callable (spec, progress_file) -> True when the VM is fully set up
+
+    Returns:
+        List of (vm name, ok, seconds, log path)
+    """
+    os.makedirs(options.log_dir, exist_ok=True)
+    workers = min(options.workers, len(options.vms)) or 1
+    print(f"Provisioning {len(options.vms)} VM(s) with {workers} worker(s), logs in {options.log_dir}/")
+
+    routers = [ThreadLogRouter(sys.stdout), ThreadLogRouter(sys.stderr)]
+    sys.stdout, sys.stderr = routers
+    results = []
+    start = time.monotonic()
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="provision") as pool:
+            futures = [pool.submit(_provision, spec, run_vm, options.log_dir, routers) for spec in options.vms]
+            for future in as_completed(futures):
+                name, ok, seconds, log_path = future.result()
+                results.append((name, ok, seconds, log_path))
+                state = f"{GREEN}done{RESET}" if ok else f"{YELLOW}stopped{RESET}"
+                routers[0].stream.write(f"  - {name:<20} {state} in {seconds:.0f}s ({log_path})\n")
+    finally:
+        sys.stdout, sys.stderr = routers[0].stream, routers[1].stream
+
+    elapsed = max(time.monotonic() - start, 1e-6)
+    done = sum(1 for _, ok, _, _ in results if ok)
+    print(f"{done}/{len(results)} VM(s) finished in {elapsed:.0f}s ({done / elapsed * 3600:.1f} VMs/hour)")
+    if done < len(results):
+        print(f"Check the logs of the {RED}stopped{RESET} VMs and rerun the same spec to resume them")
+    return results
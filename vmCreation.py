@@ -4,7 +4,27 @@ import libvirt
 import getpass
 import socket
 import sys
-from getISO import virtioDrivers, get_windows_iso
+import threading
+from functools import partial
+from getISO import virtioDrivers, get_windows_iso, make_iso_readable
+from isoCache import IsoCache
+from isoInspector import check_windows_iso
+from unattend import prompt_unattend, write_unattend_iso, install_unattended
+from hostProbe import probe_host, HostTopology, format_cpu_list
+from numaPlacement import find_node, check_node_memory
+from pciDevices import select_gpu
+from cpuPinning import plan_cpu_pinning, print_pin_plan
+from hugepages import (supported_sizes, pages_needed, check_hugepages, reserve_hugepages,
+                       record_reservation, total_kernel_params)
+from kernelUpdates import kernelBootChanges_no_prompt
+from storageTuning import (StorageProfile, STORAGE_BUSES, IO_MODES, apply_storage_profile, DiskAllocation,
+                           DISK_FORMATS, PREALLOCATIONS, CLUSTER_SIZES, validate_allocation)
+from storageBench import compare_io_modes, compare_disk_allocations
+from domainXml import apply_transforms, print_diff
+from libvirtOps import start_network, connection
+from domainBuilder import VmConfig, define_vm
+from blockBackend import (prompt_disk_backend, device_in_use, block_disk_transform, copy_image_to_device)
+from guestLatency import check_vm_latency_profile
 
 BLUE = '\033[94m'
 GREEN = '\033[92m'
@@ -14,55 +34,35 @@ PURPLE = '\033[35m'
 ORANGE = '\033[38;5;214m'
 RESET = '\033[0m'
 
+#Serializes host-wide changes (kernel cmdline, hugepage pool) when several VMs are provisioned at once
+HOST_LOCK = threading.Lock()
+
 def get_sys_info():
-    """Retrieve the current system's CPU info"""
+    """Retrieve the current system's CPU, memory and images pool info"""
     try:
-        #Grabbing CPU info
-        cpu_info = subprocess.check_output("lscpu", shell=True, text=True)
-        
-        #Parse the output to get the number of cores, threads, and sockets
-        cores = None
-        threads = None
-        sockets = None
-        for line in cpu_info.splitlines():
-            if "Core(s) per socket:" in line:
-                cores = int(line.split(":")[1].strip())
-            elif "Thread(s) per core:" in line:
-                threads = int(line.split(":")[1].strip())
-            elif "Socket(s):" in line:
-                sockets = int(line.split(":")[1].strip())
-
-        #Get total memory (in MB)
-        memory_info = subprocess.check_output("free -m", shell=True, text=True)
-        total_memory = None
-        for line in memory_info.splitlines():
-            if "Mem:" in line:
-                total_memory = int(line.split()[1])
-
-        #Getting free disk space
-        disk_info = subprocess.check_output("df -h", shell=True, text=True)
-        free_disk_space = None
-        for line in disk_info.splitlines():
-            if line.endswith(" /"):  # Root mount
-                parts = line.split()
-                if len(parts) >= 4 and parts[3].endswith('G'):
-                    free_disk_space = float(parts[3][:-1])  # Strip 'G' and convert to float
-
-        return cores, threads, sockets, total_memory, free_disk_space
-    
-    except Exception as e:
+        host = probe_host()
+        return (host.cores_per_socket, host.threads_per_core, host.sockets,
+                host.total_memory_mb, host.free_disk_gb)
+
+    except (OSError, ValueError) as e:
         print(f"🚨 Error 🚨 fetching CPU info: {RED}{e}{RESET}")
-        return None, None, None
+        return None, None, None, None, None
     
 def get_vm_config():
     """Prompt the user for VM configuration"""
     print("Please provide the following VM configuration:")
 
-    cores, threads, sockets, total_memory, free_disk_space = get_sys_info()
-    vcpus = sockets * cores * threads
+    try:
+        host = probe_host()
+    except (OSError, ValueError) as e:
+        print(f"🚨 Error 🚨 fetching CPU info: {RED}{e}{RESET}")
+        host = HostTopology()
+    cores, threads, sockets = host.cores_per_socket, host.threads_per_core, host.sockets
+    total_memory, available_memory = host.total_memory_mb, host.available_memory_mb
+    free_disk_space = host.free_disk_gb
 
-    #Fix this conditional
     if cores and threads and sockets:
+        vcpus = len(host.logical_cpus)
         print(f"\nCurrent system info:")
         print(f"  - Number of total logical CPUs:   {BLUE}{vcpus}{RESET}")
         print(f"  - Number of sockets:              {BLUE}{sockets}{RESET}")
@@ -72,9 +72,14 @@ def get_vm_config():
         print(f"  - Free storage space:             {ORANGE}{free_disk_space}GB{RESET}")
         print("====================================================")
         print(f"  - Total memory:                   {YELLOW}{total_memory}MB{RESET}")
+        print(f"  - Available memory:               {YELLOW}{available_memory}MB{RESET}")
     else:
         print("Unable to retrieve CPU information. Please enter the values manually")
 
+    #NUMA node of the GPU
+    numa_node = detect_gpu_numa_node(host)
+    numa_cpus = numa_node.cpus if numa_node else None
+
     #Name
     vmPrompt = f"Enter the name of the VM (Default {PURPLE}Windows_VM{RESET}): "
     vm_name = input(vmPrompt) or "Windows_VM"
@@ -85,9 +90,15 @@ def get_vm_config():
             memoryInput = input(f"Enter the amount of memory in MB (e.g., {YELLOW}4096{RESET} for {YELLOW}4GB{RESET}): ")
             memory = int(memoryInput)
             
-            if memory > total_memory:
+            #Unknown when /proc/meminfo couldn't be read
+            if total_memory and memory > total_memory:
                 print(f"🚨 Error 🚨 : Memory value cannot exceed total system memory ({YELLOW}{total_memory}MB{RESET}). Try again")
             else:
+                if available_memory and memory > available_memory:
+                    print(f"⚠️  Note ⚠️ : Only {YELLOW}{available_memory}MB{RESET} is currently available. The host may swap while the VM runs")
+                node_warning = check_node_memory(numa_node, memory) if numa_node else None
+                if node_warning:
+                    print(node_warning)
                 break
         except ValueError:
             print("Invalid input! Please enter only a valid number for memory as shown below!")
@@ -95,6 +106,9 @@ def get_vm_config():
             print("16384MB    ❌")
             print("16384      ✅")
 
+    #Hugepages
+    hugepage_size = prompt_hugepages(memory)
+
     #Storage
     while True:
         try:
@@ -102,7 +116,8 @@ def get_vm_config():
             diskSizeInput = input(diskSizePrompt)
             diskSize = int(diskSizeInput)
             
-            if diskSize > free_disk_space:
+            #Unknown when the images directory couldn't be checked
+            if free_disk_space is not None and diskSize > free_disk_space:
                 print(f"🚨 Error 🚨 : storage value cannot exceed total system free disk space ({ORANGE}{free_disk_space}GB{RESET}). Try again")
             else:
                 break
@@ -110,61 +125,246 @@ def get_vm_config():
             print("Invalid input! Please enter only a valid number (in GB) for storage as shown below!")
             print("50GB     ❌")
             print("50       ✅")
+    disk_backend = prompt_disk_backend(vm_name)
+    disk_allocation = None if disk_backend else prompt_disk_allocation()
+
+    #CPU pinning
+    pin_plan = None
+    if host.cores and len(host.cores) > 1:
+        pin_input = input("Pin vCPUs to dedicated host cores automatically (Y/n)? ").strip().lower()
+        if pin_input in ("yes", "y", ""):
+            pin_plan = prompt_pin_plan(host, numa_cpus)
+
+    numa_id = numa_node.id if numa_node else None
+    if pin_plan:
+        return VmConfig(name=vm_name, memory_mb=memory, disk_size_gb=diskSize,
+                        sockets=pin_plan.sockets, cores=pin_plan.cores, threads=pin_plan.threads,
+                        pin_plan=pin_plan, hugepage_size=hugepage_size, numa_node=numa_id,
+                        disk_allocation=disk_allocation, disk_backend=disk_backend)
 
     #CPU
     defaultCores = cores - 1
+    if numa_node:
+        #Keep the default guest inside the GPU's node
+        sockets = 1
+        #core_id repeats across packages and offline CPUs have no core
+        node_cores = {(core.package_id, core.core_id) for core in map(host.core_of, numa_cpus) if core}
+        defaultCores = max(1, len(node_cores) - 1)
     promptSockets = f"Enter number of CPU sockets (default {BLUE}{sockets}{RESET}): "
     promptCores = f"Enter number of CPU cores per socket (Default {BLUE}{defaultCores}{RESET}): "
     promptThreads = f"Enter number of threads per core (Default {BLUE}{threads}{RESET}): "
     sockets = input(promptSockets) or str(sockets)
     cores = input(promptCores) or str(defaultCores)
     threads = input(promptThreads) or str(threads)
-    tvcpus = int(sockets) * int(cores) * int(threads)
 
-    return vm_name, memory, tvcpus, diskSize, sockets, cores, threads
+    return VmConfig(name=vm_name, memory_mb=memory, disk_size_gb=diskSize,
+                    sockets=int(sockets), cores=int(cores), threads=int(threads),
+                    hugepage_size=hugepage_size, numa_node=numa_id, disk_allocation=disk_allocation,
+                    disk_backend=disk_backend)
+
+def _choose(prompt, options, default):
+    while True:
+        value = input(f"{prompt} {'/'.join(options)} (Default {BLUE}{default}{RESET}): ").strip() or default
+        if value in options:
+            return value
+        print(f"Invalid input! Choose one of: {', '.join(options)}")
+
+def prompt_disk_allocation():
+    """Ask how the main disk image should be laid out. Returns a DiskAllocation"""
+    allocation = DiskAllocation()
+    print(f"Disk image: {BLUE}{allocation.format}{RESET}, {allocation.cluster_size} clusters with subclusters, "
+          f"{allocation.preallocation} preallocation, lazy refcounts")
+    keep = input("Keep this disk layout (Y/n)? ").strip().lower()
+    if keep in ("yes", "y", ""):
+        return allocation
+
+    bench = input("Benchmark the candidate layouts on this host first (y/N)? ").strip().lower()
+    if bench in ("yes", "y"):
+        compare_disk_allocations()
+
+    while True:
+        allocation.format = _choose("Disk format", DISK_FORMATS, allocation.format)
+        default_prealloc = "falloc" if allocation.format == "raw" else allocation.preallocation
+        allocation.preallocation = _choose("Preallocation", PREALLOCATIONS, default_prealloc)
+        if allocation.format == "qcow2":
+            allocation.cluster_size = _choose("Cluster size", CLUSTER_SIZES, allocation.cluster_size)
+            allocation.extended_l2 = input("Subclusters (extended_l2) (Y/n)? ").strip().lower() in ("yes", "y", "")
+            allocation.lazy_refcounts = input("Lazy refcounts (Y/n)? ").strip().lower() in ("yes", "y", "")
+        try:
+            validate_allocation(allocation)
+            return allocation
+        except ValueError as e:
+            print(f"🚨 Error 🚨 : {e}. Try again")
+
+def detect_gpu_numa_node(host, gpu_choice=None):
+    """
+    On multi-node hosts return the NumaNode the passthrough GPU is attached to
+
+    Args:
+        gpu_choice: PCI address or 'boot_vga' from a spec file, asked for when None
+    """
+    if len(host.numa_nodes) < 2:
+        return None
+
+    gpu = select_gpu(choice=gpu_choice)
+    if gpu is None:
+        return None
+    node = find_node(host, gpu.numa_node)
+    if node is None:
+        print("The platform doesn't report a NUMA node for the GPU. VM placement is left to the kernel")
+        return None
 
-def create_vm(distro):
-    """Use virt-install to create a VM using the provided Windows ISO"""
+    print(f"GPU {gpu.bdf} is attached to NUMA node {BLUE}{node.id}{RESET} "
+          f"(CPUs {BLUE}{format_cpu_list(node.cpus)}{RESET}, {YELLOW}{node.free_mb}MB{RESET} free)")
+    print("vCPUs and memory will be kept on this node")
+    return node
+
+def prompt_hugepages(memory):
+    """Ask whether to back guest memory with hugepages and which size to use"""
+    sizes = supported_sizes()
+    if not sizes:
+        return None
+
+    use_hugepages = input("Back the VM memory with hugepages (y/N)? ").strip().lower()
+    if use_hugepages not in ("yes", "y"):
+        return None
+
+    default_size = "1G" if "1G" in sizes and memory % 1024 == 0 else "2M"
+    while True:
+        size = input(f"Hugepage size {'/'.join(sizes)} (Default {YELLOW}{default_size}{RESET}): ").strip().upper() or default_size
+        if size in sizes:
+            break
+        print(f"Invalid input! Choose one of: {', '.join(sizes)}")
 
-    iso_file = get_windows_iso()
-    vm_name, memory, vcpus, diskSize, sockets, cores, threads = get_vm_config()
+    print(f"{YELLOW}{pages_needed(memory, size)}{RESET} x {size} hugepages will be reserved for the VM")
+    return size
+
+def prepare_hugepages(vm_name, memory, hugepage_size, distro):
+    """Reserve hugepages at boot and check enough are free to back the VM memory now"""
+    with HOST_LOCK:
+        try:
+            #The boot reservation covers every hugepage-backed VM, not just this one
+            params = total_kernel_params(record_reservation(vm_name, memory, hugepage_size))
+            print(f"Adding kernel options: {YELLOW}{params}{RESET}")
+            kernelBootChanges_no_prompt(distro, kernel_params=params)
+        except (OSError, subprocess.CalledProcessError) as e:
+            #The pool can still be grown at runtime below, it just won't survive a reboot
+            print(f"🚨 Error 🚨 adding the hugepage kernel options: {RED}{e}{RESET}")
+
+        ok, message = check_hugepages(memory, hugepage_size)
+        if not ok:
+            print(f"{message}. Trying to reserve them now...")
+            reserve_hugepages(memory, hugepage_size)
+            ok, message = check_hugepages(memory, hugepage_size)
+    print(message)
+
+    if not ok:
+        print(f"⚠️  Note ⚠️ : Hugepages were not applied to {vm_name}, the VM could not start without them")
+        print("Reboot so the kernel options reserve the pages, then run this step again")
+    return ok
+
+def prepare_boot_isolation(pin_plan, distro):
+    """Write the latency profile for the guest cores through the distro's bootloader path"""
+    try:
+        with HOST_LOCK:
+            kernelBootChanges_no_prompt(distro, kernel_params="", isolated_cpus=pin_plan.guest_cpus)
+    except (ValueError, OSError, subprocess.CalledProcessError) as e:
+        print(f"🚨 Error 🚨 adding the latency profile: {RED}{e}{RESET}")
+        return False
+    print("Reboot for the guest cores to leave the host scheduler. Until then the hooks isolate them while the VM runs")
+    return True
+
+def prompt_pin_plan(host, allowed_cpus=None):
+    """Ask how many physical cores to dedicate and show the resulting pinning"""
+    cores = host.cores
+    if allowed_cpus is not None:
+        cores = [core for core in cores if set(core.cpus) <= set(allowed_cpus)]
+    defaultCores = len(cores) - 1
+    while True:
+        try:
+            coresInput = input(f"Enter number of physical cores for the VM (Default {BLUE}{defaultCores}{RESET}): ")
+            guest_cores = int(coresInput or defaultCores)
+        except ValueError:
+            print("Invalid input! Please enter only a valid number of cores")
+            continue
+
+        pin_plan = plan_cpu_pinning(host, guest_cores, allowed_cpus=allowed_cpus)
+        if pin_plan is None:
+            print(f"🚨 Error 🚨 : At most {BLUE}{defaultCores}{RESET} cores can be pinned, one is kept for the host. Try again")
+            continue
+        break
+
+    realtime = input("Use realtime (FIFO) scheduling for the vCPUs (y/N)? ").strip().lower()
+    pin_plan.realtime = realtime in ("yes", "y")
+    isolate = input("Remove these cores from the host scheduler and timer tick at boot, "
+                    "for a dedicated host (y/N)? ").strip().lower()
+    pin_plan.boot_isolation = isolate in ("yes", "y")
+
+    print("====================================================")
+    print_pin_plan(pin_plan)
+    print("====================================================")
+    return pin_plan
+
+def create_vm(distro, config=None, virtio_iso=None, unattend=None):
+    """
+    Render the VM's domain XML and define it using the provided Windows ISO.
+    A ready VmConfig and VirtIO ISO (from a spec file) skip every prompt, an
+    UnattendConfig adds the autounattend CD-ROM so Windows installs itself
+    """
+    interactive = config is None
+    if interactive:
+        iso_file = get_windows_iso()
+        config = get_vm_config()
+        config.iso_file = iso_file
+        unattend = prompt_unattend(config.name)
+    vm_name = config.name
+
+    windows, error = check_windows_iso(config.iso_file)
+    if error:
+        print(f"🚨 Error 🚨 {RED}{error}{RESET}")
+        return None
+    config.os_variant, config.tpm, config.secure_boot = windows.os_variant, windows.tpm, windows.secure_boot
+    print(f"Windows build {BLUE}{windows.build}{RESET} ({windows.arch}): os-variant {config.os_variant}, "
+          f"TPM {'on' if config.tpm else 'off'}, Secure Boot {'on' if config.secure_boot else 'off'}")
+    if not interactive:
+        make_iso_readable(config.iso_file)
+        config.iso_file = IsoCache().add_file(config.iso_file, kind="windows", version=f"Windows build {windows.build}")
+    if unattend:
+        config.unattend_iso = write_unattend_iso(vm_name, unattend, config.os_variant)
+    else:
+        #A manual install has no virtio storage driver until virtio-win is in, the disk moves later
+        config.disk_bus = "sata"
+        config.storage_profile = None
+    if not config.vnc_password:
+        #VNC listens on every address, it waits for the password asked after the install
+        config.graphics = "spice"
 
     if distro == "arch":
         subprocess.run(["systemctl", "enable", "libvertd"])
         subprocess.run(["systemctl", "start", "libvertd"])
-        subprocess.run(["virsh", "net-start", "default"])
-        subprocess.run(["virsh", "net-autostart", "default"])
-
-    disk_path = f"/var/lib/libvirt/images/{vm_name}.qcow2"
-    os_variant = "win11"
-
-    command = [
-        "virt-install",
-        "--connect", "qemu:///system",
-        "--name", vm_name,
-        "--memory", str(memory),
-        "--vcpus", f"{vcpus},sockets={sockets},cores={cores},threads={threads}",
-        "--disk", f"path={iso_file},device=cdrom,boot_order=1",
-        "--disk", f"size={diskSize},path={disk_path},format=qcow2,boot_order=2",
-        "--cdrom", iso_file,
-        "--os-variant", os_variant,
-        "--network", "network=default",
-        "--graphics", "spice",
-        "--cpu", "host-passthrough",
-        "--noautoconsole",
-        "--machine", "q35",
-        "--boot", "uefi",
-        "--tpm", "type=emulator,model=tpm-tis,version=2.0"
-    ]
+        try:
+            start_network("default")
+        except libvirt.libvirtError as e:
+            print(f"Failed to start the default network: {RED}{e}{RESET}")
+
+    if config.hugepage_size and not prepare_hugepages(vm_name, config.memory_mb, config.hugepage_size, distro):
+        config.hugepage_size = None
+    if config.pin_plan and config.pin_plan.boot_isolation:
+        prepare_boot_isolation(config.pin_plan, distro)
 
     try:
         print(f"Creating VM '{vm_name}'...")
-        subprocess.run(command, check=True)
-        subprocess.run(["virsh", "destroy", vm_name])
-        virtioDrivers(vm_name)
+        define_vm(config)
+        IsoCache().use(config.iso_file, vm_name)
+        check_vm_latency_profile(vm_name)
+        virtioDrivers(vm_name, virtio_iso, unattended=bool(unattend))
         print(f"VM '{vm_name}' created successfully")
+        if not interactive:
+            return vm_name
+        if unattend and install_unattended(vm_name):
+            return vm_name
         print("======================================================================================")
-        print("Open up Virt-manager and open the running VM you just created and install windows")
+        print("Open up Virt-manager, start the VM you just created and install windows")
         print("After, shut down your VM and come back to this terminal session to proceed!")
         print("\n⚠️  Note ⚠️ : Virt-manager sometimes fails to see the windows iso while booting up")
         print("Just rerunning the VM until it goes to the Windows install screen")
@@ -181,25 +381,20 @@ def create_vm(distro):
             else:
                 print("Waiting for confirmation...")
         return vm_name
-    except subprocess.CalledProcessError as e:
+    except (subprocess.CalledProcessError, libvirt.libvirtError, ValueError) as e:
         print(f"🚨 Error 🚨 during VM creation: {RED}{e}{RESET}")
         return None
 
-def cleanupDrives(vm_name):
-    """
-    Remove all storage devices from the VM except for the main Windows disk.
+def cleanup_drives_transform(root, vm_name):
     """
-    conn = libvirt.open('qemu:///system')
-    if conn is None:
-        print('Failed to connect to libvirt')
-        return
-
-    vm = conn.lookupByName(vm_name)
-    xml = vm.XMLDesc()
-    root = ET.fromstring(xml)
+    Remove all storage devices from the domain tree except for the main Windows disk
 
-    main_disk_basename = f"{vm_name}.qcow2"
-    disks_to_remove = []
+    Returns:
+        List of (device, target dev, source) that were removed
+    """
+    main_disk_basenames = (f"{vm_name}.qcow2", f"{vm_name}.img")
+    devices = root.find("./devices")
+    removed = []
 
     for disk in root.findall('./devices/disk'):
         source = disk.find('source')
@@ -212,79 +407,157 @@ def cleanupDrives(vm_name):
         if device != 'disk' and device != 'cdrom':
             continue
 
+        #A block device (disk, partition, LV, zvol) is only ever the main disk
+        if device == 'disk' and disk.get('type') == 'block':
+            continue
+
         file_path = source.get('file') or source.get('dev') or source.get('protocol')
         if not file_path:
             continue
 
-        if main_disk_basename not in file_path:
-            target_dev = target.get('dev')
-            disks_to_remove.append((device, target_dev))
+        if not any(basename in file_path for basename in main_disk_basenames):
+            devices.remove(disk)
+            removed.append((device, target.get('dev'), file_path))
+    return removed
 
-    #Detaching unused disks
-    for device_type, target_dev in disks_to_remove:
-        print(f"Detaching {device_type} device at {target_dev}...")
-        try:
-            subprocess.run([
-                'virsh', 'detach-disk', vm_name, target_dev, '--persistent'
-            ], check=True)
-        except subprocess.CalledProcessError as e:
-            print(f"Failed to detach {target_dev}: {RED}{e}{RESET}")
+def release_cached_isos(vm_name, removed):
+    """Let the ISO cache evict the install media once they are detached from the VM"""
+    cache = IsoCache()
+    for device_type, _, source in removed:
+        if device_type == "cdrom":
+            cache.release(source, vm_name)
 
-    if not disks_to_remove:
+def cleanupDrives(vm_name):
+    """
+    Remove all storage devices from the VM except for the main Windows disk.
+    """
+    removed = []
+
+    def transform(root):
+        removed.extend(cleanup_drives_transform(root, vm_name))
+
+    try:
+        apply_transforms(vm_name, [transform])
+    except libvirt.libvirtError as e:
+        print(f"Failed to detach drives: {RED}{e}{RESET}")
+        return
+
+    for device_type, target_dev, _ in removed:
+        print(f"Detached {device_type} device at {target_dev}")
+    release_cached_isos(vm_name, removed)
+
+    if not removed:
         print("No additional drives found to detach")
     else:
         print("All non-Windows drives have been detached")
 
-    conn.close()
+def prompt_storage_profile():
+    """Ask whether to apply the tuned virtio storage profile to the main disk"""
+    tune = input("Apply the high-performance virtio storage profile (Y/n)? ").strip().lower()
+    if tune not in ("yes", "y", ""):
+        return None
 
-def modify_storage_bus(vm_name):
-    #Connecting to the local hypervisor
-    conn = libvirt.open('qemu:///system')
-    if conn is None:
-        print('Failed to open connection to qemu:///system', file=sys.stderr)
-        sys.exit(1)
+    bench = input("Run a host-side fio comparison of the I/O modes first (y/N)? ").strip().lower()
+    if bench in ("yes", "y"):
+        compare_io_modes()
 
-    #Parse XML of the VM
-    vm = conn.lookupByName(vm_name)
-    xml_desc = vm.XMLDesc()
-    root = ET.fromstring(xml_desc)
-    modified = False
+    profile = StorageProfile()
+    while True:
+        bus = input(f"Disk bus {'/'.join(STORAGE_BUSES)} (Default {BLUE}{profile.bus}{RESET}): ").strip().lower() or profile.bus
+        if bus in STORAGE_BUSES:
+            profile.bus = bus
+            break
+        print(f"Invalid input! Choose one of: {', '.join(STORAGE_BUSES)}")
+    while True:
+        io = input(f"I/O mode {'/'.join(IO_MODES)} (Default {BLUE}{profile.io}{RESET}): ").strip().lower() or profile.io
+        if io in IO_MODES:
+            profile.io = io
+            break
+        print(f"Invalid input! Choose one of: {', '.join(IO_MODES)}")
+    return profile
+
+def storage_bus_transform(root, profile=None):
+    """
+    Move the main disks from SATA to VirtIO in the domain tree, applying a
+    StorageProfile when one is given
 
+    Returns:
+        List of target devs that were changed
+    """
+    if profile:
+        changed = apply_storage_profile(root, profile)
+        for dev in changed:
+            print(f"Tuning disk {dev}: {profile.bus}, cache={profile.cache}, io={profile.io}, discard={profile.discard}")
+        return changed
+
+    changed = []
     #Find the disk elements and update if using bus='sata'
     for disk in root.findall("./devices/disk"):
         #Only modifying the main disk device, not CD-ROMs
-        device = disk.get("device")
-        if device != "disk":
+        if disk.get("device") != "disk":
             continue
 
-        #Delete this?
-        #driver = disk.find("driver")
         target = disk.find("target")
 
         #Checking if disk uses SATA
         if target is not None and target.get("bus") == "sata":
             print(f"Modifying disk {target.get('dev')} from SATA to VirtIO...")
             target.set("bus", "virtio")
-            modified = True
+            changed.append(target.get("dev"))
 
-            #Updating address type to PCI
+            #The SATA drive address doesn't apply to virtio, libvirt assigns a PCI one
             address = disk.find("address")
             if address is not None:
-                address.set("type", "pci")
+                disk.remove(address)
+    return changed
 
-    if modified:
-        #Converting the modified XML back to a string
-        new_xml_desc = ET.tostring(root, encoding='unicode')
+def modify_storage_bus(vm_name, profile=None, block_device=None):
+    """
+    Move the main disk from SATA to VirtIO. With a StorageProfile (asked for
+    when not given) the disk also gets cache/io modes, an iothread and queues.
+    With a block device the image is first copied onto it and the VM is
+    switched to the device
+    """
+    if profile is None:
+        profile = prompt_storage_profile()
+
+    transforms = [partial(storage_bus_transform, profile=profile)]
+    try:
+        if block_device:
+            reason = device_in_use(block_device)
+            if reason:
+                print(f"🚨 Error 🚨 : {RED}{reason}{RESET}")
+                return
+            with connection() as conn:
+                if conn.lookupByName(vm_name).isActive():
+                    print(f"🚨 Error 🚨 : {vm_name} is running, shut it down before moving its disk")
+                    return
+
+            #Find the image first, the copy has to finish before the XML points at the device
+            found = {}
+            apply_transforms(vm_name, [lambda root: found.update(path=block_disk_transform(root, vm_name, block_device))],
+                             dry_run=True)
+            if not found["path"]:
+                print(f"🚨 Error 🚨 : {vm_name} has no {vm_name}.qcow2/.img disk to move")
+                return
+            print(f"Copying {found['path']} to {block_device}...")
+            copy_image_to_device(found["path"], block_device)
+            transforms.insert(0, partial(block_disk_transform, vm_name=vm_name, device=block_device))
+
+        diff = apply_transforms(vm_name, transforms)
+    except libvirt.libvirtError as e:
+        print(f"Libvirt error: {RED}{e}{RESET}", file=sys.stderr)
+        sys.exit(1)
+    except (subprocess.CalledProcessError, OSError, ValueError) as e:
+        print(f"🚨 Error 🚨 moving the disk to {block_device}: {RED}{e}{RESET}")
+        return
 
-        #Redefine the domain using the updated XML
-        conn.defineXML(new_xml_desc)
+    if diff:
         print(f"Modified {vm_name} storage to use VirtIO")
     else:
         print(f"No changes needed for {vm_name}")
 
-    conn.close()
-
-def get_local_ip():
+def get_local_ip(confirm=True):
     #Ensure we can connect to VNC
     subprocess.run(["systemctl", "enable", "ssh"])
 
@@ -296,6 +569,9 @@ def get_local_ip():
     #If theres an issue, go to default localhost
     except Exception:
         local_ip = '127.0.0.1'
+    if not confirm:
+        print(f"VNC is listening on all interfaces, your local IP 🛜 is: {local_ip}")
+        return
     while True:
         print("===================================================================================")
         print("VNC Server is set up on your VM and ssh is running on your system")
@@ -351,26 +627,24 @@ def update_display_to_vnc(vm_name, distro):
             else:
                 print("Waiting for confirmation...")
 
-    conn = libvirt.open(None)
-    if conn is None:
-        print("🚨 Failed to open connection to the hypervisor 🚨")
-        return
+    password = getpass.getpass("Enter VNC password (max 8 characters): 🔑").strip()[:8]
 
     try:
-        dom = conn.lookupByName(vm_name)
-    except libvirt.libvirtError:
-        print(f"Domain {vm_name} not found")
+        apply_transforms(vm_name, [partial(vnc_display_transform, password=password)])
+    except libvirt.libvirtError as e:
+        print(f"🚨 Failed to update the display of {vm_name} 🚨: {RED}{e}{RESET}")
         return
 
-    xml = dom.XMLDesc()
-    tree = ET.fromstring(xml)
+    print(f"Updated display to VNC with password 🔑 for VM: {PURPLE}{vm_name}{RESET}")
+    get_local_ip()
 
-    # Remove ALL spice-related elements
-    devices = tree.find("./devices")
+def vnc_display_transform(root, password):
+    """Strip every SPICE device from the domain tree and turn the SPICE display into VNC"""
+    devices = root.find("./devices")
     
     # Remove spice channels
     channels_to_remove = []
-    for channel in tree.findall("./devices/channel"):
+    for channel in root.findall("./devices/channel"):
         channel_type = channel.get('type')
         target = channel.find('target')
         source = channel.find('source')
@@ -387,37 +661,23 @@ def update_display_to_vnc(vm_name, distro):
         devices.remove(channel)
     
     # Remove spice audio devices
-    audio_devices_to_remove = []
-    for audio in tree.findall("./devices/audio"):
-        if audio.get('type') == 'spice':
-            audio_devices_to_remove.append(audio)
-    
-    for audio in audio_devices_to_remove:
+    for audio in root.findall("./devices/audio[@type='spice']"):
         print("Spice audio device found. Removing...")
         devices.remove(audio)
     
     # Remove spice USB redirection devices
-    redirdev_to_remove = []
-    for redirdev in tree.findall("./devices/redirdev"):
-        if redirdev.get('type') == 'spicevmc':
-            redirdev_to_remove.append(redirdev)
-    
-    for redirdev in redirdev_to_remove:
+    for redirdev in root.findall("./devices/redirdev[@type='spicevmc']"):
         print("Spice USB redirection device found. Removing...")
         devices.remove(redirdev)
     
     # Also remove any character devices that reference spicevmc
-    chardevs_to_remove = []
-    for chardev in tree.findall(".//chardev"):
-        if chardev.get('type') == 'spicevmc':
-            chardevs_to_remove.append(chardev)
-    
-    for chardev in chardevs_to_remove:
+    parents = {child: parent for parent in root.iter() for child in parent}
+    for chardev in root.findall(".//chardev[@type='spicevmc']"):
         print("Spice chardev found. Removing...")
-        chardev.getparent().remove(chardev)
+        parents[chardev].remove(chardev)
 
     #Removing existing graphic spice if present
-    spice_graphics = tree.find("./devices/graphics[@type='spice']")
+    spice_graphics = root.find("./devices/graphics[@type='spice']")
     if spice_graphics is not None:
         print("Found Spice graphics. Modifying to VNC...")
         
@@ -426,32 +686,71 @@ def update_display_to_vnc(vm_name, distro):
         spice_graphics.set("port", "-1")
         spice_graphics.set("autoport", "yes")
         spice_graphics.set("listen", "0.0.0.0")
-        
-        password = getpass.getpass("Enter VNC password (max 8 characters): 🔑").strip()[:8]
         spice_graphics.set("passwd", password)
 
-        # Remove any existing listen elements and add new one
-        for listen_elem in spice_graphics.findall("listen"):
-            spice_graphics.remove(listen_elem)
+        # Remove any existing listen elements (and SPICE-only children) and add new one
+        for child in list(spice_graphics):
+            spice_graphics.remove(child)
         
         listen = ET.SubElement(spice_graphics, "listen")
         listen.set("type", "address")
         listen.set("address", "0.0.0.0")
-    
-    new_xml = ET.tostring(tree, encoding='unicode')
-    
-    # Debug: Print XML to see what's still there
-    print("=== DEBUG: Checking for remaining spice references ===")
-    if 'spice' in new_xml.lower():
-        print("WARNING: Still found spice references in XML!")
-        # Show lines containing spice
-        for i, line in enumerate(new_xml.split('\n')):
-            if 'spice' in line.lower():
-                print(f"Line {i+1}: {line.strip()}")
+
+    # Check for anything SPICE that is still left
+    remaining = [elem.tag for elem in root.iter()
+                 if any('spice' in str(value).lower() for value in elem.attrib.values())]
+    if remaining:
+        print(f"WARNING: Still found spice references in XML: {', '.join(remaining)}")
+    return root
+
+def finalize_vm_devices(vm_name, distro, profile=None, password=None):
+    """
+    Storage bus, VNC display and drive cleanup in one transaction: the VM
+    XML is fetched once, every step edits the same tree and the result is
+    committed with a single defineXML
+
+    Args:
+        profile: StorageProfile, False for a plain SATA to VirtIO move, None to ask
+        password: VNC password. When given nothing is asked
+    """
+    interactive = password is None
+    if profile is None:
+        profile = prompt_storage_profile()
+
+    transforms = [partial(storage_bus_transform, profile=profile or None)]
+
+    #Fedora's display has to be changed by hand in virt-manager. Without a
+    #prompt (spec files) the libvirt API edit below is used there as well
+    vnc = distro != "fedora" or not interactive
+    if vnc:
+        if interactive:
+            password = getpass.getpass("Enter VNC password (max 8 characters): 🔑").strip()
+        password = password[:8]
+        transforms.append(partial(vnc_display_transform, password=password))
     else:
-        print("No spice references found in XML")
+        update_display_to_vnc(vm_name, distro)
+
+    removed = []
+    transforms.append(lambda root: removed.extend(cleanup_drives_transform(root, vm_name)))
+
+    try:
+        diff = apply_transforms(vm_name, transforms)
+    except libvirt.libvirtError as e:
+        print(f"Libvirt error, {vm_name} was left unchanged: {RED}{e}{RESET}")
+        return False
+
     print("=" * 55)
-    
-    conn.defineXML(new_xml)
-    print(f"Updated display to VNC with password 🔑 for VM: {PURPLE}{vm_name}{RESET}")
-    get_local_ip()
+    if diff:
+        print_diff(diff)
+    else:
+        print(f"No changes needed for {vm_name}")
+    print("=" * 55)
+    for device_type, target_dev, _ in removed:
+        print(f"Detached {device_type} device at {target_dev}")
+    release_cached_isos(vm_name, removed)
+    print(f"Updated {vm_name} with a single redefinition ✅")
+
+    if vnc:
+        get_local_ip(confirm=interactive)
+    return True
+
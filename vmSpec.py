@@ -0,0 +1,276 @@
+import json
+import os
+import threading
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass, field, fields
+
+try:
+    import tomllib
+except ImportError:
+    #Python < 3.11
+    tomllib = None
+
+from hostProbe import probe_host
+from coreIsolation import read_domain, guest_cpus
+from cpuPinning import plan_cpu_pinning
+from hugepages import HUGEPAGE_SIZES
+from storageTuning import StorageProfile, STORAGE_BUSES, IO_MODES, DiskAllocation, validate_allocation
+from domainBuilder import VmConfig
+from numaPlacement import check_node_memory
+from lookingGlass import parse_resolution, SHMEM_MODES
+from isoInspector import check_windows_iso, check_virtio_iso
+from unattend import UnattendConfig
+from blockBackend import DiskBackend, BACKENDS
+from evdevInput import resolve_input_devices, GRAB_TOGGLES
+from usbControllers import resolve_usb_controllers
+from pciDevices import find_gpu, BOOT_VGA
+
+DISPLAYS = ("vnc", "looking-glass")
+
+#Host CPUs handed to pinned VMs in this run, so the VMs of a batch don't share cores
+_pinned_cpus = set()
+_pin_lock = threading.Lock()
+REQUIRED_KEYS = ("name", "memory_mb", "disk_size_gb", "iso_file", "virtio_iso", "vnc_password")
+
+@dataclass
+class VmSpec:
+    """One VM as described in a spec file. Every prompt of the interactive flow has a key here"""
+    name: str
+    memory_mb: int
+    disk_size_gb: int
+    iso_file: str
+    virtio_iso: str
+    vnc_password: str
+    sockets: int = 1
+    cores: int = None
+    threads: int = None
+    pin_cores: int = None
+    realtime: bool = False
+    boot_isolation: bool = False
+    hugepage_size: str = None
+    storage: dict = None
+    latency_profile: bool = True
+    numa: bool = True
+    install_timeout_min: int = 0
+    gpu_passthrough: bool = True
+    display: str = "vnc"
+    resolution: str = "1920x1080"
+    shmem_mode: str = "shm"
+    unattend: dict = None
+    disk: dict = None
+    disk_backend: dict = None
+    input_devices: list = None
+    grab_toggle: str = "ctrl-ctrl"
+    usb_controllers: list = None
+    gpu: str = BOOT_VGA
+
+@dataclass
+class BatchOptions:
+    workers: int = 2
+    log_dir: str = "logs"
+    vms: list = field(default_factory=list)
+
+def _load_file(path):
+    with open(path, "rb") as f:
+        if path.endswith(".toml"):
+            if tomllib is None:
+                raise ValueError("TOML specs need Python 3.11 or newer, use JSON instead")
+            return tomllib.load(f)
+        return json.load(f)
+
+def _build_spec(entry, defaults):
+    data = {**defaults, **entry}
+    known = {f.name for f in fields(VmSpec)}
+    unknown = sorted(set(data) - known)
+    if unknown:
+        raise ValueError(f"Unknown key(s) for VM '{data.get('name', '?')}': {', '.join(unknown)}")
+    missing = [key for key in REQUIRED_KEYS if key not in data]
+    if missing:
+        raise ValueError(f"VM '{data.get('name', '?')}' is missing: {', '.join(missing)}")
+
+    spec = VmSpec(**data)
+    if spec.hugepage_size is not None and spec.hugepage_size not in HUGEPAGE_SIZES:
+        raise ValueError(f"VM '{spec.name}': hugepage_size must be one of {', '.join(HUGEPAGE_SIZES)}")
+    if spec.storage:
+        storage_profile(spec)
+    if spec.unattend:
+        unattend_config(spec)
+    if spec.disk:
+        disk_allocation(spec)
+    if spec.disk_backend:
+        disk_backend(spec)
+    if spec.grab_toggle not in GRAB_TOGGLES:
+        raise ValueError(f"VM '{spec.name}': grab_toggle must be one of {', '.join(GRAB_TOGGLES)}")
+    if spec.input_devices:
+        try:
+            resolve_input_devices(spec.input_devices)
+        except ValueError as e:
+            raise ValueError(f"VM '{spec.name}': {e}")
+    if spec.usb_controllers:
+        try:
+            resolve_usb_controllers(spec.usb_controllers)
+        except ValueError as e:
+            raise ValueError(f"VM '{spec.name}': {e}")
+    if spec.gpu_passthrough:
+        #Batch workers can't ask which GPU to use, so it has to be settled here
+        try:
+            find_gpu(spec.gpu)
+        except ValueError as e:
+            raise ValueError(f"VM '{spec.name}': gpu: {e}")
+    if spec.display not in DISPLAYS:
+        raise ValueError(f"VM '{spec.name}': display must be one of {', '.join(DISPLAYS)}")
+    if spec.display == "looking-glass":
+        parse_resolution(spec.resolution)
+        if spec.shmem_mode not in SHMEM_MODES:
+            raise ValueError(f"VM '{spec.name}': shmem_mode must be one of {', '.join(SHMEM_MODES)}")
+    for key, check in (("iso_file", check_windows_iso), ("virtio_iso", check_virtio_iso)):
+        if not os.path.isfile(getattr(spec, key)):
+            raise ValueError(f"VM '{spec.name}': {key} {getattr(spec, key)} does not exist")
+        error = check(getattr(spec, key))[1]
+        if error:
+            raise ValueError(f"VM '{spec.name}': {error}")
+    return spec
+
+def load_specs(path):
+    """
+    Read a JSON/TOML spec file. It is either a single VM, or a batch:
+
+        {"workers": 2, "log_dir": "logs", "defaults": {...}, "vms": [{...}, ...]}
+
+    Returns:
+        BatchOptions with the validated VmSpecs
+    """
+    data = _load_file(path)
+    if "vms" not in data:
+        return BatchOptions(workers=1, vms=[_build_spec(data, {})])
+
+    defaults = data.get("defaults", {})
+    vms = [_build_spec(entry, defaults) for entry in data["vms"]]
+    names = [spec.name for spec in vms]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"Duplicate VM names in {path}: {', '.join(duplicates)}")
+    return BatchOptions(
+        workers=max(1, int(data.get("workers", BatchOptions.workers))),
+        log_dir=data.get("log_dir", BatchOptions.log_dir),
+        vms=vms,
+    )
+
+def storage_profile(spec):
+    """StorageProfile for the spec's storage table, or None to only move the disk to virtio"""
+    if not spec.storage:
+        return None
+    try:
+        profile = StorageProfile(**spec.storage)
+    except TypeError as e:
+        raise ValueError(f"VM '{spec.name}': storage: {e}")
+    if profile.bus not in STORAGE_BUSES:
+        raise ValueError(f"VM '{spec.name}': storage bus must be one of {', '.join(STORAGE_BUSES)}")
+    if profile.io not in IO_MODES:
+        raise ValueError(f"VM '{spec.name}': storage io must be one of {', '.join(IO_MODES)}")
+    return profile
+
+def disk_allocation(spec):
+    """DiskAllocation for the spec's disk table, the fast defaults when it has none"""
+    try:
+        allocation = DiskAllocation(**(spec.disk or {}))
+        validate_allocation(allocation)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"VM '{spec.name}': disk: {e}")
+    return allocation
+
+def disk_backend(spec):
+    """DiskBackend for the spec's disk_backend table, or None for an image file"""
+    if not spec.disk_backend:
+        return None
+    try:
+        backend = DiskBackend(**spec.disk_backend)
+    except TypeError as e:
+        raise ValueError(f"VM '{spec.name}': disk_backend: {e}")
+    if backend.kind not in BACKENDS[1:]:
+        raise ValueError(f"VM '{spec.name}': disk_backend kind must be one of {', '.join(BACKENDS[1:])}")
+    if backend.kind == "block" and not backend.device:
+        raise ValueError(f"VM '{spec.name}': disk_backend 'block' needs a device")
+    if backend.kind != "block" and not backend.pool:
+        raise ValueError(f"VM '{spec.name}': disk_backend '{backend.kind}' needs a pool (volume group or dataset)")
+    return backend
+
+def unattend_config(spec):
+    """UnattendConfig for the spec's unattend table, or None for a manual Windows install"""
+    if not spec.unattend:
+        return None
+    try:
+        config = UnattendConfig(**spec.unattend)
+    except TypeError as e:
+        raise ValueError(f"VM '{spec.name}': unattend: {e}")
+    if not config.password:
+        raise ValueError(f"VM '{spec.name}': unattend needs a password for the Windows account")
+    return config
+
+def reserve_defined_cpus(specs, root="/"):
+    """
+    Count the pinned cores of a batch's VMs that are already defined (a
+    rerun resuming them) as taken, so the rest of the batch gets other ones
+    """
+    with _pin_lock:
+        for spec in specs:
+            try:
+                _pinned_cpus.update(guest_cpus(read_domain(spec.name, root)))
+            except (OSError, ET.ParseError):
+                continue
+
+def spec_to_config(spec, host=None, numa_node=None):
+    """
+    Check a VmSpec against the host and turn it into a VmConfig, the same
+    limits get_vm_config enforces on typed answers
+
+    Args:
+        spec: VmSpec
+        host: HostTopology (probed when not given)
+        numa_node: NumaNode of the GPU to keep the VM on, if any
+    """
+    if host is None:
+        host = probe_host()
+
+    if host.total_memory_mb and spec.memory_mb > host.total_memory_mb:
+        raise ValueError(f"VM '{spec.name}': {spec.memory_mb}MB exceeds total system memory ({host.total_memory_mb}MB)")
+    #LVs, zvols and disks don't come out of the images directory
+    if not spec.disk_backend and host.free_disk_gb is not None and spec.disk_size_gb > host.free_disk_gb:
+        raise ValueError(f"VM '{spec.name}': {spec.disk_size_gb}GB exceeds free disk space ({host.free_disk_gb}GB)")
+    if numa_node:
+        warning = check_node_memory(numa_node, spec.memory_mb)
+        if warning:
+            print(warning)
+
+    config = VmConfig(
+        name=spec.name,
+        memory_mb=spec.memory_mb,
+        disk_size_gb=spec.disk_size_gb,
+        iso_file=spec.iso_file,
+        hugepage_size=spec.hugepage_size,
+        latency_profile=spec.latency_profile,
+        numa_node=numa_node.id if numa_node else None,
+        disk_allocation=disk_allocation(spec),
+        disk_backend=disk_backend(spec),
+        vnc_password=spec.vnc_password,
+        storage_profile=storage_profile(spec),
+    )
+
+    if spec.pin_cores:
+        with _pin_lock:
+            pin_plan = plan_cpu_pinning(host, spec.pin_cores,
+                                        allowed_cpus=numa_node.cpus if numa_node else None,
+                                        realtime=spec.realtime, exclude_cpus=_pinned_cpus)
+            if pin_plan is None:
+                taken = f" next to the {len(_pinned_cpus)} CPUs given to other VMs" if _pinned_cpus else ""
+                raise ValueError(f"VM '{spec.name}': {spec.pin_cores} cores can't be pinned on this host{taken}")
+            _pinned_cpus.update(pin_plan.vcpu_pins)
+        pin_plan.boot_isolation = spec.boot_isolation
+        config.pin_plan = pin_plan
+        config.sockets, config.cores, config.threads = pin_plan.sockets, pin_plan.cores, pin_plan.threads
+        return config
+
+    config.sockets = spec.sockets
+    config.cores = spec.cores or max(1, (host.cores_per_socket or 2) - 1)
+    config.threads = spec.threads or host.threads_per_core or 1
+    return config